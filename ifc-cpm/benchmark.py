@@ -0,0 +1,210 @@
+"""
+Conversion benchmark over the bundled IFC models.
+
+Converts every model of ifc/ with fixed parameters, each in a fresh process, and records the time spent in each
+conversion stage, the peak memory and the number of converted elements. Results are written to a JSON file.
+Models can also be .npz files of parsed storey elements (see IfcToCpmConverter.save_storey_elements), in which case
+only the preprocessing of the storeys is benchmarked, without touching the IFC.
+
+Usage:
+    python benchmark.py --output results.json
+    python benchmark.py --output results.json --compare baseline.json --threshold 0.2
+    python benchmark.py --output results.json elements/LargeBuilding1.npz
+"""
+import os
+import sys
+import glob
+import json
+import time
+import logging
+import argparse
+import queue as queue_module
+import platform
+import resource
+import tempfile
+import multiprocessing
+
+BUILD_PARAMETERS = {
+    "origin": (5, 5),
+    "close_wall_gap_metre": 0.4,
+}
+
+# Stage time differences below this many seconds are considered noise
+MIN_REGRESSION_SECONDS = 0.05
+
+
+def get_peak_rss_mb() -> float:
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    if platform.system() == "Darwin":
+        return peak_rss / 1024 / 1024
+    return peak_rss / 1024
+
+
+def benchmark_model(ifc_filepath: str, build_parameters: dict) -> dict:
+    from lib.IfcToCpmConverter import IfcToCpmConverterBuilder
+    from lib.logger import logger
+    logger.setLevel(logging.CRITICAL)
+
+    start = time.perf_counter()
+    builder = IfcToCpmConverterBuilder(ifc_filepath)
+    load_time = time.perf_counter() - start
+    converter = builder.build(**build_parameters, profile=True)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        converter.write(os.path.join(tmp_dir, "out.cpm"))
+    total_time = time.perf_counter() - start
+
+    levels = converter.crowd_environment.levels
+    return {
+        "stages": {"load": load_time, **converter.get_stage_times()},
+        "total": total_time,
+        "peak_rss_mb": get_peak_rss_mb(),
+        "elements": {
+            "levels": len(levels),
+            "walls": sum(len(level.walls) for level in levels),
+            "gates": sum(len(level.gates) for level in levels),
+            "barricades": sum(len(level.barricades) for level in levels),
+            "stairs": len(converter.crowd_environment.stairs),
+        },
+        "counters": converter.get_profile()["counters"],
+        "unparsable": len(converter.get_unparsable_objects()),
+    }
+
+
+def benchmark_elements(elements_filepath: str, build_parameters: dict) -> dict:
+    from lib.element_table import load_element_tables, ELEMENT_TYPE_CODES
+    from lib.preprocessors import preprocess_storey_elements_within_budget
+    from lib.profiling import Profiler
+    from lib.logger import logger
+    logger.setLevel(logging.CRITICAL)
+
+    start = time.perf_counter()
+    storeys_elements = load_element_tables(elements_filepath)
+    load_time = time.perf_counter() - start
+    profiler = Profiler()
+    processed = [
+        preprocess_storey_elements_within_budget(
+            elements,
+            tolerance=build_parameters.get("close_wall_gap_metre", 0.2),
+            split_method=build_parameters.get("split_method", "sweep-line"),
+            profiler=profiler.get_storey_profiler(name),
+        )
+        for name, elements in storeys_elements.items()
+    ]
+    total_time = time.perf_counter() - start
+
+    def count(element_type):
+        return sum(int((elements.types == ELEMENT_TYPE_CODES[element_type]).sum()) for elements, _ in processed)
+
+    return {
+        "stages": {"load": load_time, **profiler.get_stage_times()},
+        "total": total_time,
+        "peak_rss_mb": get_peak_rss_mb(),
+        "elements": {
+            "levels": len(processed),
+            "walls": count("Wall"),
+            "gates": count("Gate"),
+            "barricades": count("Barricade"),
+            "stairs": 0,
+        },
+        "counters": profiler.get_counters(),
+        "unparsable": sum(len(left_out) for _, left_out in processed),
+    }
+
+
+def _benchmark_model_worker(ifc_filepath: str, build_parameters: dict, queue):
+    try:
+        if ifc_filepath.endswith(".npz"):
+            queue.put(benchmark_elements(ifc_filepath, build_parameters))
+        else:
+            queue.put(benchmark_model(ifc_filepath, build_parameters))
+    except Exception as e:
+        queue.put({"error": f"{type(e).__name__}: {e}"})
+
+
+def run_benchmark(ifc_filepaths, build_parameters: dict, repeat: int = 1) -> dict:
+    """
+    Benchmark each model in a fresh process, so that peak memory is measured per model.
+    When repeating, the fastest run of each model is kept.
+    """
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for ifc_filepath in ifc_filepaths:
+        name = os.path.splitext(os.path.basename(ifc_filepath))[0]
+        runs = []
+        for _ in range(repeat):
+            queue = context.Queue()
+            process = context.Process(target=_benchmark_model_worker, args=(ifc_filepath, build_parameters, queue))
+            process.start()
+            result = None
+            while result is None:
+                try:
+                    result = queue.get(timeout=1)
+                except queue_module.Empty:
+                    if not process.is_alive():
+                        # Crashed without reporting, e.g. a segmentation fault in the geometry kernel
+                        result = {"error": f"Process exited with code {process.exitcode}"}
+            process.join()
+            runs.append(result)
+            if "error" in result:
+                break
+        results[name] = min(runs, key=lambda r: r.get("total", 0))
+        if "error" in results[name]:
+            print(f"{name}: {results[name]['error']}")
+        else:
+            print(f"{name}: {results[name]['total']:.2f}s, {results[name]['peak_rss_mb']:.0f} MB")
+    return results
+
+
+def compare_results(baseline: dict, results: dict, threshold: float):
+    """
+    Returns a list of (model, metric, baseline value, new value) for every stage time, total time or peak memory
+    that grew by more than threshold (relative) compared to the baseline.
+    """
+    regressions = []
+    for name, result in results["models"].items():
+        baseline_result = baseline["models"].get(name)
+        if baseline_result is None or "error" in baseline_result or "error" in result:
+            continue
+
+        metrics = [(f"stages.{stage}", baseline_result["stages"].get(stage), duration) for stage, duration in result["stages"].items()]
+        metrics.append(("total", baseline_result["total"], result["total"]))
+        for metric, baseline_value, value in metrics:
+            if baseline_value is not None and value - baseline_value > max(threshold * baseline_value, MIN_REGRESSION_SECONDS):
+                regressions.append((name, metric, baseline_value, value))
+        if result["peak_rss_mb"] > (1 + threshold) * baseline_result["peak_rss_mb"]:
+            regressions.append((name, "peak_rss_mb", baseline_result["peak_rss_mb"], result["peak_rss_mb"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the IFC to CPM conversion of the bundled models.")
+    parser.add_argument("models", nargs="*", help="IFC files to convert, or .npz files of parsed storey elements to preprocess (default: ifc/*.ifc)")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file to write the results to")
+    parser.add_argument("--repeat", type=int, default=1, help="Convert each model this many times and keep the fastest run")
+    parser.add_argument("--compare", help="Baseline JSON file to compare the results with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Relative increase reported as a regression")
+    args = parser.parse_args()
+
+    ifc_filepaths = args.models or sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "ifc", "*.ifc")))
+    results = {
+        "parameters": BUILD_PARAMETERS,
+        "python": platform.python_version(),
+        "cpus": multiprocessing.cpu_count(),
+        "models": run_benchmark(ifc_filepaths, BUILD_PARAMETERS, repeat=args.repeat),
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare_results(baseline, results, args.threshold)
+        for name, metric, baseline_value, value in regressions:
+            print(f"REGRESSION {name} {metric}: {baseline_value:.3f} -> {value:.3f}")
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
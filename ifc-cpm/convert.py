@@ -0,0 +1,94 @@
+"""
+Batch conversion of IFC files to CPM.
+
+Converts every given IFC file (paths or glob patterns) with the same build parameters, several files at a time,
+and writes a JSON manifest of the outputs, durations, unparsable object counts and errors. A file that fails or
+times out is recorded in the manifest and does not stop the batch.
+
+Usage:
+    python convert.py "ifc/*.ifc" --output-dir cpm --origin 5 5 --close-wall-gap 0.4 --jobs 4 --timeout 600
+"""
+import os
+import sys
+import glob
+import json
+import argparse
+from lib.batch import convert_files
+from lib.preprocessors import SPLIT_METHODS
+
+
+def expand_inputs(patterns):
+    ifc_filepaths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        for ifc_filepath in matches:
+            if ifc_filepath not in ifc_filepaths:
+                ifc_filepaths.append(ifc_filepath)
+    return ifc_filepaths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert IFC files to CPM, several files at a time.")
+    parser.add_argument("inputs", nargs="+", help="IFC files or glob patterns")
+    parser.add_argument("--output-dir", default="cpm", help="Directory to write the CPM files to")
+    parser.add_argument("--manifest", help="JSON manifest to write (default: <output-dir>/manifest.json)")
+    parser.add_argument("--jobs", type=int, default=None, help="Number of files converted at the same time (default: all cores)")
+    parser.add_argument("--timeout", type=float, default=None, help="Seconds after which the conversion of a file is aborted")
+    parser.add_argument("--compress", action="store_true", help="Write gzip compressed .cpm.gz files")
+    parser.add_argument("--building", help="Name of the building to convert (default: the first building)")
+    parser.add_argument("--origin", type=float, nargs=2, metavar=("X", "Y"))
+    parser.add_argument("--dimension", type=float, nargs=2, metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--close-wall-gap", type=float, default=0.2, help="Metres")
+    parser.add_argument("--min-wall-height", type=float, default=0.5, help="Metres")
+    parser.add_argument("--wall-offset-tolerance", type=float, default=0.1, help="Metres")
+    parser.add_argument("--split-method", choices=list(SPLIT_METHODS.keys()), default="sweep-line")
+    parser.add_argument("--split-max-iterations", type=int, default=None, help="Split points per storey, across retries, after which the walls being split again are reported as unparsable")
+    parser.add_argument("--split-max-seconds", type=float, default=None, help="Seconds of splitting per storey, across retries, after which the walls being split again are reported as unparsable")
+    parser.add_argument("--low-memory", action="store_true", help="Only load the parts of the IFC files used by the converter")
+    parser.add_argument("--cache-dir", help="Directory of the persisted geometry caches")
+    parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"], default="WARNING", help="Level of the conversion logs")
+    args = parser.parse_args()
+
+    ifc_filepaths = expand_inputs(args.inputs)
+    if len(ifc_filepaths) == 0:
+        parser.error("No IFC files match the inputs")
+
+    extension = ".cpm.gz" if args.compress else ".cpm"
+    jobs = []
+    for ifc_filepath in ifc_filepaths:
+        name = os.path.splitext(os.path.basename(ifc_filepath))[0]
+        cpm_out_filepath = os.path.join(args.output_dir, name + extension)
+        if cpm_out_filepath in [out for _, out in jobs]:
+            parser.error(f"Several inputs would be written to {cpm_out_filepath}")
+        jobs.append((ifc_filepath, cpm_out_filepath))
+
+    build_parameters = {
+        "origin": tuple(args.origin) if args.origin else None,
+        "dimension": tuple(args.dimension) if args.dimension else None,
+        "close_wall_gap_metre": args.close_wall_gap,
+        "min_wall_height_metre": args.min_wall_height,
+        "wall_offset_tolerance_metre": args.wall_offset_tolerance,
+        "split_method": args.split_method,
+        "split_max_iterations": args.split_max_iterations,
+        "split_max_seconds": args.split_max_seconds,
+        "cache_dir": args.cache_dir,
+    }
+    os.makedirs(args.output_dir, exist_ok=True)
+    results = convert_files(jobs, build_parameters, building_name=args.building, workers=args.jobs, timeout=args.timeout, log_level=args.log_level, low_memory=args.low_memory)
+
+    for result in results:
+        if result["status"] == "ok":
+            print(f"{result['input']}: {result['duration']:.2f}s, {result['unparsable']} unparsable objects")
+        else:
+            print(f"{result['input']}: {result['status']}: {result['error']}")
+
+    manifest_filepath = args.manifest or os.path.join(args.output_dir, "manifest.json")
+    with open(manifest_filepath, "w") as f:
+        json.dump({"parameters": build_parameters, "low_memory": args.low_memory, "results": results}, f, indent=2)
+
+    if any(result["status"] != "ok" for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
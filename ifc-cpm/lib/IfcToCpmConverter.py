@@ -1,4 +1,4 @@
-from typing import Tuple, List
+from typing import Dict, Tuple, List
 import ifcopenshell
 import ifcopenshell.geom
 import ifcopenshell.util.placement
@@ -6,21 +6,63 @@ import ifcopenshell.util.element
 import ifcopenshell.util.unit
 from skspatial.objects import Line
 import math
+import os
+import gzip
+import re
+import copy
+import contextlib
+import json
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from .cpm_writer import CrowdSimulationEnvironment, Level
 from .representation_helpers import WallVertices
-from .preprocessors import convert_disconnected_walls_into_barricades, split_intersecting_elements, decompose_wall_with_openings, glue_connected_elements, close_wall_gaps
+from .preprocessors import preprocess_storey_elements_within_budget, SPLIT_METHODS
+from .split_budget import SplitBudget
+from .storey_pool import preprocess_storeys, create_storey_pool
+from .element_table import ElementTable, save_element_tables
 from .ifctypes import WallWithOpening, Wall
 from .walls import get_walls_by_storey
-from .stairs import StairParser
-from .utils import filter, get_sorted_building_storeys, truncate, get_oriented_xy_bounding_box, get_edge_from_bounding_box
+from .stairs import StairParser, get_stair_footprints
+from .storey_index import StoreyElevationIndex
+from .model_index import ModelIndex
+from .z_extents import ZExtentResolver
+from .utils import filter, get_oriented_xy_bounding_box_batch, get_edge_from_bounding_box, get_sorted_building_storeys
+from .obb import COLLINEAR_POINTS_ERROR
+from .fixed_point import snap_vertex
 from .geom_settings import settings
 from .logger import logger
 from .unparsable import get_unparsable_elements
+from .shape_cache import ShapeCache, DEFAULT_MAX_BYTES, TESSELLATED_PRODUCT_TYPES, WALL_TYPES, get_tessellated_products, get_geometry_cache_path, get_default_geometry_workers
+from .profiling import Profiler, NULL_PROFILER
+from .incremental import EntityHasher, IncrementalState, get_storey_fingerprint
+from .selective_loading import open_selectively
+
+# Openings and doors starting at most this far above a storey elevation are considered to reach its floor
+OPENING_FLOOR_TOLERANCE_METRE = 0.02
+
+
+def get_profile_path(cpm_out_filepath: str) -> str:
+    """
+    Path of the JSON profile written next to a CPM file, e.g. out.profile.json for out.cpm or out.cpm.gz
+    """
+    root = cpm_out_filepath
+    for extension in [".gz", ".cpm"]:
+        if root.endswith(extension):
+            root = root[:-len(extension)]
+    return f"{root}.profile.json"
 
 
 class IfcToCpmConverterBuilder:
-    def __init__(self, ifc_filepath: str):
-        self.model = ifcopenshell.open(ifc_filepath)
+    def __init__(self, ifc_filepath: str, low_memory=False):
+        """
+        low_memory: only load the instances of the file used by the converter, see selective_loading
+        """
+        self.ifc_filepath = ifc_filepath
+        if low_memory:
+            self.model = open_selectively(ifc_filepath)
+        else:
+            self.model = ifcopenshell.open(ifc_filepath)
         self.unit_scale = ifcopenshell.util.unit.calculate_unit_scale(self.model)
 
     def get_buildings(self):
@@ -30,64 +72,290 @@ class IfcToCpmConverterBuilder:
         return buildings
 
     def get_ifc_building(self, name=None):
+        """
+        Input: Name or GlobalId of the building, None for the first building
+        """
         for ifc_building in self.model.by_type("IfcBuilding"):
             if name is None:
                 return ifc_building
-            if name == ifc_building.Name:
+            if name == ifc_building.Name or name == ifc_building.GlobalId:
                 return ifc_building
 
-    def build(self, building_name: str = None, dimension: Tuple[int, int] = None, origin: Tuple[int, int] = None, close_wall_gap_metre=0.2, min_wall_height_metre=0.5, wall_offset_tolerance_metre=0.1):
+    def build(self, building_name: str = None, dimension: Tuple[int, int] = None, origin: Tuple[int, int] = None, close_wall_gap_metre=0.2, min_wall_height_metre=0.5, wall_offset_tolerance_metre=0.1, split_method="sweep-line", shape_cache_max_bytes=DEFAULT_MAX_BYTES, geometry_workers=None, cache_dir=None, workers=1, incremental_state_path=None, profile=False, split_max_iterations=None, split_max_seconds=None, shared_shape_cache=None, process_pool=None):
         ifc_building = self.get_ifc_building(building_name)
+        geometry_cache_path = None
+        if cache_dir is not None:
+            geometry_cache_path = get_geometry_cache_path(cache_dir, self.ifc_filepath)
         return IfcToCpmConverter(
             ifc_building=ifc_building,
+            model=self.model,
             unit_scale=self.unit_scale,
             dimension=dimension,
             origin=origin,
             close_wall_gap_metre=close_wall_gap_metre,
             min_wall_height_metre=min_wall_height_metre,
-            wall_offset_tolerance_metre=wall_offset_tolerance_metre
+            wall_offset_tolerance_metre=wall_offset_tolerance_metre,
+            split_method=split_method,
+            shape_cache_max_bytes=shape_cache_max_bytes,
+            geometry_workers=geometry_workers,
+            geometry_cache_path=geometry_cache_path,
+            workers=workers,
+            incremental_state_path=incremental_state_path,
+            profile=profile,
+            split_max_iterations=split_max_iterations,
+            split_max_seconds=split_max_seconds,
+            shared_shape_cache=shared_shape_cache,
+            process_pool=process_pool,
         )
 
+    def build_all(self, output_dir: str = None, compress=False, threads=None, **build_parameters) -> Dict[str, dict]:
+        """
+        Convert every building of the model in threads sharing the loaded model and one geometry cache.
+        The threads only share the model and the cache; parsing is Python code holding the GIL, so they do not speed up
+        the conversion. With workers other than 1, the storeys of all buildings are preprocessed in one shared pool of
+        worker processes, which runs the 2D stages of the buildings in parallel.
+        Buildings without storeys are skipped.
+        Input:
+            output_dir: directory to write the CPM file of each building to, named after the building
+            threads: number of buildings converted at the same time, None uses the default of ThreadPoolExecutor
+            build_parameters: keyword arguments of build, except building_name, incremental_state_path,
+                shared_shape_cache and process_pool
+        Output: dict of building name to the result of its conversion, with the status ("ok" or "error"), the duration,
+            and the converter, or the path of its CPM file when output_dir is given, or the error.
+            A building that fails does not stop the others.
+            Buildings without a name, or with the name of a previous building, are keyed by their GlobalId.
+        """
+        if "incremental_state_path" in build_parameters:
+            raise ValueError("Incremental conversion is not supported when converting all buildings")
+        workers = build_parameters.pop("workers", 1)
+        cache_dir = build_parameters.pop("cache_dir", None)
+        geometry_cache_path = get_geometry_cache_path(cache_dir, self.ifc_filepath) if cache_dir is not None else None
+        shape_cache = ShapeCache(max_bytes=build_parameters.get("shape_cache_max_bytes", DEFAULT_MAX_BYTES))
+        if geometry_cache_path is not None and os.path.exists(geometry_cache_path):
+            logger.debug(f"Loading geometry cache {geometry_cache_path}...")
+            shape_cache.load(geometry_cache_path)
+
+        names, seen_names = [], set()
+        for ifc_building in self.model.by_type("IfcBuilding"):
+            name = ifc_building.Name if ifc_building.Name and ifc_building.Name not in seen_names else ifc_building.GlobalId
+            seen_names.add(ifc_building.Name)
+            if len(get_sorted_building_storeys(ifc_building)) == 0:
+                logger.info(f"Skipping building {name} without storeys")
+                continue
+            names.append(name)
+
+        def convert(name):
+            start = time.perf_counter()
+            try:
+                converter = self.build(name, shared_shape_cache=shape_cache, process_pool=process_pool, **build_parameters)
+                if output_dir is None:
+                    return {"status": "ok", "duration": time.perf_counter() - start, "converter": converter}
+                cpm_out_filepath = os.path.join(output_dir, re.sub(r"[^\w.-]+", "_", name) + (".cpm.gz" if compress else ".cpm"))
+                converter.write(cpm_out_filepath, compress=compress)
+            except Exception as e:
+                logger.error(e, exc_info=True)
+                return {"status": "error", "duration": time.perf_counter() - start, "error": f"{type(e).__name__}: {e}"}
+            return {"status": "ok", "duration": time.perf_counter() - start, "output": cpm_out_filepath}
+
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+        with create_storey_pool(workers) if workers != 1 else contextlib.nullcontext() as process_pool, ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = {name: executor.submit(convert, name) for name in names}
+            results = {name: future.result() for name, future in futures.items()}
+
+        if geometry_cache_path is not None and shape_cache.is_modified:
+            shape_cache.save(geometry_cache_path)
+        return results
+
 
 class IfcToCpmConverter:
-    def __init__(self, ifc_building, unit_scale, dimension: Tuple[int, int] = None, origin: Tuple[int, int] = None, close_wall_gap_metre=0, min_wall_height_metre=0.5, wall_offset_tolerance_metre=0.1):
+    def __init__(self, ifc_building, unit_scale, dimension: Tuple[int, int] = None, origin: Tuple[int, int] = None, close_wall_gap_metre=0, min_wall_height_metre=0.5, wall_offset_tolerance_metre=0.1, split_method="sweep-line", shape_cache_max_bytes=DEFAULT_MAX_BYTES, model=None, geometry_workers=None, geometry_cache_path=None, workers=1, incremental_state_path=None, profile=False, split_max_iterations=None, split_max_seconds=None, shared_shape_cache=None, process_pool=None):
+        """
+        shared_shape_cache: geometry cache shared with the converters of other buildings; it is loaded and saved by
+            its owner, so geometry_cache_path and shape_cache_max_bytes are ignored
+        process_pool: pool of storey_pool.create_storey_pool shared with other converters, which preprocesses the
+            storeys instead of workers
+        """
+        if split_method not in SPLIT_METHODS:
+            raise ValueError(f"Unknown split method {split_method}, expected one of {list(SPLIT_METHODS.keys())}")
+
         # A list to store things that could not be parsed
         self.unparsable_objects = []
+        # Time spent in each conversion stage, per storey and per product; only recorded when profiling
+        self.profiler = Profiler(enabled=profile)
 
         if origin is None:
             origin = (0, 0)
 
         self.ifc_building = ifc_building
         self.unit_scale = unit_scale
-        self.crowd_environment = CrowdSimulationEnvironment(offset=origin, dimension=dimension, unit_scaler=lambda x: round(x * 1000) / 1000)
+        self.origin = origin
+        self.dimension = dimension
+        self.crowd_environment = self._create_crowd_environment()
 
         self.close_wall_gap_metre = close_wall_gap_metre
-        self.storeys = get_sorted_building_storeys(ifc_building)
+        self.split_method = split_method
+        # Walls of a storey whose intersections cannot be split within this budget are reported as unparsable
+        self.split_budget = SplitBudget(max_iterations=split_max_iterations, max_seconds=split_max_seconds)
+        # Number of processes preprocessing storeys in parallel, None uses all cores
+        self.workers = workers
+        self.process_pool = process_pool
+        # Preprocessed storeys of a previous conversion, reused for the storeys that did not change
+        self.incremental_state_path = incremental_state_path
+        self.previous_state = None
+        if incremental_state_path is not None and os.path.exists(incremental_state_path):
+            logger.debug(f"Loading incremental state {incremental_state_path}...")
+            self.previous_state = IncrementalState.load(incremental_state_path)
+
+        with self.profiler.stage("index"):
+            self.model_index = ModelIndex(ifc_building)
+
+        self.storey_index = StoreyElevationIndex(ifc_building, unit_scale, self.model_index)
+        self.storeys = self.storey_index.storeys
+
+        self.owns_shape_cache = shared_shape_cache is None
+        if self.owns_shape_cache:
+            self.shape_cache = ShapeCache(max_bytes=shape_cache_max_bytes, profiler=self.profiler)
+        else:
+            self.shape_cache = shared_shape_cache
+            geometry_cache_path = None
+        # Axis vertices of each wall, see _infer_wall_vertices
+        self.wall_vertices = {}
+        self.z_extents = ZExtentResolver(self.shape_cache, unit_scale, profiler=self.profiler)
+        if geometry_workers is None:
+            geometry_workers = get_default_geometry_workers()
+        with self.profiler.stage("geometry"):
+            cache_loaded = False
+            if geometry_cache_path is not None and os.path.exists(geometry_cache_path):
+                # Geometry persisted by a previous conversion of the same file, no need to tessellate again
+                logger.debug(f"Loading geometry cache {geometry_cache_path}...")
+                cache_loaded = self.shape_cache.load(geometry_cache_path)
+            if not cache_loaded and model is not None and geometry_workers != 0:
+                # Tessellate all products up-front across multiple cores; the stages below read from the cache
+                # When converting incrementally, only walls are needed up-front to find the storeys that changed
+                types = WALL_TYPES if self.previous_state is not None else TESSELLATED_PRODUCT_TYPES
+                self.shape_cache.populate(settings, model, self._get_tessellated_products(types), workers=geometry_workers)
 
         min_wall_height = min_wall_height_metre  # Minimum wall height to be considered as a wall
         wall_offset_tolerance = wall_offset_tolerance_metre  # Maximum gap between the wall and level to be considered as a wall
-        self.walls_map = get_walls_by_storey(ifc_building, min_wall_height=min_wall_height, wall_offset_tolerance=wall_offset_tolerance, unit_scale=self.unit_scale)
+        with self.profiler.stage("walls"):
+            self.walls_map = get_walls_by_storey(ifc_building, min_wall_height=min_wall_height, wall_offset_tolerance=wall_offset_tolerance, unit_scale=self.unit_scale, shape_cache=self.shape_cache, storey_index=self.storey_index, model_index=self.model_index)
 
-        self._parse_stairs()
+        with self.profiler.stage("stairs"):
+            self._parse_stairs()
         self._parse_storeys()
-        self.unparsable_objects += get_unparsable_elements(self.ifc_building)
-
-    def write(self, cpm_out_filepath):
+        with self.profiler.stage("unparsable"):
+            self.unparsable_elements = get_unparsable_elements(self.ifc_building, self.model_index)
+        self.unparsable_objects += self.unparsable_elements
+        logger.debug(f"Shape cache: {self.shape_cache.get_stats()}")
+        logger.debug(f"Opening and door z extents: {dict(self.z_extents.counts)}")
+        if geometry_cache_path is not None and self.shape_cache.is_modified:
+            self.shape_cache.save(geometry_cache_path)
+
+    def write(self, cpm_out_filepath, pretty=True, compress=None, write_profile=False):
+        """
+        Stream the CPM document into cpm_out_filepath.
+        The output is gzip compressed if compress is True, or if compress is None and the path ends with ".gz".
+        If write_profile is True, the profile of the conversion is written as JSON next to the output, see get_profile_path.
+        """
         logger.debug("Writing to file...")
-        with open(cpm_out_filepath, "w") as f:
-            f.write(self.crowd_environment.write())
+        if compress is None:
+            compress = cpm_out_filepath.endswith(".gz")
+        if compress:
+            f = gzip.open(cpm_out_filepath, "wt", encoding="utf-8")
+        else:
+            f = open(cpm_out_filepath, "w", encoding="utf-8")
+        with f, self.profiler.stage("write"):
+            self.crowd_environment.write(output=f, pretty=pretty)
+
+        if write_profile:
+            with open(get_profile_path(cpm_out_filepath), "w", encoding="utf-8") as f:
+                json.dump(self.get_profile(), f, indent=2)
+
+    def save_storey_elements(self, path, stage="parsed", compress=False):
+        """
+        Save the element table of each storey to a .npz file, see element_table.save_element_tables.
+        Tables are keyed by "<storey index>:<storey name>".
+        stage: "parsed" for the walls with openings given to the preprocessors, "preprocessed" for their output.
+        Storeys reused from an incremental state were not parsed, so they are left out of the parsed stage.
+        """
+        if stage not in self.storeys_elements:
+            raise ValueError(f"Unknown stage {stage}, expected one of {list(self.storeys_elements.keys())}")
+        tables = {name: elements for name, elements in self.storeys_elements[stage].items() if elements is not None}
+        save_element_tables(path, tables, compress=compress)
 
     def get_unparsable_objects(self) -> Tuple[any, str]:
         return self.unparsable_objects
 
+    def get_stage_times(self) -> Dict[str, float]:
+        """
+        Seconds spent in each conversion stage so far, including write(). Empty unless profiling.
+        """
+        return self.profiler.get_stage_times()
+
+    def get_profile(self) -> dict:
+        """
+        Stage times, counters and slowest products of the conversion so far, in total and per storey. Empty unless profiling.
+        """
+        if not self.profiler.enabled:
+            return {}
+        return {**self.profiler.get_profile(), "shape_cache": self.shape_cache.get_stats()}
+
+    def _get_tessellated_products(self, types):
+        """
+        Products to tessellate up-front. Openings and doors whose z extents show that they do not reach the floor of
+        any storey are never tessellated, so they are left out.
+        """
+        products = get_tessellated_products(self.ifc_building, types, self.model_index)
+        return [x for x in products if not (x.is_a("IfcOpeningElement") or x.is_a("IfcDoor")) or self._may_reach_a_floor(x)]
+
+    def with_close_wall_gap(self, close_wall_gap_metre, process_pool=None) -> "IfcToCpmConverter":
+        """
+        Input: process_pool: see __init__, by default the pool of this converter
+        Output: converter of the same building with another close_wall_gap_metre, which reuses the parsed walls and
+            stairs of this converter and only preprocesses the storeys again
+        """
+        if self.incremental_state_path is not None:
+            raise ValueError("Cannot reuse the parsed walls of an incremental conversion")
+        converter = copy.copy(self)
+        converter.close_wall_gap_metre = close_wall_gap_metre
+        converter.process_pool = process_pool or self.process_pool
+        converter.profiler = Profiler(enabled=self.profiler.enabled)
+        converter.unparsable_objects = list(self.parsed_unparsable_objects)
+        converter.crowd_environment = converter._create_crowd_environment()
+        for stair in self.stairs:
+            converter.crowd_environment.add_stair(stair)
+
+        storey_names = list(self.storeys_elements["parsed"].keys())
+        storeys_elements = list(self.storeys_elements["parsed"].values())
+        converter.storeys_elements = {"parsed": self.storeys_elements["parsed"], "preprocessed": {}}
+        profilers = [converter.profiler.get_storey_profiler(name) for name in storey_names]
+        converter._preprocess_storeys(storeys_elements, list(range(len(storeys_elements))), profilers, [[] for _ in storeys_elements])
+        converter.storeys_elements["preprocessed"] = dict(zip(storey_names, storeys_elements))
+        converter._add_levels(storeys_elements)
+        converter.unparsable_objects += self.unparsable_elements
+        return converter
+
+    def _create_crowd_environment(self) -> CrowdSimulationEnvironment:
+        return CrowdSimulationEnvironment(offset=self.origin, dimension=self.dimension, unit_scaler=lambda x: round(x * 1000) / 1000, array_unit_scaler=lambda x: np.round(x * 1000) / 1000)
+
+    def _may_reach_a_floor(self, ifc_product) -> bool:
+        _, z_extents = self.z_extents.get_analytic_z_extents(ifc_product)
+        if z_extents is None:
+            return True
+        min_z, max_z = z_extents
+        return any(min_z <= elevation + OPENING_FLOOR_TOLERANCE_METRE and max_z >= elevation for elevation in self.storey_index.scaled_elevations)
+
     def _parse_stairs(self):
         self.stairs = []
-        for storey_id, storey in enumerate(self.storeys):
-            building_elements = ifcopenshell.util.element.get_decomposition(storey)
-            stairs_in_storey = [x for x in building_elements if x.is_a("IfcStair")]
-            for stair_in_storey in stairs_in_storey:
+        storeys_stairs = [self.model_index.get_storey_elements(storey, "IfcStair") for storey in self.storeys]
+        # The footprints of all the stairs of the building are computed in one batch
+        footprints = iter(get_stair_footprints([x for stairs in storeys_stairs for x in stairs], self.shape_cache))
+        for storey_id, stairs_in_storey in enumerate(storeys_stairs):
+            for stair_in_storey, footprint in zip(stairs_in_storey, footprints):
                 try:
-                    stair = StairParser.from_ifc_stair(self.ifc_building, storey_id, stair_in_storey)
+                    with self.profiler.product("stairs", stair_in_storey):
+                        stair = StairParser.from_ifc_stair(self.ifc_building, storey_id, stair_in_storey, self.shape_cache, self.storey_index, footprint)
                     self.stairs.append(stair)
                     self.crowd_environment.add_stair(stair)
                 except Exception as e:
@@ -96,44 +364,137 @@ class IfcToCpmConverter:
                     self.unparsable_objects.append((stair_in_storey, str(e)))
 
     def _parse_storeys(self):
+        storeys_elements = []
+        storeys_unparsable_walls = []
+        fingerprints = []
+        profilers = []
+        storey_names = [f"{storey_id}:{storey.Name}" for storey_id, storey in enumerate(self.storeys)]
+        hasher = EntityHasher()
         for storey_id, storey in enumerate(self.storeys):
-            elements = self._get_storey_elements(storey_id, storey)
+            profiler = self.profiler.get_storey_profiler(storey_names[storey_id])
+            profilers.append(profiler)
+            fingerprint = None
+            if self.incremental_state_path is not None:
+                with profiler.stage("fingerprints"):
+                    fingerprint = self._get_storey_fingerprint(hasher, storey)
+            fingerprints.append(fingerprint)
+
+            saved_storey = self.previous_state.get(fingerprint) if self.previous_state is not None else None
+            if saved_storey is not None:
+                logger.debug(f"Reusing unchanged storey: {storey_id} {storey.Name}")
+                elements, unparsable_walls = saved_storey
+                walls = {ifc_wall.GlobalId: ifc_wall for ifc_wall in self.walls_map[storey]}
+                self.unparsable_objects += [(walls[global_id], message) for global_id, message in unparsable_walls]
+                storeys_elements.append(elements)
+                storeys_unparsable_walls.append(unparsable_walls)
+            else:
+                unparsable_objects_count = len(self.unparsable_objects)
+                # Tessellations on demand are attributed to the storey as well, unless other converters share the cache
+                if self.owns_shape_cache:
+                    self.shape_cache.profiler = profiler
+                with profiler.stage("wall-inference"):
+                    elements = ElementTable.from_elements(self._get_storey_elements(storey_id, storey, profiler))
+                if self.owns_shape_cache:
+                    self.shape_cache.profiler = self.profiler
+                storeys_elements.append(elements)
+                storeys_unparsable_walls.append([(ifc_wall.GlobalId, message) for ifc_wall, message in self.unparsable_objects[unparsable_objects_count:]])
+
+        # Only storeys that were not reused from the previous state still need to be preprocessed
+        unprocessed = [i for i, fingerprint in enumerate(fingerprints) if self.previous_state is None or self.previous_state.get(fingerprint) is None]
+        # Element tables of each storey before and after preprocessing, see save_storey_elements
+        self.storeys_elements = {
+            "parsed": {name: storeys_elements[i] if i in unprocessed else None for i, name in enumerate(storey_names)},
+            "preprocessed": {},
+        }
+        # Objects that could not be parsed before preprocessing, see with_close_wall_gap
+        self.parsed_unparsable_objects = list(self.unparsable_objects)
+        self._preprocess_storeys(storeys_elements, unprocessed, profilers, storeys_unparsable_walls)
+        self.storeys_elements["preprocessed"] = dict(zip(storey_names, storeys_elements))
+
+        if self.incremental_state_path is not None:
+            state = IncrementalState()
+            for fingerprint, elements, unparsable_walls in zip(fingerprints, storeys_elements, storeys_unparsable_walls):
+                state.put(fingerprint, elements, unparsable_walls)
+            state.save(self.incremental_state_path)
+
+        self._add_levels(storeys_elements)
+
+    def _preprocess_storeys(self, storeys_elements: List[ElementTable], unprocessed: List[int], profilers: List[Profiler], storeys_unparsable_walls: List[List[Tuple[str, str]]]):
+        """
+        Preprocess the parsed element tables of the unprocessed storeys, in place, and report the walls left out.
+        """
+        tolerance = self.close_wall_gap_metre  # / self.unit_scale
+        if self.process_pool is not None:
+            processed = preprocess_storeys([storeys_elements[i] for i in unprocessed], tolerance=tolerance, split_method=self.split_method, profilers=[profilers[i] for i in unprocessed], split_budget=self.split_budget, pool=self.process_pool)
+        elif self.workers == 1 or len(unprocessed) <= 1:
+            processed = [preprocess_storey_elements_within_budget(storeys_elements[i], tolerance=tolerance, split_method=self.split_method, profiler=profilers[i], split_budget=self.split_budget) for i in unprocessed]
+        else:
+            processed = preprocess_storeys([storeys_elements[i] for i in unprocessed], tolerance=tolerance, split_method=self.split_method, workers=self.workers, profilers=[profilers[i] for i in unprocessed], split_budget=self.split_budget)
+        for i, (elements, left_out) in zip(unprocessed, processed):
+            storeys_elements[i] = elements
+            walls = {ifc_wall.GlobalId: ifc_wall for ifc_wall in self.walls_map[self.storeys[i]]}
+            for global_id, message in left_out:
+                if global_id not in walls:
+                    logger.warning(f"Skipped element splitting: {message}")
+                    continue
+                logger.warning(f"Skipped wall splitting: error splitting wall {walls[global_id].Name}: {message}")
+                self.unparsable_objects.append((walls[global_id], message))
+                storeys_unparsable_walls[i].append((global_id, message))
+
+    def _add_levels(self, storeys_elements: List[ElementTable]):
+        for storey_id, storey_elements in enumerate(storeys_elements):
+            elements = storey_elements.to_elements()
+            # elements += self._get_storey_void_barricade_elements(storey)
+            elements += self._get_storey_stair_border_walls(storey_id)
             level = Level(index=storey_id, elements=elements)
             self.crowd_environment.add_level(level)
 
-    def _get_storey_elements(self, storey_id, storey):
+    def _get_storey_fingerprint(self, hasher, storey):
+        elevation = self.storey_index.get_elevation(storey) * self.unit_scale
+        parameters = (self.close_wall_gap_metre, self.split_method, self.unit_scale, self.split_budget.max_iterations, self.split_budget.max_seconds)
+        return get_storey_fingerprint(hasher, self.model_index, self.walls_map[storey], elevation, parameters)
+
+    def _get_storey_elements(self, storey_id, storey, profiler=NULL_PROFILER):
         logger.debug(f"Processing storey: {storey_id} {storey.Name}")
         ifc_walls = self.walls_map[storey]
-        building_elements = []
+        self._infer_wall_vertices(ifc_walls)
+        walls_openings = []
         for ifc_wall in ifc_walls:
             try:
-                wall_with_opening = self._get_wall_with_opening(ifc_wall=ifc_wall, ifc_building_storey=storey)
-                building_elements.append(wall_with_opening)
+                with profiler.product("wall-inference", ifc_wall):
+                    walls_openings.append(self._get_wall_opening_geometries(ifc_wall=ifc_wall, ifc_building_storey=storey))
+            except Exception as exc:
+                walls_openings.append(exc)
+
+        # The boxes of the openings and doors of all the walls of the storey are computed in one batch
+        opening_geometries = [vertices for x in walls_openings if not isinstance(x, Exception) for vertices in x[2]]
+        opening_bboxes = iter(get_oriented_xy_bounding_box_batch(opening_geometries))
+
+        building_elements = []
+        for ifc_wall, wall_openings in zip(ifc_walls, walls_openings):
+            try:
+                if isinstance(wall_openings, Exception):
+                    raise wall_openings
+                start_vertex, end_vertex, geometries = wall_openings
+                bboxes = [next(opening_bboxes) for _ in geometries]
+                building_elements.append(self._get_wall_with_opening(ifc_wall, start_vertex, end_vertex, bboxes))
             except Exception as exc:
                 logger.warning(f"Skipped wall parsing: error parsing wall {ifc_wall.Name}: {exc}")
                 logger.error(exc, exc_info=True)
                 self.unparsable_objects.append((ifc_wall, str(exc)))
 
-        tolerance = self.close_wall_gap_metre  # / self.unit_scale
-
-        if tolerance > 0:
-            logger.debug("Glueing wall connections...")
-            building_elements = glue_connected_elements(elements=building_elements, tolerance=tolerance)
-
-        logger.debug("Decomposing wall openings...")
-        building_elements = decompose_wall_with_openings(building_elements)
-
-        logger.debug("Splitting intersections...")
-        building_elements = split_intersecting_elements(building_elements)
-
-        if tolerance > 0:
-            logger.debug("Closing wall gaps...")
-            building_elements = close_wall_gaps(building_elements, tolerance=tolerance)
-        building_elements = convert_disconnected_walls_into_barricades(building_elements)
-        # building_elements += self._get_storey_void_barricade_elements(storey)
-        building_elements += self._get_storey_stair_border_walls(storey_id)
         return building_elements
 
+    def _infer_wall_vertices(self, ifc_walls):
+        """
+        Infer the axis vertices of the walls not inferred yet, in one batch.
+        Walls spanning several storeys are inferred once per converter, a failure is kept and raised by
+        _get_wall_opening_geometries.
+        """
+        ifc_walls = [x for x in dict.fromkeys(ifc_walls) if x not in self.wall_vertices]
+        for ifc_wall, vertices in zip(ifc_walls, WallVertices.from_products(ifc_walls, self.shape_cache)):
+            self.wall_vertices[ifc_wall] = vertices
+
     def _get_storey_stair_border_walls(self, storey_id):
         walls: List[Wall] = []
         stairs_voiding_storey = filter(self.stairs, lambda s: storey_id > s.start_level_index and storey_id <= s.end_level_index)
@@ -163,15 +524,22 @@ class IfcToCpmConverter:
 
         return walls
 
-    def _get_wall_with_opening(self, ifc_wall, ifc_building_storey) -> WallWithOpening:
+    def _get_wall_opening_geometries(self, ifc_wall, ifc_building_storey):
+        """
+        Output: Snapped axis vertices of the wall, and the vertices of each of its openings and doors in the storey
+        """
         logger.debug("Inferring wall vertices for wall " + ifc_wall.Name + "...")
-        start_vertex, end_vertex = WallVertices.from_product(ifc_wall)
-        start_vertex = truncate(start_vertex[0]), truncate(start_vertex[1])
-        end_vertex = truncate(end_vertex[0]), truncate(end_vertex[1])
+        if ifc_wall not in self.wall_vertices:
+            self._infer_wall_vertices([ifc_wall])
+        vertices = self.wall_vertices[ifc_wall]
+        if isinstance(vertices, Exception):
+            raise vertices
+        start_vertex, end_vertex = vertices
+        start_vertex, end_vertex = snap_vertex(start_vertex), snap_vertex(end_vertex)
 
         opening_geometries = []
-        elevation = ifcopenshell.util.placement.get_storey_elevation(ifc_building_storey) * self.unit_scale
-        tolerance = 0.02  # / self.unit_scale  # Tolerance is 2cm
+        elevation = self.storey_index.get_elevation(ifc_building_storey) * self.unit_scale
+        tolerance = OPENING_FLOOR_TOLERANCE_METRE  # / self.unit_scale
 
         # Parse openings
         openings = ifc_wall.HasOpenings
@@ -179,54 +547,52 @@ class IfcToCpmConverter:
             opening_element = opening.RelatedOpeningElement
             if opening_element.PredefinedType is None or opening_element.PredefinedType.upper() != 'RECESS':
                 try:
-                    shape = ifcopenshell.geom.create_shape(settings, opening_element)
-                    min_z = min(shape.geometry.verts[2::3])
-                    max_z = max(shape.geometry.verts[2::3])
+                    min_z, max_z = self.z_extents.get_z_extents(opening_element)
 
                     opening_is_likely_a_door = min_z <= elevation + tolerance
                     if not opening_is_likely_a_door or max_z < elevation:
                         continue
 
-                    opening_geometries.append((shape))
+                    opening_geometries.append(self.shape_cache.get_vertices(settings, opening_element))
                 except Exception as e:
                     logger.warning(f"Skipping opening parsing: error parsing opening {opening_element.Name}: {e}")
                     logger.error(e, exc_info=True)
 
         # Parse doors without opening
-        ifc_doors = [x for x in ifcopenshell.util.element.get_decomposition(ifc_wall) if x.is_a("IfcDoor")]
-        for ifc_door in ifc_doors:
-            opening_container = ifcopenshell.util.element.get_container(ifc_door, "IfcOpeningElement")
+        for ifc_door in self.model_index.get_wall_doors(ifc_wall):
+            opening_container = self.model_index.get_door_opening_container(ifc_door)
             if opening_container:
                 continue
 
             try:
-                shape = ifcopenshell.geom.create_shape(settings, ifc_door)
-                min_z = min(shape.geometry.verts[2::3])
-                max_z = max(shape.geometry.verts[2::3])
+                min_z, max_z = self.z_extents.get_z_extents(ifc_door)
 
                 door_in_storey = min_z <= elevation + tolerance
                 if not door_in_storey or max_z < elevation:
                     continue
 
-                opening_geometries.append((shape))
+                opening_geometries.append(self.shape_cache.get_vertices(settings, ifc_door))
             except Exception as e:
                 logger.warning(f"Skipping door parsing: error parsing door {ifc_door.Name}: {e}")
                 logger.error(e, exc_info=True)
 
+        return start_vertex, end_vertex, opening_geometries
+
+    def _get_wall_with_opening(self, ifc_wall, start_vertex, end_vertex, opening_bboxes) -> WallWithOpening:
+        """
+        Input: opening_bboxes: Box of each opening and door of the wall, from get_oriented_xy_bounding_box_batch
+        """
         # Project vertices into wall for alignment
         opening_vertices = []
-        for shape in opening_geometries:
-            vertices = ifcopenshell.util.shape.get_vertices(shape.geometry)
-            bbox = get_oriented_xy_bounding_box(vertices)
+        for bbox in opening_bboxes:
+            if bbox is None:
+                raise ValueError(COLLINEAR_POINTS_ERROR)
             v1, v2 = get_edge_from_bounding_box(bbox)
 
             wall_line = Line.from_points(start_vertex, end_vertex)
-            x1, y1 = wall_line.project_point(v1)
-            x2, y2 = wall_line.project_point(v2)
-
-            x1, y1 = truncate(x1), truncate(y1)
-            x2, y2 = truncate(x2), truncate(y2)
-            opening_vertices.append(((x1, y1), (x2, y2)))
+            opening_v1 = snap_vertex(wall_line.project_point(v1))
+            opening_v2 = snap_vertex(wall_line.project_point(v2))
+            opening_vertices.append((opening_v1, opening_v2))
 
         logger.debug("    Finished")
 
@@ -0,0 +1,116 @@
+import os
+import time
+import multiprocessing
+import multiprocessing.connection
+from typing import List, Tuple
+
+"""
+Conversion of many IFC files in a pool of worker processes.
+Each file is converted in its own process, so that a file that crashes the geometry kernel or exceeds its time budget
+can be killed without affecting the others. At most `workers` files are converted at the same time.
+Each process sends its result through its own pipe, so that killing a process can only lose the result of its file.
+"""
+
+# Seconds between checks of the running conversions for timeouts and crashes
+POLL_INTERVAL = 0.5
+
+
+def convert_file(ifc_filepath: str, cpm_out_filepath: str, build_parameters: dict, building_name: str = None, low_memory: bool = False) -> dict:
+    """
+    Convert a single IFC file. The output is written to a temporary file first, so that it only exists once complete.
+    Output: dict of the number of unparsable objects, by IFC class as well
+    """
+    from .IfcToCpmConverter import IfcToCpmConverterBuilder
+
+    converter = IfcToCpmConverterBuilder(ifc_filepath, low_memory=low_memory).build(building_name, **build_parameters)
+    tmp_filepath = f"{cpm_out_filepath}.{os.getpid()}.tmp"
+    try:
+        converter.write(tmp_filepath, compress=cpm_out_filepath.endswith(".gz"))
+        os.replace(tmp_filepath, cpm_out_filepath)
+    finally:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+
+    unparsable_by_type = {}
+    for ifc_entity, _ in converter.get_unparsable_objects():
+        unparsable_by_type[ifc_entity.is_a()] = unparsable_by_type.get(ifc_entity.is_a(), 0) + 1
+    return {
+        "unparsable": len(converter.get_unparsable_objects()),
+        "unparsable_by_type": unparsable_by_type,
+    }
+
+
+def _convert_file_worker(ifc_filepath: str, cpm_out_filepath: str, build_parameters: dict, building_name: str, low_memory: bool, log_level, connection):
+    from .logger import logger
+    if log_level is not None:
+        logger.setLevel(log_level)
+    try:
+        result = {"status": "ok", **convert_file(ifc_filepath, cpm_out_filepath, build_parameters, building_name, low_memory)}
+    except Exception as e:
+        logger.error(e, exc_info=True)
+        result = {"status": "error", "error": f"{type(e).__name__}: {e}"}
+    connection.send(result)
+    connection.close()
+
+
+def convert_files(jobs: List[Tuple[str, str]], build_parameters: dict, building_name: str = None, workers: int = None, timeout: float = None, log_level=None, low_memory: bool = False) -> List[dict]:
+    """
+    Input:
+        jobs: Array of (IFC file path, CPM output file path)
+        build_parameters: keyword arguments of IfcToCpmConverterBuilder.build
+        workers: maximum number of files converted at the same time, None uses all cores
+        timeout: seconds after which the conversion of a file is killed, None waits forever
+        log_level: level of the converter logger in the worker processes, None keeps the default
+        low_memory: only load the parts of the IFC files used by the converter, see IfcToCpmConverterBuilder
+    Output: Array of the result of each job, in the same order, with the status ("ok", "error" or "timeout"),
+        the output path, the duration and the number of unparsable objects or the error
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    context = multiprocessing.get_context("spawn")
+    pending = list(enumerate(jobs))
+    running = {}  # index -> (process, receiving end of its pipe, start time)
+    results = [None] * len(jobs)
+
+    def finish(index: int, result: dict):
+        process, receiver, start = running.pop(index)
+        receiver.close()
+        process.join()
+        ifc_filepath, cpm_out_filepath = jobs[index]
+        results[index] = {
+            "input": ifc_filepath,
+            "output": cpm_out_filepath if result["status"] == "ok" else None,
+            "duration": time.perf_counter() - start,
+            **result,
+        }
+
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(running) < workers:
+            index, (ifc_filepath, cpm_out_filepath) = pending.pop(0)
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=_convert_file_worker, args=(ifc_filepath, cpm_out_filepath, build_parameters, building_name, low_memory, log_level, sender))
+            process.start()
+            # Only the worker holds the sending end, so the pipe reports the end of file once it exits
+            sender.close()
+            running[index] = (process, receiver, time.perf_counter())
+
+        ready = multiprocessing.connection.wait([receiver for _, receiver, _ in running.values()], timeout=POLL_INTERVAL)
+        for index, (process, receiver, start) in list(running.items()):
+            if receiver in ready:
+                try:
+                    result = receiver.recv()
+                except EOFError:
+                    # Exited without reporting, e.g. a segmentation fault in the geometry kernel
+                    process.join()
+                    result = {"status": "error", "error": f"Process exited with code {process.exitcode}"}
+                finish(index, result)
+            elif timeout is not None and time.perf_counter() - start > timeout:
+                process.kill()
+                finish(index, {"status": "timeout", "error": f"Timed out after {timeout}s"})
+                # The killed conversion had no chance to remove its partial output
+                tmp_filepath = f"{jobs[index][1]}.{process.pid}.tmp"
+                if os.path.exists(tmp_filepath):
+                    os.remove(tmp_filepath)
+
+    return results
@@ -1,9 +1,13 @@
 from typing import List, Tuple
 import math
 from collections import defaultdict
+import numpy as np
 import xmltodict
 from .ifctypes import BuildingElement, Wall, Gate, Barricade, StraightSingleRunStair, DoubleRunStairWithLanding
-from .utils import filter, truncate
+from .utils import filter
+from .fixed_point import snap_array
+
+STAIR_TYPES = ['StraightSingleRunStair', 'DoubleRunStairWithLanding']
 
 
 class Level:
@@ -25,13 +29,21 @@ class Level:
 
 
 class CrowdSimulationEnvironment:
-    def __init__(self, offset=(0, 0), dimension=None, unit_scaler=lambda x: x):
+    def __init__(self, offset=(0, 0), dimension=None, unit_scaler=lambda x: x, array_unit_scaler=None):
+        """
+        unit_scaler: scales a length or coordinate to the unit of the CPM file
+        array_unit_scaler: same as unit_scaler for a NumPy array of coordinates, by default unit_scaler is applied to
+            each coordinate
+        """
         self.highest_id_map = defaultdict(lambda: 0)
         self.levels: List[Level] = []
         self.stairs: List[StraightSingleRunStair] = []
         self.vertices = {}
         self.x_offset, self.y_offset = offset
         self.unit_scaler = unit_scaler
+        if array_unit_scaler is None:
+            array_unit_scaler = np.vectorize(unit_scaler, otypes=[np.float64])
+        self.array_unit_scaler = array_unit_scaler
         self.dimension = dimension
 
     def add_level(self, level):
@@ -40,11 +52,16 @@ class CrowdSimulationEnvironment:
     def add_stair(self, stair: StraightSingleRunStair):
         self.stairs.append(stair)
 
-    def write(self):
+    def write(self, output=None, pretty=True):
+        """
+        Returns the CPM document as a string, or streams it into output (a text file handle) when given.
+        When streaming, levels are converted one at a time while they are being written.
+        """
+        # (n, 2, 2) array of the start and end vertices of the elements of each level
+        self.levels_vertices = [self._get_element_vertices(level.elements) for level in self.levels]
         self.map_bounds = self._get_map_bounds()
-        levels = [self._get_level(x) for x in self.levels if len(x.elements) > 0]
-        stairs = [self._create_stair_json(s) for s in self.stairs]
-        stairs = [s for s in stairs if s is not None]
+        levels = self._get_levels()
+        stairs = self._get_stairs()
         data = {
             "Model": {
                 "@xmlns:xsd": "http://www.w3.org/2001/XMLSchema",
@@ -60,14 +77,33 @@ class CrowdSimulationEnvironment:
             }
         }
 
-        return xmltodict.unparse(data, pretty=True)
+        return xmltodict.unparse(data, output=output, pretty=pretty)
+
+    def _get_levels(self):
+        levels = [(x, vertices) for x, vertices in zip(self.levels, self.levels_vertices) if len(x.elements) > 0]
+        # xmltodict skips empty lists, but not empty generators
+        if len(levels) == 0:
+            return []
+        return (self._get_level(x, vertices) for x, vertices in levels)
+
+    def _get_stairs(self):
+        stairs = [s for s in self.stairs if s.__type__ in STAIR_TYPES]
+        if len(stairs) == 0:
+            return []
+        # Stairs are numbered after all levels, so they must be converted lazily as well
+        return (self._create_stair_json(s) for s in stairs)
 
-    def _get_level(self, level: Level):
+    def _get_level(self, level: Level, vertices: np.ndarray):
         level_id = self._get_id(Level)
 
-        walls = [x for x in [self._create_wall_json(x) for x in level.walls] if x is not None]
-        gates = [self._create_gate_json(x) for x in level.gates]
-        barricades = [self._create_barricade_json(x) for x in level.barricades]
+        # Normalized vertices and scaled lengths of all elements of the level are computed at once
+        # Same as BuildingElement.length
+        dx, dy = (vertices[:, 1] - vertices[:, 0]).T
+        lengths = self.array_unit_scaler(np.sqrt(dx ** 2 + dy ** 2)).tolist()
+        elements = list(zip(level.elements, self._normalize_vertices(vertices).tolist(), lengths))
+        walls = [x for x in [self._create_wall_json(x, v, length) for x, v, length in elements if x.__type__ == 'Wall'] if x is not None]
+        gates = [self._create_gate_json(x, v, length) for x, v, length in elements if x.__type__ == 'Gate']
+        barricades = [self._create_barricade_json(x, v, length) for x, v, length in elements if x.__type__ == 'Barricade']
 
         if self.dimension is not None:
             width, height = self.dimension
@@ -83,11 +119,10 @@ class CrowdSimulationEnvironment:
             "gate_pkg": {"gates": {"Gate": gates}},
         }
 
-    def _create_wall_json(self, wall: Wall):
+    def _create_wall_json(self, wall: Wall, vertices, length: float):
         wall_id = self._get_id()
-        (x1, y1), (x2, y2) = self._normalize_vertex(wall.start_vertex), self._normalize_vertex(wall.end_vertex)
+        (x1, y1), (x2, y2) = vertices
 
-        length = self.unit_scaler(wall.length)
         if length == 0:
             return None
 
@@ -106,12 +141,12 @@ class CrowdSimulationEnvironment:
             },
         }
 
-    def _create_gate_json(self, gate: Gate):
+    def _create_gate_json(self, gate: Gate, vertices, length: float):
         gate_id = self._get_id()
-        (x1, y1), (x2, y2) = self._normalize_vertex(gate.start_vertex), self._normalize_vertex(gate.end_vertex)
+        (x1, y1), (x2, y2) = vertices
         return {
             "id": gate_id,
-            "length": self.unit_scaler(gate.length),
+            "length": length,
             "angle": 0,  # TODO?
             "destination": False,
             "counter": False,
@@ -125,20 +160,20 @@ class CrowdSimulationEnvironment:
             },
         }
 
-    def _create_barricade_json(self, barricade: Barricade):
+    def _create_barricade_json(self, barricade: Barricade, vertices, length: float):
         barricade_id = self._get_id()
-        (x1, y1), (x2, y2) = barricade.start_vertex, barricade.end_vertex
+        (x1, y1), (x2, y2) = vertices
 
         return {
             "id": barricade_id,
-            "length": self.unit_scaler(barricade.length),
+            "length": length,
             "isLow": False,
             "isTransparent": False,
             "iWlWG": False,
             "vertices": {
                 "Vertex": [
-                    self._get_vertex(self._normalize_vertex((x1, y1))),
-                    self._get_vertex(self._normalize_vertex((x2, y2)))
+                    self._get_vertex((x1, y1)),
+                    self._get_vertex((x2, y2))
                 ]
             },
         }
@@ -282,16 +317,19 @@ class CrowdSimulationEnvironment:
         return id
 
     def _normalize_vertex(self, vertex: Tuple[float, float]) -> Tuple[float, float]:
-        x1, y1 = vertex
-        x1, y1 = self._scale_to_metric((x1, y1))
+        x, y = self._normalize_vertices(np.array([vertex], dtype=np.float64)).tolist()[0]
+        return x, y
+
+    def _normalize_vertices(self, vertices: np.ndarray) -> np.ndarray:
+        """
+        Scale vertices to metric, snap them onto the grid and move them to the map origin.
+        Input: array of vertices, with x and y on the last axis
+        Output: array of the same shape
+        """
+        vertices = snap_array(self.array_unit_scaler(vertices))
         (x_min, y_min), _ = self.map_bounds
-
-        x1, y1 = truncate(x1), truncate(y1)
-        x_min, y_min = truncate(x_min), truncate(y_min)
-
-        x1, y1 = x1 + self.x_offset - x_min, y1 + self.y_offset - y_min
-
-        return x1, y1
+        x_min, y_min = snap_array(np.array([x_min, y_min], dtype=np.float64)).tolist()
+        return vertices + np.array([self.x_offset, self.y_offset]) - np.array([x_min, y_min])
 
     def _scale_to_metric(self, length):
         if isinstance(length, tuple):
@@ -312,17 +350,23 @@ class CrowdSimulationEnvironment:
 
         return w, h
 
+    @staticmethod
+    def _get_element_vertices(elements: List[BuildingElement]) -> np.ndarray:
+        return np.array([(element.start_vertex, element.end_vertex) for element in elements], dtype=np.float64).reshape(-1, 2, 2)
+
     def _get_map_bounds(self):
         x_max = 0
         x_min = math.inf
         y_max = 0
         y_min = math.inf
-        for level in self.levels:
-            for element in level.elements:
-                x_max = max(x_max, element.start_vertex[0], element.end_vertex[0])
-                x_min = min(x_min, element.start_vertex[0], element.end_vertex[0])
-                y_max = max(y_max, element.start_vertex[1], element.end_vertex[1])
-                y_min = min(y_min, element.start_vertex[1], element.end_vertex[1])
+        for vertices in self.levels_vertices:
+            if len(vertices) == 0:
+                continue
+            (level_x_min, level_y_min), (level_x_max, level_y_max) = vertices.min(axis=(0, 1)).tolist(), vertices.max(axis=(0, 1)).tolist()
+            x_max = max(x_max, level_x_max)
+            x_min = min(x_min, level_x_min)
+            y_max = max(y_max, level_y_max)
+            y_min = min(y_min, level_y_min)
 
         x_max = math.ceil(x_max)
         y_max = math.ceil(y_max)
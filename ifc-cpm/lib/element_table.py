@@ -0,0 +1,329 @@
+import os
+from array import array
+from typing import Dict, List, Tuple
+import numpy as np
+from .ifctypes import BuildingElement, WallWithOpening, Wall, Barricade, Gate
+
+"""
+Columnar store of the 2D building elements of a storey.
+Instead of one Python object per element, elements are stored as rows of a few NumPy arrays: a type code,
+the start and end vertices, and the indices of the element name and object id in a shared string table.
+Openings and connections only exist on a few elements, so they are kept in side tables keyed by row.
+The preprocessors work on tables; to_elements converts a table back into BuildingElement objects for the writer.
+Tables can be saved to and loaded from .npz files with save_element_tables and load_element_tables, e.g. to re-run
+the preprocessors on the parsed walls of a model without converting the IFC again.
+"""
+
+ELEMENT_TYPES = ["BuildingElement", "WallWithOpening", "Wall", "Barricade", "Gate"]
+ELEMENT_TYPE_CODES = {element_type: i for i, element_type in enumerate(ELEMENT_TYPES)}
+ELEMENT_CLASSES = {
+    "WallWithOpening": WallWithOpening,
+    "Wall": Wall,
+    "Barricade": Barricade,
+    "Gate": Gate,
+}
+
+# Index of missing names and object ids
+NO_STRING = -1
+
+# Bump whenever the layout of saved element tables changes
+ELEMENT_TABLES_FORMAT_VERSION = 1
+
+Line = Tuple[Tuple[float, float], Tuple[float, float]]
+
+
+class ElementTable:
+    def __init__(self, types: np.ndarray, vertices: np.ndarray, names: np.ndarray, object_ids: np.ndarray, strings: List[str], opening_vertices=None, connected_to=None):
+        self.types = types  # (n,) uint8 index into ELEMENT_TYPES
+        self.vertices = vertices  # (n, 2, 2) float64 start and end vertex of each element
+        self.names = names  # (n,) int32 index into strings
+        self.object_ids = object_ids  # (n,) int32 index into strings
+        self.strings = strings
+        self.opening_vertices = opening_vertices if opening_vertices is not None else {}
+        self.connected_to = connected_to if connected_to is not None else {}
+
+    @staticmethod
+    def from_elements(elements: List[BuildingElement]) -> "ElementTable":
+        builder = ElementTableBuilder()
+        for element in elements:
+            builder.append(
+                element.__type__,
+                element.start_vertex,
+                element.end_vertex,
+                name=element.name,
+                object_id=element.object_id,
+                opening_vertices=getattr(element, "opening_vertices", None),
+                connected_to=getattr(element, "connected_to", None),
+            )
+        return builder.build()
+
+    def __len__(self):
+        return len(self.types)
+
+    def get_type(self, i: int) -> str:
+        return ELEMENT_TYPES[self.types[i]]
+
+    def get_name(self, i: int) -> str:
+        return self._get_string(self.names[i])
+
+    def get_object_id(self, i: int) -> str:
+        return self._get_string(self.object_ids[i])
+
+    def get_lines(self) -> List[Line]:
+        return [((x1, y1), (x2, y2)) for (x1, y1), (x2, y2) in self.vertices.tolist()]
+
+    def get_line(self, i: int) -> Line:
+        (x1, y1), (x2, y2) = self.vertices[i].tolist()
+        return (x1, y1), (x2, y2)
+
+    def get_lengths(self) -> np.ndarray:
+        deltas = self.vertices[:, 1] - self.vertices[:, 0]
+        return np.sqrt(deltas[:, 0] ** 2 + deltas[:, 1] ** 2)
+
+    def get_vertex_degrees(self) -> np.ndarray:
+        """
+        Output: (n, 2) array of the number of element ends at the start and end vertex of each element
+        """
+        # Adding 0.0 turns -0.0 into 0.0, which are the same vertex
+        endpoints = self.vertices.reshape(-1, 2) + 0.0
+        if len(endpoints) == 0:
+            return np.zeros((0, 2), dtype=np.int64)
+        _, inverse, counts = np.unique(endpoints, axis=0, return_inverse=True, return_counts=True)
+        return counts[inverse.reshape(-1)].reshape(-1, 2)
+
+    def with_lines(self, lines: List[Line]) -> "ElementTable":
+        """
+        Returns a copy of the table with the vertices of every element replaced, sharing all other columns.
+        """
+        return self.with_vertices(np.array(lines, dtype=np.float64).reshape(-1, 2, 2))
+
+    def with_vertices(self, vertices: np.ndarray) -> "ElementTable":
+        return ElementTable(self.types, vertices, self.names, self.object_ids, self.strings, self.opening_vertices, self.connected_to)
+
+    def select(self, rows, side_tables=True) -> "ElementTable":
+        """
+        Returns a table of the given rows, in the given order. Side tables are dropped if side_tables is False.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        opening_vertices, connected_to = {}, {}
+        if side_tables:
+            positions = np.full(len(self), -1, dtype=np.int64)
+            positions[rows] = np.arange(len(rows))
+            opening_vertices = {int(positions[i]): x for i, x in self.opening_vertices.items() if positions[i] >= 0}
+            connected_to = {int(positions[i]): x for i, x in self.connected_to.items() if positions[i] >= 0}
+        return ElementTable(self.types[rows], self.vertices[rows], self.names[rows], self.object_ids[rows], self.strings, opening_vertices, connected_to)
+
+    @staticmethod
+    def concatenate(tables: List["ElementTable"]) -> "ElementTable":
+        """
+        Rows of all tables, in order. The string tables are merged, so names and object ids stay the same.
+        """
+        strings = list(tables[0].strings)
+        string_indices = {string: i for i, string in enumerate(strings)}
+        names, object_ids = [], []
+        opening_vertices, connected_to = {}, {}
+        offset = 0
+        for table in tables:
+            for string in table.strings:
+                if string not in string_indices:
+                    string_indices[string] = len(strings)
+                    strings.append(string)
+            # The last entry maps NO_STRING onto itself
+            string_map = np.array([string_indices[string] for string in table.strings] + [NO_STRING], dtype=np.int32)
+            names.append(string_map[table.names])
+            object_ids.append(string_map[table.object_ids])
+            opening_vertices.update({offset + i: x for i, x in table.opening_vertices.items()})
+            connected_to.update({offset + i: x for i, x in table.connected_to.items()})
+            offset += len(table)
+        return ElementTable(
+            types=np.concatenate([table.types for table in tables]),
+            vertices=np.concatenate([table.vertices for table in tables]),
+            names=np.concatenate(names),
+            object_ids=np.concatenate(object_ids),
+            strings=strings,
+            opening_vertices=opening_vertices,
+            connected_to=connected_to,
+        )
+
+    def get_element(self, i: int) -> BuildingElement:
+        element_type = self.get_type(i)
+        (x1, y1), (x2, y2) = self.vertices[i].tolist()
+        kwargs = {
+            "object_id": self.get_object_id(i),
+            "name": self.get_name(i),
+            "start_vertex": (x1, y1),
+            "end_vertex": (x2, y2),
+        }
+        if element_type in ("WallWithOpening", "Wall"):
+            kwargs["connected_to"] = self.connected_to.get(i, [])
+        if element_type == "WallWithOpening":
+            kwargs["opening_vertices"] = self.opening_vertices.get(i, [])
+
+        if element_type in ELEMENT_CLASSES:
+            return ELEMENT_CLASSES[element_type](**kwargs)
+        return BuildingElement(**kwargs, type=element_type)
+
+    def to_elements(self) -> List[BuildingElement]:
+        return [self.get_element(i) for i in range(len(self))]
+
+    def to_arrays(self, prefix: str = "") -> Dict[str, np.ndarray]:
+        """
+        Flatten the table, including its side tables, into NumPy arrays that can be stored with np.savez.
+        """
+        strings = list(self.strings)
+        string_indices = {string: i for i, string in enumerate(strings)}
+
+        def intern(string):
+            if string is None:
+                return NO_STRING
+            if string not in string_indices:
+                string_indices[string] = len(strings)
+                strings.append(string)
+            return string_indices[string]
+
+        opening_rows = sorted(self.opening_vertices.keys())
+        connected_to_rows = sorted(self.connected_to.keys())
+        opening_vertices = [opening for i in opening_rows for opening in self.opening_vertices[i]]
+        connected_to = [(intern(element_id), intern(connection_type)) for i in connected_to_rows for element_id, connection_type in self.connected_to[i]]
+        return {
+            f"{prefix}types": self.types,
+            f"{prefix}vertices": self.vertices,
+            f"{prefix}names": self.names,
+            f"{prefix}object_ids": self.object_ids,
+            f"{prefix}strings": np.array(strings, dtype=str),
+            f"{prefix}opening_rows": np.array(opening_rows, dtype=np.int64),
+            f"{prefix}opening_offsets": np.cumsum([0] + [len(self.opening_vertices[i]) for i in opening_rows], dtype=np.int64),
+            f"{prefix}opening_vertices": np.array(opening_vertices, dtype=np.float64).reshape(-1, 2, 2),
+            f"{prefix}connected_to_rows": np.array(connected_to_rows, dtype=np.int64),
+            f"{prefix}connected_to_offsets": np.cumsum([0] + [len(self.connected_to[i]) for i in connected_to_rows], dtype=np.int64),
+            f"{prefix}connected_to": np.array(connected_to, dtype=np.int32).reshape(-1, 2),
+        }
+
+    @staticmethod
+    def from_arrays(arrays, prefix: str = "") -> "ElementTable":
+        strings = arrays[f"{prefix}strings"].tolist()
+
+        def get_string(index):
+            return None if index == NO_STRING else strings[index]
+
+        opening_offsets = arrays[f"{prefix}opening_offsets"].tolist()
+        opening_vertices = [((x1, y1), (x2, y2)) for (x1, y1), (x2, y2) in arrays[f"{prefix}opening_vertices"].tolist()]
+        connected_to_offsets = arrays[f"{prefix}connected_to_offsets"].tolist()
+        connected_to = [(get_string(element_id), get_string(connection_type)) for element_id, connection_type in arrays[f"{prefix}connected_to"].tolist()]
+        return ElementTable(
+            types=arrays[f"{prefix}types"],
+            vertices=arrays[f"{prefix}vertices"],
+            names=arrays[f"{prefix}names"],
+            object_ids=arrays[f"{prefix}object_ids"],
+            strings=strings,
+            opening_vertices={
+                row: opening_vertices[opening_offsets[k]:opening_offsets[k + 1]]
+                for k, row in enumerate(arrays[f"{prefix}opening_rows"].tolist())
+            },
+            connected_to={
+                row: connected_to[connected_to_offsets[k]:connected_to_offsets[k + 1]]
+                for k, row in enumerate(arrays[f"{prefix}connected_to_rows"].tolist())
+            },
+        )
+
+    def _get_string(self, index: int) -> str:
+        if index == NO_STRING:
+            return None
+        return self.strings[index]
+
+
+class ElementTableBuilder:
+    """
+    Accumulates rows and builds an ElementTable. Strings are interned, so repeated names are stored once.
+    Columns are accumulated in typed arrays rather than lists of Python objects.
+    """
+    def __init__(self):
+        self.types = array("B")
+        self.coordinates = array("d")
+        self.names = array("i")
+        self.object_ids = array("i")
+        self.strings = []
+        self.string_indices = {}
+        self.opening_vertices = {}
+        self.connected_to = {}
+
+    def __len__(self):
+        return len(self.types)
+
+    def append(self, element_type: str, start_vertex, end_vertex, name: str = None, object_id: str = None, opening_vertices=None, connected_to=None):
+        i = len(self.types)
+        self.types.append(ELEMENT_TYPE_CODES[element_type])
+        self.coordinates.extend((start_vertex[0], start_vertex[1], end_vertex[0], end_vertex[1]))
+        self.names.append(self._intern(name))
+        self.object_ids.append(self._intern(object_id))
+        if opening_vertices:
+            self.opening_vertices[i] = opening_vertices
+        if connected_to:
+            self.connected_to[i] = connected_to
+
+    def append_row(self, table: ElementTable, i: int, element_type: str = None, start_vertex=None, end_vertex=None):
+        """
+        Copy row i of table, optionally replacing its type and vertices.
+        """
+        (x1, y1), (x2, y2) = table.vertices[i].tolist()
+        self.append(
+            element_type if element_type is not None else table.get_type(i),
+            start_vertex if start_vertex is not None else (x1, y1),
+            end_vertex if end_vertex is not None else (x2, y2),
+            name=table.get_name(i),
+            object_id=table.get_object_id(i),
+            opening_vertices=table.opening_vertices.get(i),
+            connected_to=table.connected_to.get(i),
+        )
+
+    def build(self) -> ElementTable:
+        return ElementTable(
+            types=np.array(self.types, dtype=np.uint8),
+            vertices=np.array(self.coordinates, dtype=np.float64).reshape(-1, 2, 2),
+            names=np.array(self.names, dtype=np.int32),
+            object_ids=np.array(self.object_ids, dtype=np.int32),
+            strings=self.strings,
+            opening_vertices=self.opening_vertices,
+            connected_to=self.connected_to,
+        )
+
+    def _intern(self, string: str) -> int:
+        if string is None:
+            return NO_STRING
+        if string not in self.string_indices:
+            self.string_indices[string] = len(self.strings)
+            self.strings.append(string)
+        return self.string_indices[string]
+
+
+def save_element_tables(path: str, tables: Dict[str, ElementTable], compress: bool = False):
+    """
+    Save named element tables, e.g. the elements of each storey, to a single .npz file.
+    Tables are stored uncompressed by default, so that loading them only reads the arrays.
+    """
+    arrays = {
+        "format_version": np.array(ELEMENT_TABLES_FORMAT_VERSION),
+        "table_names": np.array(list(tables.keys()), dtype=str),
+    }
+    for i, table in enumerate(tables.values()):
+        arrays.update(table.to_arrays(prefix=f"{i}/"))
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        if compress:
+            np.savez_compressed(f, **arrays)
+        else:
+            np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_element_tables(path: str) -> Dict[str, ElementTable]:
+    """
+    Load the element tables saved by save_element_tables, in the order they were saved.
+    """
+    with np.load(path, allow_pickle=False) as data:
+        arrays = {key: data[key] for key in data.files}
+    if int(arrays["format_version"]) != ELEMENT_TABLES_FORMAT_VERSION:
+        raise ValueError(f"Unsupported element tables format version {int(arrays['format_version'])} in {path}, expected {ELEMENT_TABLES_FORMAT_VERSION}")
+    return {name: ElementTable.from_arrays(arrays, prefix=f"{i}/") for i, name in enumerate(arrays["table_names"].tolist())}
@@ -0,0 +1,80 @@
+import math
+from typing import Tuple
+import numpy as np
+
+"""
+Fixed-point coordinate kernel.
+Coordinates are snapped onto a decimal grid (by default 4 decimal places, i.e. 0.1 mm when working in metres).
+A snapped coordinate is an integer number of grid steps, so intersections, equality and hashing can be computed
+with exact integer arithmetic instead of floating point.
+"""
+
+GRID_DIGITS = 4
+
+
+def to_fixed(number: float, digits: int = GRID_DIGITS) -> int:
+    """
+    Convert a number into an integer number of grid steps.
+    Numbers already on the grid are kept as-is, other numbers are rounded up to the next grid step.
+    """
+    scale = 10 ** digits
+    steps = round(number * scale)
+    if steps / scale == number:
+        return steps
+    return math.ceil(number * scale)
+
+
+def from_fixed(steps: int, digits: int = GRID_DIGITS) -> float:
+    return steps / 10 ** digits
+
+
+def is_on_grid(number: float, digits: int = GRID_DIGITS) -> bool:
+    scale = 10 ** digits
+    return round(number * scale) / scale == number
+
+
+def snap(number: float, digits: int = GRID_DIGITS) -> float:
+    if is_on_grid(number, digits):
+        return number
+    return from_fixed(to_fixed(number, digits), digits)
+
+
+def snap_array(numbers: np.ndarray, digits: int = GRID_DIGITS) -> np.ndarray:
+    """
+    Same as snap, for every number of an array.
+    """
+    scale = 10 ** digits
+    numbers = np.asarray(numbers, dtype=np.float64)
+    on_grid = np.round(numbers * scale) / scale == numbers
+    return np.where(on_grid, numbers, np.ceil(numbers * scale) / scale)
+
+
+def snap_vertex(vertex: Tuple[float, float], digits: int = GRID_DIGITS) -> Tuple[float, float]:
+    x, y = vertex
+    return snap(x, digits), snap(y, digits)
+
+
+def _ceil_div(numerator: int, denominator: int) -> int:
+    if denominator < 0:
+        numerator, denominator = -numerator, -denominator
+    return -((-numerator) // denominator)
+
+
+def fixed_lines_intersection(line1, line2):
+    """
+    Intersection of two unbounded lines given in grid steps, rounded up onto the grid.
+    The result is exact and does not depend on the order of the lines or of their vertices.
+    Returns None if the lines are parallel.
+    """
+    (x1, y1), (x2, y2) = line1
+    (x3, y3), (x4, y4) = line2
+
+    denominator = (x1 - x2) * (y3 - y4) - (y1 - y2) * (x3 - x4)
+    if denominator == 0:
+        return None
+
+    cross1 = x1 * y2 - y1 * x2
+    cross2 = x3 * y4 - y3 * x4
+    x = _ceil_div(cross1 * (x3 - x4) - (x1 - x2) * cross2, denominator)
+    y = _ceil_div(cross1 * (y3 - y4) - (y1 - y2) * cross2, denominator)
+    return x, y
@@ -2,4 +2,45 @@ import ifcopenshell.geom
 
 settings = ifcopenshell.geom.settings()
 settings.set(settings.USE_WORLD_COORDS, True)
-settings.set(settings.CONVERT_BACK_UNITS, False)
\ No newline at end of file
+settings.set(settings.CONVERT_BACK_UNITS, False)
+
+# Used for representations made of curves, such as wall and stair flight axes
+curve_settings = ifcopenshell.geom.settings()
+curve_settings.set(curve_settings.CONVERT_BACK_UNITS, False)
+curve_settings.set(curve_settings.USE_WORLD_COORDS, True)
+curve_settings.set(curve_settings.INCLUDE_CURVES, True)
+
+# Stable names for the settings above, used to key persisted geometry
+_settings_names = {
+    id(settings): "world-coords",
+    id(curve_settings): "world-coords-curves",
+}
+
+
+def get_settings_name(geom_settings) -> str:
+    return _settings_names.get(id(geom_settings))
+
+
+def get_settings_values(geom_settings) -> list:
+    """
+    Output: Array of (option, value) of geometry settings, unset options have the value None
+    """
+    if hasattr(geom_settings, "setting_names"):
+        options = [(name, name) for name in geom_settings.setting_names()]
+    else:
+        # IfcOpenShell 0.7 only exposes the options as integer constants of the settings class
+        options = sorted((name, getattr(geom_settings, name)) for name in dir(geom_settings) if name.isupper() and isinstance(getattr(geom_settings, name), int))
+    values = []
+    for name, option in options:
+        try:
+            values.append((name, repr(geom_settings.get(option))))
+        except Exception:
+            values.append((name, None))
+    return values
+
+
+def get_named_settings_values() -> list:
+    """
+    Output: Array of (settings name, settings values) of the settings used to key persisted geometry
+    """
+    return sorted((_settings_names[id(x)], get_settings_values(x)) for x in [settings, curve_settings])
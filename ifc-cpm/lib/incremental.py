@@ -0,0 +1,126 @@
+import os
+import hashlib
+from typing import Dict, List, Tuple
+import numpy as np
+import ifcopenshell
+from .element_table import ElementTable
+from .model_index import ModelIndex
+
+"""
+Incremental re-conversion of revised IFC models.
+The input of each storey is fingerprinted by the content of its walls, openings and doors. The preprocessed elements
+of each storey are saved along with their fingerprint, so that a later conversion of a revised model only processes
+the storeys whose fingerprint changed and reuses the saved elements of the others.
+"""
+
+# Bump whenever a change to the converter changes its output, so that saved states are not reused
+INCREMENTAL_STATE_VERSION = 5
+
+
+class EntityHasher:
+    """
+    Hashes an entity together with every entity it references, e.g. a wall with its placement and representation.
+    References are hashed by content rather than by their STEP id, so hashes are stable across revisions of a file.
+    Owner histories are ignored, as they change on every export.
+    """
+    def __init__(self):
+        self.hashes = {}
+
+    def hash_entity(self, entity) -> bytes:
+        if entity.id() in self.hashes:
+            return self.hashes[entity.id()]
+
+        digest = hashlib.sha256(entity.is_a().encode())
+        for i in range(len(entity)):
+            digest.update(b"|")
+            self._update(digest, entity[i])
+        self.hashes[entity.id()] = digest.digest()
+        return self.hashes[entity.id()]
+
+    def _update(self, digest, value):
+        if isinstance(value, ifcopenshell.entity_instance):
+            if value.id() == 0:
+                # Typed value of a select, e.g. IfcLabel('...')
+                digest.update(value.is_a().encode())
+                self._update(digest, value.wrappedValue)
+            elif value.is_a("IfcOwnerHistory"):
+                digest.update(b"$")
+            else:
+                digest.update(self.hash_entity(value))
+        elif isinstance(value, (tuple, list)):
+            digest.update(b"(")
+            for item in value:
+                self._update(digest, item)
+                digest.update(b",")
+            digest.update(b")")
+        else:
+            digest.update(repr(value).encode())
+
+
+def get_wall_fingerprint(hasher: EntityHasher, ifc_wall, model_index: ModelIndex) -> bytes:
+    """
+    Fingerprint of everything _get_storey_elements reads for a wall: the wall, its openings, its doors and its connections.
+    """
+    digest = hashlib.sha256(hasher.hash_entity(ifc_wall))
+    for opening in ifc_wall.HasOpenings:
+        digest.update(hasher.hash_entity(opening.RelatedOpeningElement))
+    for ifc_door in model_index.get_wall_doors(ifc_wall):
+        opening_container = model_index.get_door_opening_container(ifc_door)
+        digest.update(hasher.hash_entity(ifc_door))
+        digest.update(repr(opening_container.GlobalId if opening_container else None).encode())
+    for connection in ifc_wall.ConnectedTo:
+        digest.update(repr((connection.RelatedElement.GlobalId, connection.RelatingConnectionType)).encode())
+    return digest.digest()
+
+
+def get_storey_fingerprint(hasher: EntityHasher, model_index: ModelIndex, ifc_walls, elevation: float, parameters: Tuple) -> str:
+    """
+    Input:
+        model_index: index of the building of the walls
+        ifc_walls: walls of the storey, in conversion order
+        elevation: elevation of the storey
+        parameters: conversion parameters affecting the preprocessed elements
+    Output: Hexadecimal fingerprint of the storey
+    """
+    digest = hashlib.sha256(repr((INCREMENTAL_STATE_VERSION, ifcopenshell.version, elevation, parameters)).encode())
+    for ifc_wall in ifc_walls:
+        digest.update(get_wall_fingerprint(hasher, ifc_wall, model_index))
+    return digest.hexdigest()
+
+
+class IncrementalState:
+    """
+    Preprocessed elements and unparsable walls of each storey of a conversion, keyed by storey fingerprint.
+    Unparsable walls are stored as (GlobalId, error message).
+    """
+    def __init__(self):
+        self.storeys: Dict[str, Tuple[ElementTable, List[Tuple[str, str]]]] = {}
+
+    def get(self, fingerprint: str):
+        return self.storeys.get(fingerprint)
+
+    def put(self, fingerprint: str, elements: ElementTable, unparsable_walls: List[Tuple[str, str]]):
+        self.storeys[fingerprint] = (elements, unparsable_walls)
+
+    def save(self, path: str):
+        arrays = {"fingerprints": np.array(list(self.storeys.keys()), dtype=str)}
+        for i, (elements, unparsable_walls) in enumerate(self.storeys.values()):
+            arrays.update(elements.to_arrays(prefix=f"{i}/"))
+            arrays[f"{i}/unparsable_walls"] = np.array(unparsable_walls, dtype=str).reshape(-1, 2)
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: str) -> "IncrementalState":
+        state = IncrementalState()
+        with np.load(path, allow_pickle=False) as data:
+            arrays = {key: data[key] for key in data.files}
+        for i, fingerprint in enumerate(arrays["fingerprints"].tolist()):
+            elements = ElementTable.from_arrays(arrays, prefix=f"{i}/")
+            unparsable_walls = [(global_id, message) for global_id, message in arrays[f"{i}/unparsable_walls"].tolist()]
+            state.put(fingerprint, elements, unparsable_walls)
+        return state
@@ -0,0 +1,128 @@
+from typing import Dict, List
+from collections import defaultdict
+import ifcopenshell.util.element
+
+"""
+Index of the elements of a building, built in a single traversal of its spatial decomposition.
+Instead of walking ifcopenshell.util.element.get_decomposition again in every conversion stage, the direct children
+of every element are read once, and elements are bucketed by class, by containing storey and by host wall.
+Queries return the same elements as get_decomposition, ordered by STEP id so that conversions are reproducible.
+"""
+
+# (inverse attribute, related attribute) followed by get_decomposition
+DECOMPOSITION_RELATIONS = [
+    ("ContainsElements", "RelatedElements"),
+    ("IsDecomposedBy", "RelatedObjects"),
+    ("HasOpenings", "RelatedOpeningElement"),
+    ("HasFillings", "RelatedBuildingElement"),
+    ("IsNestedBy", "RelatedObjects"),
+]
+
+# Classes (including their subclasses) bucketed by the index
+INDEXED_CLASSES = [
+    "IfcBuildingStorey",
+    "IfcWall",
+    "IfcCurtainWall",
+    "IfcDoor",
+    "IfcOpeningElement",
+    "IfcStair",
+    "IfcStairFlight",
+    "IfcSlab",
+    "IfcTransportElement",
+]
+
+
+def _get_children(element) -> List:
+    children = []
+    for inverse_attribute, related_attribute in DECOMPOSITION_RELATIONS:
+        for rel in getattr(element, inverse_attribute, []):
+            related = getattr(rel, related_attribute)
+            if isinstance(related, tuple):
+                children += related
+            else:
+                children.append(related)
+    return children
+
+
+class ModelIndex:
+    def __init__(self, ifc_building):
+        self.ifc_building = ifc_building
+
+        # Direct children of every element of the decomposition
+        self.children = {}
+        queue = [ifc_building]
+        while len(queue) > 0:
+            element = queue.pop()
+            if element in self.children:
+                continue
+            self.children[element] = _get_children(element)
+            queue += self.children[element]
+
+        self.elements = self._sort(self.get_decomposition(ifc_building))
+        self.elements_by_class: Dict[str, List] = {ifc_class: [] for ifc_class in INDEXED_CLASSES}
+        for element in self.elements:
+            for ifc_class in INDEXED_CLASSES:
+                if element.is_a(ifc_class):
+                    self.elements_by_class[ifc_class].append(element)
+
+        self.storey_elements = {storey: self._sort(self.get_decomposition(storey)) for storey in self.elements_by_class["IfcBuildingStorey"]}
+
+        # Doors in the decomposition of each wall, and the reverse map of the walls hosting each door
+        self.wall_doors = {}
+        self.door_host_walls = defaultdict(list)
+        for ifc_wall in self.get_elements("IfcWall", "IfcCurtainWall"):
+            self.wall_doors[ifc_wall] = [x for x in self._sort(self.get_decomposition(ifc_wall)) if x.is_a("IfcDoor")]
+            for ifc_door in self.wall_doors[ifc_wall]:
+                self.door_host_walls[ifc_door].append(ifc_wall)
+        self.door_opening_containers = {
+            ifc_door: ifcopenshell.util.element.get_container(ifc_door, "IfcOpeningElement")
+            for ifc_door in self.elements_by_class["IfcDoor"]
+        }
+
+    def get_decomposition(self, element) -> set:
+        """
+        Same as ifcopenshell.util.element.get_decomposition, for elements of the indexed building.
+        """
+        if element not in self.children:
+            return ifcopenshell.util.element.get_decomposition(element)
+        queue = [element]
+        results = set()
+        while len(queue) > 0:
+            for child in self.children[queue.pop()]:
+                if child not in results:
+                    results.add(child)
+                    queue.append(child)
+        return results
+
+    def get_elements(self, *ifc_classes: str) -> List:
+        """
+        Elements of the building that are instances of any of the classes (or their subclasses), ordered by STEP id.
+        """
+        if all(ifc_class in self.elements_by_class for ifc_class in ifc_classes):
+            elements = set()
+            for ifc_class in ifc_classes:
+                elements.update(self.elements_by_class[ifc_class])
+            return self._sort(elements)
+        return [x for x in self.elements if any(x.is_a(ifc_class) for ifc_class in ifc_classes)]
+
+    def get_storey_elements(self, ifc_storey, *ifc_classes: str) -> List:
+        """
+        Elements in the decomposition of a storey, optionally only the instances of the given classes.
+        """
+        elements = self.storey_elements[ifc_storey]
+        if len(ifc_classes) == 0:
+            return elements
+        return [x for x in elements if any(x.is_a(ifc_class) for ifc_class in ifc_classes)]
+
+    def get_wall_doors(self, ifc_wall) -> List:
+        return self.wall_doors[ifc_wall]
+
+    def get_door_host_walls(self, ifc_door) -> List:
+        return self.door_host_walls.get(ifc_door, [])
+
+    def get_door_opening_container(self, ifc_door):
+        return self.door_opening_containers[ifc_door]
+
+    @staticmethod
+    def _sort(elements) -> List:
+        return sorted(elements, key=lambda x: x.id())
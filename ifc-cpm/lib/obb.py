@@ -0,0 +1,104 @@
+from typing import List
+import numpy as np
+
+"""
+Minimum-area oriented bounding boxes of point clouds in the XY plane.
+The box of a convex polygon has a side collinear with one of its edges, so the box is searched among the boxes aligned
+with each edge of the convex hull (rotating calipers). The boxes of all hull edges of all point clouds of a batch are
+computed at once with NumPy.
+"""
+
+# Boxes whose area is within this relative margin of the smallest area are considered equally small; the first of
+# them in hull order is returned, so that rectangular footprints get a stable box despite rounding errors
+AREA_RELATIVE_TOLERANCE = 1e-9
+
+# Maximum number of (hull edge, hull vertex) pairs projected at once, which bounds the memory used by a batch
+MAX_BATCH_PROJECTIONS = 4 * 1024 * 1024
+
+COLLINEAR_POINTS_ERROR = "Cannot compute the bounding box of points that are all collinear"
+
+
+def convex_hull_xy(points: np.ndarray) -> np.ndarray:
+    """
+    Input: (n, 2) array of points
+    Output: (h, 2) array of the convex hull vertices in counterclockwise order, starting from the lowest (x, y)
+    Collinear points on the hull edges are dropped.
+    """
+    points = np.unique(points, axis=0)
+    if len(points) <= 2:
+        return points
+
+    def build_chain(sorted_points):
+        chain = []
+        for x, y in sorted_points:
+            while len(chain) >= 2:
+                (x1, y1), (x2, y2) = chain[-2], chain[-1]
+                if (x2 - x1) * (y - y1) - (y2 - y1) * (x - x1) > 0:
+                    break
+                chain.pop()
+            chain.append((x, y))
+        return chain
+
+    sorted_points = points.tolist()
+    lower = build_chain(sorted_points)
+    upper = build_chain(reversed(sorted_points))
+    return np.array(lower[:-1] + upper[:-1], dtype=np.float64)
+
+
+def get_oriented_xy_bounding_boxes(point_clouds: List[np.ndarray], skip_collinear=False) -> List[np.ndarray]:
+    """
+    Input:
+        point_clouds: Array of (n, 2) or (n, 3) arrays of points; z is ignored
+        skip_collinear: return None for the point clouds whose points are all collinear, instead of raising ValueError
+    Output: Array of (4, 2) arrays of the corners of the minimum-area box of each point cloud, in order around the box.
+    The first two corners are on the hull edge the box is aligned with, in the direction of the edge.
+    """
+    hulls = []
+    for points in point_clouds:
+        hull = convex_hull_xy(np.asarray(points, dtype=np.float64).reshape(len(points), -1)[:, :2])
+        if len(hull) < 3 and not skip_collinear:
+            raise ValueError(COLLINEAR_POINTS_ERROR)
+        hulls.append(hull)
+
+    boxes = []
+    batch = []
+    for hull in [x for x in hulls if len(x) >= 3]:
+        if len(batch) > 0 and (sum(len(x) for x in batch) + len(hull)) * max(len(hull), max(len(x) for x in batch)) > MAX_BATCH_PROJECTIONS:
+            boxes += _get_hull_boxes(batch)
+            batch = []
+        batch.append(hull)
+    if len(batch) > 0:
+        boxes += _get_hull_boxes(batch)
+    boxes = iter(boxes)
+    return [next(boxes) if len(hull) >= 3 else None for hull in hulls]
+
+
+def _get_hull_boxes(hulls: List[np.ndarray]) -> List[np.ndarray]:
+    # Hulls are padded to the same size by repeating their first vertex, which does not change their extents
+    size = max(len(hull) for hull in hulls)
+    padded_hulls = np.stack([np.concatenate([hull, np.repeat(hull[:1], size - len(hull), axis=0)]) for hull in hulls])
+
+    # One row per hull edge: its start vertex, its unit direction, its normal pointing into the hull
+    owners = np.concatenate([np.full(len(hull), i) for i, hull in enumerate(hulls)])
+    starts = np.concatenate(hulls)
+    ends = np.concatenate([np.roll(hull, -1, axis=0) for hull in hulls])
+    directions = ends - starts
+    directions /= np.linalg.norm(directions, axis=1)[:, np.newaxis]
+    normals = np.stack([-directions[:, 1], directions[:, 0]], axis=1)
+
+    # Coordinates of the hull vertices along and across each edge
+    offsets = padded_hulls[owners] - starts[:, np.newaxis, :]
+    s = np.einsum("ehk,ek->eh", offsets, directions)
+    t = np.einsum("ehk,ek->eh", offsets, normals)
+    s_min, s_max, t_max = s.min(axis=1), s.max(axis=1), t.max(axis=1)
+    areas = (s_max - s_min) * t_max
+
+    boxes = []
+    edge_offsets = np.cumsum([0] + [len(hull) for hull in hulls])
+    for i in range(len(hulls)):
+        hull_areas = areas[edge_offsets[i]:edge_offsets[i + 1]]
+        e = edge_offsets[i] + int(np.argmax(hull_areas <= hull_areas.min() * (1 + AREA_RELATIVE_TOLERANCE)))
+        b0 = starts[e] + s_min[e] * directions[e]
+        b1 = starts[e] + s_max[e] * directions[e]
+        boxes.append(np.array([b0, b1, b1 + t_max[e] * normals[e], b0 + t_max[e] * normals[e]]))
+    return boxes
@@ -1,21 +1,56 @@
-import copy
+import numpy as np
 from typing import List, Tuple
-from collections import defaultdict
-from itertools import combinations
-from .ifctypes import BuildingElement, Barricade, Wall, Gate, WallWithOpening
-from .utils import find_lines_intersection, find_unbounded_lines_intersection, eucledian_distance, shortest_distance_between_two_lines, filter
-
-
-def glue_connected_elements(elements: List[BuildingElement], tolerance: float) -> List[BuildingElement]:
-    out_elements = copy.deepcopy(elements)
-
-    def intersections_within_tolerance(element1: BuildingElement, point: Tuple[float, float]):
+from .ifctypes import Wall, Gate, WallWithOpening
+from .element_table import ElementTable, ElementTableBuilder, Line, ELEMENT_TYPE_CODES
+from .utils import find_lines_intersection, find_unbounded_lines_intersection, eucledian_distance, shortest_distance_between_two_lines
+from .sweep_line import find_all_intersections, sort_points_along_line
+from .spatial_index import UniformGrid, get_line_bounding_box, inflate_bounding_box
+from .fixed_point import from_fixed
+from .logger import logger
+from .profiling import Profiler, NULL_PROFILER
+from .split_budget import SplitBudget, SplitBudgetTracker, SplitBudgetExceeded, UNLIMITED_SPLIT_BUDGET
+
+# Grid cells are never smaller than this, so that long walls do not span an excessive number of cells
+GLUE_MIN_CELL_SIZE = 1.0
+# Extra margin on spatial queries, to account for rounding onto the fixed-point grid
+GLUE_EPSILON = from_fixed(1)
+# Number of times the split stage of a storey is retried without the elements blamed for exceeding its budget,
+# before the rest of the storey is left out
+MAX_SPLIT_RETRIES = 3
+
+
+def glue_connected_elements(elements: ElementTable, tolerance: float) -> ElementTable:
+    # Only vertices are reassigned when glueing, so the other columns are shared with the input table
+    vertices = elements.vertices.copy()
+
+    def get_vertex(index: int, end: int) -> Tuple[float, float]:
+        x, y = vertices[index, end].tolist()
+        return x, y
+
+    def get_line(index: int) -> Line:
+        return get_vertex(index, 0), get_vertex(index, 1)
+
+    # Elements can only be glued when their gap is within tolerance, so only elements whose
+    # bounding boxes are within tolerance of each other need to be tested.
+    grid = UniformGrid(cell_size=max(tolerance, GLUE_MIN_CELL_SIZE))
+    bounding_boxes = np.concatenate([vertices.min(axis=1), vertices.max(axis=1)], axis=1)
+    for i, bbox in enumerate(bounding_boxes.tolist()):
+        grid.insert(i, tuple(bbox))
+
+    def nearby_elements(index: int):
+        bbox = get_line_bounding_box(get_line(index))
+        candidates = grid.query(inflate_bounding_box(bbox, tolerance + GLUE_EPSILON))
+        candidates.discard(index)
+        return candidates
+
+    def update_grid(index: int):
+        grid.update(index, get_line_bounding_box(get_line(index)))
+
+    def intersections_within_tolerance(index1: int, point: Tuple[float, float]):
         intersections = set()
-        for element2 in out_elements:
-            if element2 == element1:
-                continue
-            line1 = element1.start_vertex, element1.end_vertex
-            line2 = element2.start_vertex, element2.end_vertex
+        for index2 in nearby_elements(index1):
+            line1 = get_line(index1)
+            line2 = get_line(index2)
 
             # Ensure wall gap is small enough
             is_gap_small_enough = shortest_distance_between_two_lines(line1, line2) <= tolerance
@@ -28,9 +63,9 @@ def glue_connected_elements(elements: List[BuildingElement], tolerance: float) -
                     intersections.add(intersection)
         return list(intersections)
 
-    def glue_two_elements(element1: BuildingElement, element2: BuildingElement, tolerance: float):
-        line1 = element1.start_vertex, element1.end_vertex
-        line2 = element2.start_vertex, element2.end_vertex
+    def glue_two_elements(index1: int, index2: int, tolerance: float):
+        line1 = get_line(index1)
+        line2 = get_line(index2)
 
         # Glue walls when the gap between walls is less than tolerance.
         is_gap_small_enough = shortest_distance_between_two_lines(line1, line2) <= tolerance
@@ -41,74 +76,70 @@ def glue_connected_elements(elements: List[BuildingElement], tolerance: float) -
         if intersection is None:
             return
 
-        w1_v1_distance_to_intersection = eucledian_distance(element1.start_vertex, intersection)
-        w1_v2_distance_to_intersection = eucledian_distance(element1.end_vertex, intersection)
-        w2_v1_distance_to_intersection = eucledian_distance(element2.start_vertex, intersection)
-        w2_v2_distance_to_intersection = eucledian_distance(element2.end_vertex, intersection)
+        # Each vertex (0 for the start, 1 for the end) of both elements within tolerance of the intersection is attached to it
+        for index, end in [(index1, 0), (index1, 1), (index2, 0), (index2, 1)]:
+            vertex = get_vertex(index, end)
+            if eucledian_distance(vertex, intersection) > tolerance:
+                continue
 
-        if w1_v1_distance_to_intersection <= tolerance:
-            w1_v1_intersection_within_tolerance = len(intersections_within_tolerance(element1, element1.start_vertex))
-            if w1_v1_intersection_within_tolerance <= 1:
-                element1.start_vertex = intersection
+            if len(intersections_within_tolerance(index, vertex)) <= 1:
+                vertices[index, end] = intersection
             else:
-                distance_after_attachment = eucledian_distance(element1.end_vertex, intersection)
-                if distance_after_attachment > element1.length:
-                    element1.start_vertex = intersection
-
-        if w1_v2_distance_to_intersection <= tolerance:
-            w1_v2_intersection_within_tolerance = len(intersections_within_tolerance(element1, element1.end_vertex))
-            if w1_v2_intersection_within_tolerance <= 1:
-                element1.end_vertex = intersection
-            else:
-                distance_after_attachment = eucledian_distance(element1.start_vertex, intersection)
-                if distance_after_attachment > element1.length:
-                    element1.end_vertex = intersection
-
-        if w2_v1_distance_to_intersection <= tolerance:
-            w2_v1_intersection_within_tolerance = len(intersections_within_tolerance(element2, element2.start_vertex))
-            if w2_v1_intersection_within_tolerance <= 1:
-                element2.start_vertex = intersection
-            else:
-                distance_after_attachment = eucledian_distance(element2.end_vertex, intersection)
-                if distance_after_attachment > element2.length:
-                    element2.start_vertex = intersection
-
-        if w2_v2_distance_to_intersection <= tolerance:
-            w2_v2_intersection_within_tolerance = len(intersections_within_tolerance(element2, element2.end_vertex))
-            if w2_v2_intersection_within_tolerance <= 1:
-                element2.end_vertex = intersection
-            else:
-                distance_after_attachment = eucledian_distance(element2.start_vertex, intersection)
-                if distance_after_attachment > element2.length:
-                    element2.end_vertex = intersection
-
-    for element1, element2 in combinations(out_elements, 2):
-        glue_two_elements(element1, element2, tolerance=tolerance)
-
-    return out_elements
-
-
-def close_wall_gaps(elements: List[BuildingElement], tolerance):
+                other_vertex = get_vertex(index, 1 - end)
+                length = eucledian_distance(vertex, other_vertex)
+                distance_after_attachment = eucledian_distance(other_vertex, intersection)
+                if distance_after_attachment > length:
+                    vertices[index, end] = intersection
+            update_grid(index)
+
+    # Pairs are visited in the same order as combinations(out_elements, 2), skipping pairs that are too far apart.
+    # Candidates are looked up again whenever the first element of the pair has moved.
+    for index1 in range(len(elements)):
+        line1 = get_line(index1)
+        candidates = sorted(x for x in nearby_elements(index1) if x > index1)
+        while len(candidates) > 0:
+            index2 = candidates.pop(0)
+            glue_two_elements(index1, index2, tolerance=tolerance)
+            if get_line(index1) != line1:
+                line1 = get_line(index1)
+                candidates = sorted(x for x in nearby_elements(index1) if x > index2)
+
+    return elements.with_vertices(vertices)
+
+
+def close_wall_gaps(elements: ElementTable, tolerance) -> ElementTable:
     # Should only close disconnected vertices (i.e., nearby vertex connected to another vertex does not count)
-    vertices_count = defaultdict(lambda: 0)
-    for el in elements:
-        vertices_count[el.start_vertex] += 1
-        vertices_count[el.end_vertex] += 1
+    degrees = elements.get_vertex_degrees()
 
-    out_elements = copy.deepcopy(elements)
+    connectors = ElementTableBuilder()
     out_edges = set()
-    eligible_elements = filter(out_elements, lambda x: x.length > 0)
-    for element1, element2 in combinations(eligible_elements, 2):
-        line1 = element1.start_vertex, element1.end_vertex
-        line2 = element2.start_vertex, element2.end_vertex
+    eligible_elements = (elements.get_lengths() > 0).nonzero()[0]
+
+    # Only dangling vertices can be connected, so only those are indexed.
+    dangling_vertices = UniformGrid(cell_size=max(tolerance, GLUE_MIN_CELL_SIZE))
+    for i, j in zip(*(degrees[eligible_elements] <= 1).nonzero()):
+        x, y = elements.vertices[eligible_elements[i], j].tolist()
+        dangling_vertices.insert((int(i), int(j)), (x, y, x, y))
+
+    # Pairs of elements with dangling vertices within tolerance of each other, in the same order as combinations(eligible_elements, 2)
+    candidate_pairs = set()
+    for (i, j), (x, y, _, _) in list(dangling_vertices.bounding_boxes.items()):
+        for (other_i, _) in dangling_vertices.query_radius((x, y), tolerance + GLUE_EPSILON):
+            if other_i != i:
+                candidate_pairs.add((min(i, other_i), max(i, other_i)))
+
+    for i1, i2 in sorted(candidate_pairs):
+        element1, element2 = int(eligible_elements[i1]), int(eligible_elements[i2])
+        line1 = elements.get_line(element1)
+        line2 = elements.get_line(element2)
 
         candidate_edges = []
-        for w1_vertex in line1:
-            for w2_vertex in line2:
+        for j1, w1_vertex in enumerate(line1):
+            for j2, w2_vertex in enumerate(line2):
                 if w1_vertex != w2_vertex:
                     # Ensure both vertices are disconnected, otherwise it will invalidate existing connections.
-                    w1_vertex_disconnected = vertices_count[w1_vertex] <= 1
-                    w2_vertex_disconnected = vertices_count[w2_vertex] <= 1
+                    w1_vertex_disconnected = degrees[element1, j1] <= 1
+                    w2_vertex_disconnected = degrees[element2, j2] <= 1
                     if w1_vertex_disconnected and w2_vertex_disconnected:
                         distance = eucledian_distance(w1_vertex, w2_vertex)
                         if distance <= tolerance:
@@ -119,115 +150,305 @@ def close_wall_gaps(elements: List[BuildingElement], tolerance):
             # Ensure connector does not exist
             if (edge_v1, edge_v2) not in out_edges and (edge_v2, edge_v1) not in out_edges:
                 out_edges.add((edge_v1, edge_v2))
-                connector_wall = Wall(name=f"Connector-[{element1.name}]-[{element2.name}]", start_vertex=edge_v1, end_vertex=edge_v2)
-                out_elements.append(connector_wall)
-
-    return out_elements
-
-
-def convert_disconnected_walls_into_barricades(elements: List[BuildingElement]):
-    vertices_count = defaultdict(lambda: 0)
-    for el in elements:
-        vertices_count[el.start_vertex] += 1
-        vertices_count[el.end_vertex] += 1
-
-    output_elements = copy.copy(elements)
-    walls = [x for x in output_elements if x.__type__ == "Wall"]
-    for wall in walls:
-        if (
-            vertices_count[wall.start_vertex] < 2
-            or vertices_count[wall.end_vertex] < 2
-        ):
-            barricade = Barricade(
-                object_id=wall.object_id,
-                name=wall.name,
-                start_vertex=wall.start_vertex,
-                end_vertex=wall.end_vertex,
-            )
-            output_elements.remove(wall)
-            output_elements.append(barricade)
-
-    return output_elements
-
-
-def split_intersecting_elements(elements: List[BuildingElement]) -> List[BuildingElement]:
+                name = f"Connector-[{elements.get_name(element1)}]-[{elements.get_name(element2)}]"
+                connectors.append("Wall", edge_v1, edge_v2, name=name)
+
+    # Connectors are added after the elements, which are kept as they are
+    return ElementTable.concatenate([elements, connectors.build()])
+
+
+def convert_disconnected_walls_into_barricades(elements: ElementTable) -> ElementTable:
+    degrees = elements.get_vertex_degrees()
+    is_disconnected_wall = (elements.types == ELEMENT_TYPE_CODES["Wall"]) & (degrees.min(axis=1, initial=2) < 2)
+
+    # Barricades replace their walls at the end of the table
+    barricades = elements.select(is_disconnected_wall.nonzero()[0], side_tables=False)
+    barricades.types[:] = ELEMENT_TYPE_CODES["Barricade"]
+    return ElementTable.concatenate([elements.select((~is_disconnected_wall).nonzero()[0]), barricades])
+
+
+def split_intersecting_elements(elements: ElementTable, profiler: Profiler = NULL_PROFILER, budget_tracker: SplitBudgetTracker = None) -> ElementTable:
     """
     Split intersecting elements to get new vertices.
-    Input: Array of BuildingElement
-    Output: Array of BuildingElement
+    An element ending on the interior of a queued element splits that element rather than itself. Every split strictly
+    shortens an element, so a part is never produced twice from the same element; if it is anyway, or if the budget
+    is exceeded, SplitBudgetExceeded is raised with the elements whose parts were being split again.
+    Input: ElementTable
+    Output: ElementTable
     """
-    elements_queue = copy.copy(elements)
-    output_elements = []
+    budget_tracker = budget_tracker or UNLIMITED_SPLIT_BUDGET.start()
+    # Queue of (row, original row, type, name, line); row is None for the parts of split elements
+    elements_queue = [(i, i, elements.get_type(i), elements.get_name(i), line) for i, line in enumerate(elements.get_lines())]
+    output_elements = ElementTableBuilder()
+    # (original row, line) of the parts produced so far
+    produced_parts = set()
+    # Original row to the number of times its parts were split
+    split_counts = {}
+
+    def budget_exceeded() -> SplitBudgetExceeded:
+        profiler.count("split-iterations", split_iterations)
+        offenders = [elements.get_object_id(origin) for origin, count in split_counts.items() if count >= 2]
+        return SplitBudgetExceeded(f"Splitting intersecting elements exceeded its budget after {budget_tracker.iterations} iterations", list(dict.fromkeys(offenders)))
+
+    def split_parts(origin: int, name: str, line: Line, point) -> List[Tuple[str, Line]]:
+        nonlocal split_iterations
+        split_iterations += 1
+        split_counts[origin] = split_counts.get(origin, 0) + 1
+        if budget_tracker.step():
+            raise budget_exceeded()
+        parts = _split_line_at_point(point, name, line)
+        for split_name, split_line in parts:
+            if (origin, split_line) in produced_parts or split_line == line:
+                raise SplitBudgetExceeded(f"Element {name} is split again into {split_line}", [elements.get_object_id(origin)])
+            produced_parts.add((origin, split_line))
+        return parts
+
+    split_iterations = 0
     while len(elements_queue) > 0:
+        if budget_tracker.is_past_deadline():
+            raise budget_exceeded()
+
         element = elements_queue.pop(0)
-        intersection = _find_first_intersection(element, elements_queue)
+        row, origin, element_type, name, line = element
+        while True:
+            index, intersection = _find_first_intersection(line, [other_line for _, _, _, _, other_line in elements_queue], profiler)
+            if intersection is None or (intersection != line[0] and intersection != line[1]):
+                break
+            # The element ends on a queued element (T junction), which is split in place instead
+            _, other_origin, other_type, other_name, other_line = elements_queue[index]
+            elements_queue[index:index + 1] = [
+                (None, other_origin, other_type, split_name, split_line)
+                for split_name, split_line in split_parts(other_origin, other_name, other_line, intersection)
+            ]
+
         if intersection is None:
-            output_elements.append(element)
+            if row is not None:
+                output_elements.append_row(elements, row)
+            else:
+                output_elements.append(element_type, line[0], line[1], name=name, object_id=elements.get_object_id(origin))
         else:
-            split_elements = _split_element_at_point(intersection, element)
-            elements_queue += split_elements
+            elements_queue += [(None, origin, element_type, split_name, split_line) for split_name, split_line in split_parts(origin, name, line, intersection)]
 
-    return output_elements
+    profiler.count("split-iterations", split_iterations)
+    return output_elements.build()
+
+
+def split_intersecting_elements_sweep_line(elements: ElementTable, profiler: Profiler = NULL_PROFILER, budget_tracker: SplitBudgetTracker = None) -> ElementTable:
+    """
+    Split intersecting elements to get new vertices, finding all intersections in a single sweep.
+    Split elements are named the same way as split_intersecting_elements, i.e. splitting at the points
+    closest to the start vertex first: name-1, name-2-1, name-2-2, ...
+    SplitBudgetExceeded is raised with the elements cut at two points or more when the budget is exceeded.
+    Input: ElementTable
+    Output: ElementTable
+    """
+    budget_tracker = budget_tracker or UNLIMITED_SPLIT_BUDGET.start()
+    lines = elements.get_lines()
+    try:
+        intersections = find_all_intersections(lines, profiler, budget_tracker)
+    except SplitBudgetExceeded as e:
+        raise SplitBudgetExceeded(str(e), list(dict.fromkeys(elements.get_object_id(i) for i in e.offenders)))
+
+    output_elements = ElementTableBuilder()
+    split_iterations = 0
+    for i, line in enumerate(lines):
+        # Intersections at the element's own vertices (T junctions) do not split it
+        points = [p for p in intersections[i] if p != line[0] and p != line[1]]
+        points = sort_points_along_line(line, points)
+        if len(points) == 0:
+            output_elements.append_row(elements, i)
+            continue
+
+        if budget_tracker.is_past_deadline():
+            profiler.count("split-iterations", split_iterations)
+            offenders = [elements.get_object_id(j) for j in range(i, len(lines)) if len(set(intersections[j]) - set(lines[j])) >= 2]
+            raise SplitBudgetExceeded(f"Splitting intersecting elements exceeded its budget after {budget_tracker.iterations} iterations", list(dict.fromkeys(offenders)))
+
+        element_type = elements.get_type(i)
+        object_id = elements.get_object_id(i)
+        remainder = elements.get_name(i), line
+        for point in points:
+            split_iterations += 1
+            split_elements = _split_line_at_point(point, *remainder)
+            if len(split_elements) == 2:
+                split_name, (start_vertex, end_vertex) = split_elements[0]
+                output_elements.append(element_type, start_vertex, end_vertex, name=split_name, object_id=object_id)
+            remainder = split_elements[-1]
+        split_name, (start_vertex, end_vertex) = remainder
+        output_elements.append(element_type, start_vertex, end_vertex, name=split_name, object_id=object_id)
+
+    profiler.count("split-iterations", split_iterations)
+    return output_elements.build()
+
+
+SPLIT_METHODS = {
+    "iterative": split_intersecting_elements,
+    "sweep-line": split_intersecting_elements_sweep_line,
+}
 
 
 def decompose_wall_with_opening(wall: WallWithOpening):
-    out_elements = []
-    edges = set()
-    vertices = [wall.start_vertex, wall.end_vertex]
+    """
+    Split a wall into gates at its openings and walls between them.
+    Input: WallWithOpening
+    Output: Array of the gates, in the order of the openings, followed by the walls, from the start vertex to the end vertex
+    """
+    parts = _decompose_wall(wall.name, wall.start_vertex, wall.end_vertex, wall.opening_vertices)
+    return [(Gate if element_type == "Gate" else Wall)(name=name, start_vertex=start_vertex, end_vertex=end_vertex) for element_type, name, start_vertex, end_vertex in parts]
 
-    def opening_within_wall_bounds(v1, v2):
-        min_x = min(wall.start_vertex[0], wall.end_vertex[0])
-        max_x = max(wall.start_vertex[0], wall.end_vertex[0])
-        min_y = min(wall.start_vertex[1], wall.end_vertex[1])
-        max_y = max(wall.start_vertex[1], wall.end_vertex[1])
-
-        (x1, y1), (x2, y2) = v1, v2
-        return (min_x <= x1 <= max_x and min_x <= x2 <= max_x) and (min_y <= y1 <= max_y and min_y <= y2 <= max_y)
-
-    for i, (opening_v1, opening_v2) in enumerate(wall.opening_vertices):
-        if opening_within_wall_bounds(opening_v1, opening_v2):
-            gate = Gate(name=f"{wall.name}:gate-{i}", start_vertex=opening_v1, end_vertex=opening_v2)
-            if gate.length > 0:
-                out_elements.append(gate)
-                edges.add((opening_v1, opening_v2))
-                edges.add((opening_v2, opening_v1))
-                vertices += [opening_v1, opening_v2]
-
-    vertex = vertices[0]
-    while True:
-        nearest_vertex = min(vertices, key=lambda v: eucledian_distance(vertex, v))
-        if vertex != nearest_vertex:
-            if (vertex, nearest_vertex) not in edges:
-                connector = Wall(name=wall.name, start_vertex=vertex, end_vertex=nearest_vertex)
-                if connector.length > 0:
-                    out_elements.append(connector)
 
-        vertex = nearest_vertex
-        vertices.remove(vertex)
+def decompose_wall_with_openings(elements: ElementTable) -> ElementTable:
+    """
+    Replace every WallWithOpening of the table by its gates and walls, in place.
+    """
+    wall_rows = (elements.types == ELEMENT_TYPE_CODES["WallWithOpening"]).nonzero()[0].tolist()
+    parts = ElementTableBuilder()
+    part_rows = []
+    for i in wall_rows:
+        start_vertex, end_vertex = elements.get_line(i)
+        for element_type, name, part_start, part_end in _decompose_wall(elements.get_name(i), start_vertex, end_vertex, elements.opening_vertices.get(i, [])):
+            parts.append(element_type, part_start, part_end, name=name, object_id=elements.get_object_id(i))
+            part_rows.append(i)
+
+    # Parts take the place of their wall, in order
+    other_rows = (elements.types != ELEMENT_TYPE_CODES["WallWithOpening"]).nonzero()[0]
+    table = ElementTable.concatenate([elements.select(other_rows), parts.build()])
+    positions = np.concatenate([other_rows, np.array(part_rows, dtype=np.int64)])
+    return table.select(np.argsort(positions, kind="stable"))
+
+
+def preprocess_storey_elements(elements: ElementTable, tolerance: float, split_method: str = "sweep-line", profiler: Profiler = NULL_PROFILER, split_budget: SplitBudget = UNLIMITED_SPLIT_BUDGET) -> ElementTable:
+    """
+    Turn the parsed walls of a storey into connected walls, gates and barricades.
+    Raises SplitBudgetExceeded when splitting intersections exceeds split_budget.
+    Input: ElementTable
+    Output: ElementTable
+    """
+    elements = _prepare_storey_elements(elements, tolerance, profiler)
+
+    logger.debug("Splitting intersections...")
+    with profiler.stage("split"):
+        elements = SPLIT_METHODS[split_method](elements, profiler=profiler, budget_tracker=split_budget.start())
+
+    return _finish_storey_elements(elements, tolerance, profiler)
+
 
-        if len(vertices) == 0:
+def preprocess_storey_elements_within_budget(elements: ElementTable, tolerance: float, split_method: str = "sweep-line", profiler: Profiler = NULL_PROFILER, split_budget: SplitBudget = UNLIMITED_SPLIT_BUDGET) -> Tuple[ElementTable, List[Tuple[str, str]]]:
+    """
+    Same as preprocess_storey_elements, but the elements blamed for exceeding the split budget are left out and the
+    intersections are split again without them. The retries share the budget of the storey, and after MAX_SPLIT_RETRIES
+    retries, or when no element is to blame, the rest of the storey is left out.
+    Output: (ElementTable, Array of (object id, error message) of the elements left out)
+    """
+    budget_tracker = split_budget.start()
+    elements = _prepare_storey_elements(elements, tolerance, profiler)
+
+    left_out = []
+    retries = 0
+    while True:
+        try:
+            logger.debug("Splitting intersections...")
+            with profiler.stage("split"):
+                elements = SPLIT_METHODS[split_method](elements, profiler=profiler, budget_tracker=budget_tracker)
             break
+        except SplitBudgetExceeded as e:
+            profiler.count("split-budget-exceeded")
+            offenders = e.offenders
+            if retries == MAX_SPLIT_RETRIES or len(offenders) == 0:
+                offenders = list(dict.fromkeys(elements.get_object_id(i) for i in range(len(elements))))
+            retries += 1
+            logger.warning(f"Leaving out {len(offenders)} elements: {e}")
+            left_out += [(object_id, str(e)) for object_id in offenders if object_id is not None]
+            offenders = set(offenders)
+            elements = elements.select([i for i in range(len(elements)) if elements.get_object_id(i) not in offenders])
+
+    return _finish_storey_elements(elements, tolerance, profiler), left_out
+
+
+def _prepare_storey_elements(elements: ElementTable, tolerance: float, profiler: Profiler) -> ElementTable:
+    """
+    Glue the connected elements and decompose the walls with openings, the stages before splitting intersections.
+    """
+    if tolerance > 0:
+        logger.debug("Glueing wall connections...")
+        with profiler.stage("glue"):
+            elements = glue_connected_elements(elements=elements, tolerance=tolerance)
+
+    logger.debug("Decomposing wall openings...")
+    with profiler.stage("decompose"):
+        return decompose_wall_with_openings(elements)
+
 
-    return out_elements
+def _finish_storey_elements(elements: ElementTable, tolerance: float, profiler: Profiler) -> ElementTable:
+    """
+    Close the wall gaps and convert the disconnected walls into barricades, the stages after splitting intersections.
+    """
+    if tolerance > 0:
+        logger.debug("Closing wall gaps...")
+        with profiler.stage("close-gaps"):
+            elements = close_wall_gaps(elements, tolerance=tolerance)
 
+    with profiler.stage("barricades"):
+        return convert_disconnected_walls_into_barricades(elements)
+
+
+def _decompose_wall(name: str, start_vertex, end_vertex, opening_vertices) -> List[Tuple[str, str, Tuple[float, float], Tuple[float, float]]]:
+    """
+    Opening endpoints are ordered by their projection on the wall axis, so the wall is walked once from its start
+    vertex to its end vertex. Overlapping openings are merged into a single gate, named after the first of them.
+    Output: Array of (type, name, start vertex, end vertex) of the gates, in the order of the openings, followed by
+        the walls, from the start vertex to the end vertex
+    """
+    (x1, y1), (x2, y2) = start_vertex, end_vertex
+    dx, dy = x2 - x1, y2 - y1
 
-def decompose_wall_with_openings(elements: List[BuildingElement]) -> List[BuildingElement]:
-    out_elements = []
-    for element in elements:
-        if element.__type__ == 'WallWithOpening':
-            out_elements += decompose_wall_with_opening(element)
+    def project(vertex):
+        return (vertex[0] - x1) * dx + (vertex[1] - y1) * dy
+
+    def opening_within_wall_bounds(v1, v2):
+        min_x, max_x = min(x1, x2), max(x1, x2)
+        min_y, max_y = min(y1, y2), max(y1, y2)
+
+        (ox1, oy1), (ox2, oy2) = v1, v2
+        return (min_x <= ox1 <= max_x and min_x <= ox2 <= max_x) and (min_y <= oy1 <= max_y and min_y <= oy2 <= max_y)
+
+    # Openings as [first opening index, (start t, start vertex), (end t, end vertex), vertices of the gate]
+    openings = []
+    for i, (opening_v1, opening_v2) in enumerate(opening_vertices):
+        if opening_within_wall_bounds(opening_v1, opening_v2) and eucledian_distance(opening_v1, opening_v2) > 0:
+            start, end = sorted([(project(opening_v1), opening_v1), (project(opening_v2), opening_v2)])
+            openings.append([i, start, end, (opening_v1, opening_v2)])
+    openings.sort(key=lambda opening: opening[1])
+
+    # Merge openings overlapping the previous one; openings that only touch are kept apart
+    gates = []
+    for opening in openings:
+        if len(gates) > 0 and opening[1][0] < gates[-1][2][0]:
+            gate = gates[-1]
+            gate[0] = min(gate[0], opening[0])
+            gate[2] = max(gate[2], opening[2])
+            gate[3] = (gate[1][1], gate[2][1])
         else:
-            out_elements.append(element)
+            gates.append(opening)
 
-    return out_elements
+    parts = [("Gate", f"{name}:gate-{i}", v1, v2) for i, _, _, (v1, v2) in sorted(gates)]
 
+    vertex = start_vertex
+    for _, (_, gate_start), (_, gate_end), _ in gates:
+        if eucledian_distance(vertex, gate_start) > 0:
+            parts.append(("Wall", name, vertex, gate_start))
+        vertex = gate_end
+    if eucledian_distance(vertex, end_vertex) > 0:
+        parts.append(("Wall", name, vertex, end_vertex))
 
-def _find_first_intersection(target_element: BuildingElement, other_elements: List[BuildingElement]) -> Tuple[float, float]:
-    for other_element in other_elements:
-        if target_element == other_element:
-            continue
-        target_line = target_element.start_vertex, target_element.end_vertex
-        other_line = other_element.start_vertex, other_element.end_vertex
+    return parts
+
+
+def _find_first_intersection(target_line: Line, other_lines: List[Line], profiler: Profiler = NULL_PROFILER) -> Tuple[int, Tuple[float, float]]:
+    """
+    Output: (index of the other line, intersection) of the first T or + intersection, or (None, None)
+    """
+    for i, other_line in enumerate(other_lines):
         intersection = find_lines_intersection(target_line, other_line)
         if intersection is not None:
             wall_vertices = [
@@ -238,39 +459,32 @@ def _find_first_intersection(target_element: BuildingElement, other_elements: Li
             ]
             # Only add intersections that are T or +
             if wall_vertices.count(intersection) <= 1:
-                return intersection
-    return None
+                profiler.count("intersection-tests", i + 1)
+                return i, intersection
+    profiler.count("intersection-tests", len(other_lines))
+    return None, None
 
 
-def _split_element_at_point(point, element: BuildingElement):
+def _split_line_at_point(point, name: str, line: Line) -> List[Tuple[str, Line]]:
     """
     Input:
         point (x, y)
-        element: BuildingElement
+        name: name of the element
+        line: ((x1, y1), (x2, y2))
         (x, y) must fall within the line.
+    Output: Array of (name, line) of the parts with a non-zero length
     """
     x, y = point
-    (x1, y1), (x2, y2) = element.start_vertex, element.end_vertex
-
-    element1 = BuildingElement(
-        type=element.__type__,
-        name=f"{element.name}-1",
-        start_vertex=(x1, y1),
-        end_vertex=(x, y),
-    )
-
-    element2 = BuildingElement(
-        type=element.__type__,
-        name=f"{element.name}-2",
-        start_vertex=(x, y),
-        end_vertex=(x2, y2),
-    )
+    (x1, y1), (x2, y2) = line
+
+    line1 = (x1, y1), (x, y)
+    line2 = (x, y), (x2, y2)
 
     out = []
-    if element1.length > 0:
-        out.append(element1)
+    if eucledian_distance(*line1) > 0:
+        out.append((f"{name}-1", line1))
 
-    if element2.length > 0:
-        out.append(element2)
+    if eucledian_distance(*line2) > 0:
+        out.append((f"{name}-2", line2))
 
     return out
@@ -0,0 +1,135 @@
+import time
+import heapq
+import itertools
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict
+
+"""
+Timing and counters of the conversion.
+Stages are timed with the profiler.stage(name) context manager; the time of a stage entered several times
+(e.g. once per storey) is accumulated. Each storey can be profiled by its own child profiler, whose stage times
+and counters are also accumulated into its parent. The slowest individual products are kept as well.
+A disabled profiler records nothing, so that profiling has close to no overhead when it is not requested.
+"""
+
+# Number of slowest products kept by a profiler
+DEFAULT_SLOWEST_PRODUCTS = 10
+
+
+class Profiler:
+    def __init__(self, enabled=True, slowest_products=DEFAULT_SLOWEST_PRODUCTS, parent: "Profiler" = None):
+        self.enabled = enabled
+        self.parent = parent
+        self.stage_times = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.storeys: Dict[str, Profiler] = {}
+        # Min-heap of (seconds, tie breaker, product record), holding the slowest products measured so far
+        self.slowest_products = slowest_products
+        self.product_times = []
+        self._product_counter = itertools.count()
+
+    @contextmanager
+    def stage(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage_times({name: time.perf_counter() - start})
+
+    @contextmanager
+    def product(self, stage: str, ifc_product):
+        """
+        Time the processing of a single IfcProduct, e.g. the inference of a wall or the tessellation of an opening.
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_product_time(stage, ifc_product, time.perf_counter() - start)
+
+    def count(self, name: str, n: int = 1):
+        if self.enabled:
+            self.add_counters({name: n})
+
+    def get_storey_profiler(self, name: str) -> "Profiler":
+        """
+        Profiler of a single storey, accumulating into this profiler as well.
+        """
+        if not self.enabled:
+            return self
+        if name not in self.storeys:
+            self.storeys[name] = Profiler(slowest_products=self.slowest_products, parent=self)
+        return self.storeys[name]
+
+    def add_stage_times(self, stage_times: Dict[str, float]):
+        """
+        Accumulate stage times measured elsewhere, e.g. in a worker process.
+        """
+        if not self.enabled:
+            return
+        profiler = self
+        while profiler is not None:
+            for name, duration in stage_times.items():
+                profiler.stage_times[name] += duration
+            profiler = profiler.parent
+
+    def add_counters(self, counters: Dict[str, int]):
+        if not self.enabled:
+            return
+        profiler = self
+        while profiler is not None:
+            for name, n in counters.items():
+                profiler.counters[name] += n
+            profiler = profiler.parent
+
+    def add_product_time(self, stage: str, ifc_product, duration: float):
+        if not self.enabled:
+            return
+        record = {
+            "stage": stage,
+            "id": getattr(ifc_product, "GlobalId", None) or f"#{ifc_product.id()}",
+            "type": ifc_product.is_a(),
+            "name": getattr(ifc_product, "Name", None),
+            "seconds": duration,
+        }
+        profiler = self
+        while profiler is not None:
+            item = (duration, next(profiler._product_counter), record)
+            if len(profiler.product_times) < profiler.slowest_products:
+                heapq.heappush(profiler.product_times, item)
+            elif duration > profiler.product_times[0][0]:
+                heapq.heapreplace(profiler.product_times, item)
+            profiler = profiler.parent
+
+    def get_stage_times(self) -> Dict[str, float]:
+        return dict(self.stage_times)
+
+    def get_counters(self) -> Dict[str, int]:
+        return dict(self.counters)
+
+    def get_slowest_products(self):
+        return [record for _, _, record in sorted(self.product_times, key=lambda item: -item[0])]
+
+    def get_profile(self) -> dict:
+        """
+        Output: JSON serializable dict of the stage times, counters and slowest products, in total and per storey
+        """
+        profile = {
+            "stages": self.get_stage_times(),
+            "counters": self.get_counters(),
+            "slowest_products": self.get_slowest_products(),
+        }
+        if self.parent is None:
+            profile["storeys"] = {name: storey.get_profile() for name, storey in self.storeys.items()}
+        return profile
+
+
+# Shared profiler that does not record anything
+NULL_PROFILER = Profiler(enabled=False)
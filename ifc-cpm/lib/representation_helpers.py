@@ -1,25 +1,51 @@
-from functools import cache
 import ifcopenshell.util.placement
-from .utils import get_composite_verts, get_edge_from_bounding_box, get_oriented_xy_bounding_box
+from .utils import get_composite_verts, get_edge_from_bounding_box, get_oriented_xy_bounding_box, get_oriented_xy_bounding_box_batch
+from .obb import COLLINEAR_POINTS_ERROR
 from .geom_settings import settings
+from .shape_cache import get_shape_vertices
 
 
 class WallVertices:
     @staticmethod
-    @cache
-    def from_product(ifc_product):
-        try:
-            if ifc_product.Representation is not None:
-                vertices = WallVertices.infer(ifc_product.Representation.Representations)
-                return vertices
-        except:
-            pass
+    def from_product(ifc_product, shape_cache=None):
+        vertices = WallVertices.from_products([ifc_product], shape_cache)[0]
+        if isinstance(vertices, Exception):
+            raise vertices
+        return vertices
+
+    @staticmethod
+    def from_products(ifc_products, shape_cache=None) -> list:
+        """
+        Same as from_product for several products; the boxes of the point clouds of the products without an axis are
+        computed in one batch.
+        Output: Array of the vertices of each product, or of the exception raised while inferring them
+        """
+        out = [None] * len(ifc_products)
+        point_clouds = {}
+        for i, ifc_product in enumerate(ifc_products):
+            try:
+                if ifc_product.Representation is not None:
+                    out[i] = WallVertices.infer(ifc_product.Representation.Representations, shape_cache)
+                    continue
+            except:
+                pass
 
-        return WallVertices.from_point_cloud(ifc_product)
+            try:
+                vertices = get_composite_verts(ifc_product, shape_cache)
+            except Exception as e:
+                out[i] = e
+                continue
+            if len(vertices) > 0:
+                point_clouds[i] = vertices
+
+        bboxes = get_oriented_xy_bounding_box_batch(point_clouds.values())
+        for i, bbox in zip(point_clouds.keys(), bboxes):
+            out[i] = ValueError(COLLINEAR_POINTS_ERROR) if bbox is None else get_edge_from_bounding_box(bbox)
+        return out
 
     @staticmethod
-    def from_point_cloud(ifc_product):
-        vertices = get_composite_verts(ifc_product)
+    def from_point_cloud(ifc_product, shape_cache=None):
+        vertices = get_composite_verts(ifc_product, shape_cache)
 
         if len(vertices) > 0:
             bbox = get_oriented_xy_bounding_box(vertices)
@@ -27,14 +53,13 @@ class WallVertices:
             return edge
 
     @staticmethod
-    def infer(representations):
+    def infer(representations, shape_cache=None):
         for repr in representations:
             if repr.RepresentationIdentifier == "Axis":
                 if WallVertices.is_wall_axis_curved(repr):
                     raise NotImplementedError("Curved walls are not yet supported")
 
-                shape = ifcopenshell.geom.create_shape(settings, repr)
-                vertices = ifcopenshell.util.shape.get_vertices(shape)
+                vertices = get_shape_vertices(settings, repr, shape_cache)
                 vertices = [(x[0], x[1]) for x in vertices]
                 return vertices
 
@@ -0,0 +1,352 @@
+import os
+import re
+import tempfile
+from array import array
+from typing import Dict, Iterator, List, Set, Tuple
+import numpy as np
+import ifcopenshell
+import ifcopenshell.ifcopenshell_wrapper
+from .logger import logger
+
+"""
+Low-memory loading of the parts of an IFC file used by the converter.
+The STEP file is scanned once without building an entity graph, recording only the type and the references of every
+instance. The instances of the classes the converter reads are kept, together with their parts and type objects,
+everything they reference (placements, representations, property sets, ...) and the relationships between kept
+objects. Relationships also relating objects that are left out, e.g. the furniture contained in a storey, are
+rewritten to only relate the kept objects. The kept instances are written to a temporary STEP file with their
+original ids, which is then opened with ifcopenshell.
+"""
+
+# Classes (including their subclasses) read by the converter
+SELECTIVE_LOADING_CLASSES = [
+    "IfcProject",
+    "IfcSpatialStructureElement",
+    "IfcWall",
+    "IfcCurtainWall",
+    "IfcOpeningElement",
+    "IfcDoor",
+    "IfcStair",
+    "IfcStairFlight",
+    "IfcSlab",
+    "IfcTransportElement",
+]
+
+# Relationships from a kept object to the objects kept with it, as (class, relating attribute, related attribute)
+# Parts are kept because products without a representation are tessellated through their parts
+KEPT_WITH_RELATIONS = [
+    ("IfcRelAggregates", 4, 5),
+    ("IfcRelNests", 4, 5),
+    ("IfcRelDefinesByType", 5, 4),
+]
+
+STRING_PATTERN = re.compile(rb"'(?:[^']|'')*'")
+REFERENCE_PATTERN = re.compile(rb"#(\d+)")
+RECORD_PATTERN = re.compile(rb"\s*#(\d+)\s*=\s*([A-Za-z0-9_]+)\s*\((.*)\)\s*;\s*$", re.DOTALL)
+SCHEMA_PATTERN = re.compile(rb"FILE_SCHEMA\s*\(\s*\(\s*'([^']+)'")
+
+
+def _get_subtypes(schema, ifc_class: str) -> Set[str]:
+    """
+    Upper case names of a class and all its subclasses in the schema
+    """
+    queue = [schema.declaration_by_name(ifc_class)]
+    names = set()
+    while len(queue) > 0:
+        declaration = queue.pop()
+        names.add(declaration.name().upper())
+        queue += declaration.subtypes()
+    return names
+
+
+def _read_records(f, offset: int) -> Iterator[Tuple[int, bytes]]:
+    """
+    Instances of the DATA section as (offset in the file, STEP text). Instances can span several lines.
+    """
+    f.seek(offset)
+    record = b""
+    record_offset = offset
+    for line in f:
+        if record == b"":
+            if not line.lstrip().startswith(b"#"):
+                offset += len(line)
+                if line.strip() == b"ENDSEC;":
+                    return
+                continue
+            record_offset = offset
+        record += line
+        offset += len(line)
+        # A semicolon ends the instance unless it is inside a string; quotes escaped as '' keep the count even
+        if record.rstrip().endswith(b";") and record.count(b"'") % 2 == 0:
+            yield record_offset, record
+            record = b""
+
+
+def _split_arguments(text: bytes) -> List:
+    """
+    Parse the arguments of an instance into nested lists of tokens; tokens are kept as STEP text.
+    """
+    stack = [[]]
+    token = b""
+    i = 0
+    while i < len(text):
+        c = text[i:i + 1]
+        if c == b"'":
+            end = STRING_PATTERN.match(text, i).end()
+            token += text[i:end]
+            i = end
+            continue
+        if c == b"(":
+            if token.strip() != b"":
+                # Typed value, e.g. IFCLABEL('...'), kept as a single token
+                depth, j = 0, i
+                while True:
+                    if text[j:j + 1] == b"'":
+                        j = STRING_PATTERN.match(text, j).end()
+                        continue
+                    depth += {b"(": 1, b")": -1}.get(text[j:j + 1], 0)
+                    j += 1
+                    if depth == 0:
+                        break
+                token += text[i:j]
+                i = j
+                continue
+            stack.append([])
+        elif c == b")":
+            if token.strip() != b"":
+                stack[-1].append(token.strip())
+            token = b""
+            items = stack.pop()
+            stack[-1].append(items)
+        elif c == b",":
+            if token.strip() != b"":
+                stack[-1].append(token.strip())
+            token = b""
+        else:
+            token += c
+        i += 1
+    if token.strip() != b"":
+        stack[-1].append(token.strip())
+    return stack[0]
+
+
+def _join_arguments(arguments: List) -> bytes:
+    return b",".join(b"(" + _join_arguments(x) + b")" if isinstance(x, list) else x for x in arguments)
+
+
+def _get_reference(token) -> int:
+    if isinstance(token, bytes) and token.startswith(b"#"):
+        return int(token[1:])
+    return None
+
+
+class StepIndex:
+    """
+    Type and references of every instance of a STEP file, stored in flat arrays.
+    The arguments of the relationships that keep objects together are kept as well.
+    """
+    def __init__(self, path: str, kept_with_classes: Set[str]):
+        self.path = path
+        self.types: List[str] = []
+        type_codes: Dict[str, int] = {}
+        ids = array("q")
+        codes = array("H")
+        offsets = array("q")
+        lengths = array("q")
+        reference_offsets = array("q", [0])
+        references = array("q")
+        # Instance id -> parsed arguments, for the classes in kept_with_classes
+        self.kept_with_arguments: Dict[int, Tuple[str, List]] = {}
+
+        with open(path, "rb") as f:
+            header = b""
+            for line in f:
+                header += line
+                if line.strip() == b"DATA;":
+                    break
+            self.header = header
+
+            for offset, record in _read_records(f, len(header)):
+                match = RECORD_PATTERN.match(record)
+                if match is None:
+                    raise ValueError(f"Cannot parse STEP instance at byte {offset} of {path}")
+                instance_id, ifc_type, arguments = int(match.group(1)), match.group(2).upper().decode(), match.group(3)
+                if ifc_type not in type_codes:
+                    type_codes[ifc_type] = len(self.types)
+                    self.types.append(ifc_type)
+                ids.append(instance_id)
+                codes.append(type_codes[ifc_type])
+                offsets.append(offset)
+                lengths.append(len(record))
+                references.extend(int(x) for x in REFERENCE_PATTERN.findall(STRING_PATTERN.sub(b"", arguments)))
+                reference_offsets.append(len(references))
+                if ifc_type in kept_with_classes:
+                    self.kept_with_arguments[instance_id] = (ifc_type, _split_arguments(arguments))
+
+        self.ids = np.frombuffer(ids, dtype=np.int64) if len(ids) > 0 else np.zeros(0, dtype=np.int64)
+        # Instances are looked up by id with a binary search
+        self.order = np.argsort(self.ids, kind="stable")
+        self.sorted_ids = self.ids[self.order]
+        self.codes = np.frombuffer(codes, dtype=np.uint16) if len(codes) > 0 else np.zeros(0, dtype=np.uint16)
+        self.offsets = np.frombuffer(offsets, dtype=np.int64) if len(offsets) > 0 else np.zeros(0, dtype=np.int64)
+        self.lengths = np.frombuffer(lengths, dtype=np.int64) if len(lengths) > 0 else np.zeros(0, dtype=np.int64)
+        self.reference_offsets = np.frombuffer(reference_offsets, dtype=np.int64)
+        self.references = self.get_indices(np.frombuffer(references, dtype=np.int64) if len(references) > 0 else np.zeros(0, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_indices(self, instance_ids: np.ndarray) -> np.ndarray:
+        """
+        Row of each instance id, -1 for ids that do not exist in the file
+        """
+        if len(self.sorted_ids) == 0:
+            return np.full(len(instance_ids), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.sorted_ids, instance_ids), len(self.sorted_ids) - 1)
+        return np.where(self.sorted_ids[positions] == instance_ids, self.order[positions], -1)
+
+    def get_type_mask(self, ifc_types: Set[str]) -> np.ndarray:
+        codes = [code for code, ifc_type in enumerate(self.types) if ifc_type in ifc_types]
+        return np.isin(self.codes, codes)
+
+
+def select_instances(index: StepIndex, schema) -> Tuple[np.ndarray, Dict[int, List]]:
+    """
+    Output: (mask of the kept rows, rewritten arguments of the relationships relating objects that are left out, by id)
+    """
+    objects = index.get_type_mask(_get_subtypes(schema, "IfcObjectDefinition"))
+    relationships = index.get_type_mask(_get_subtypes(schema, "IfcRelationship"))
+    spatial = index.get_type_mask(_get_subtypes(schema, "IfcSpatialStructureElement") | _get_subtypes(schema, "IfcProject"))
+    kept_objects = np.zeros(len(index), dtype=bool)
+    for ifc_class in SELECTIVE_LOADING_CLASSES:
+        kept_objects |= index.get_type_mask(_get_subtypes(schema, ifc_class))
+
+    # Parts and type objects of kept elements; the parts of spatial elements are kept through the selected classes
+    relation_classes = [(_get_subtypes(schema, relation_class), relating_attribute, related_attribute) for relation_class, relating_attribute, related_attribute in KEPT_WITH_RELATIONS]
+    type_relation_classes = _get_subtypes(schema, "IfcRelDefinesByType")
+    kept_with = {}
+    for ifc_type, arguments in index.kept_with_arguments.values():
+        for relation_classes_subtypes, relating_attribute, related_attribute in relation_classes:
+            if ifc_type not in relation_classes_subtypes or len(arguments) <= max(relating_attribute, related_attribute):
+                continue
+            relating = _get_reference(arguments[relating_attribute])
+            related = arguments[related_attribute]
+            related = [_get_reference(x) for x in related] if isinstance(related, list) else [_get_reference(related)]
+            if ifc_type in type_relation_classes:
+                # A type object is kept with any of the objects it types
+                for instance_id in related:
+                    kept_with.setdefault(instance_id, []).append(relating)
+            else:
+                kept_with.setdefault(relating, []).extend(related)
+    queue = index.ids[kept_objects & ~spatial].tolist()
+    while len(queue) > 0:
+        other_ids = [x for x in kept_with.get(queue.pop(), []) if x is not None]
+        for instance_id, row in zip(other_ids, index.get_indices(np.array(other_ids, dtype=np.int64)).tolist()):
+            if row >= 0 and objects[row] and not kept_objects[row]:
+                kept_objects[row] = True
+                queue.append(instance_id)
+    left_out_objects = objects & ~kept_objects
+
+    # Relationships are kept when they still relate kept objects once the left out objects are removed
+    kept = kept_objects.copy()
+    rewritten_arguments = {}
+    with open(index.path, "rb") as f:
+        for row in np.nonzero(relationships)[0].tolist():
+            start, end = index.reference_offsets[row], index.reference_offsets[row + 1]
+            references = index.references[start:end]
+            if not np.any(references >= 0):
+                continue
+            left_out = references[left_out_objects[np.maximum(references, 0)] & (references >= 0)]
+            if len(left_out) == 0:
+                kept[row] = True
+                continue
+            f.seek(index.offsets[row])
+            match = RECORD_PATTERN.match(f.read(index.lengths[row]))
+            arguments = _rewrite_relationship(_split_arguments(match.group(3)), set(index.ids[left_out].tolist()))
+            if arguments is not None:
+                kept[row] = True
+                rewritten_arguments[int(index.ids[row])] = arguments
+
+    # Everything referenced by the kept instances, except left out objects referenced by relationships
+    frontier = np.nonzero(kept)[0]
+    while len(frontier) > 0:
+        starts, ends = index.reference_offsets[frontier], index.reference_offsets[frontier + 1]
+        counts = ends - starts
+        positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        sources = np.repeat(frontier, counts)
+        targets = index.references[positions]
+        valid = targets >= 0
+        targets, sources = targets[valid], sources[valid]
+        targets = targets[~(relationships[sources] & left_out_objects[targets])]
+        targets = np.unique(targets[~kept[targets]])
+        kept[targets] = True
+        frontier = targets
+    return kept, rewritten_arguments
+
+
+def _rewrite_relationship(arguments: List, left_out_ids: Set[int]) -> List:
+    """
+    Remove the references to left out objects from the arguments of a relationship.
+    Returns None if the relationship relates no kept object any more, i.e. a single valued reference or all the
+    references of a list are left out.
+    """
+    rewritten = []
+    for argument in arguments:
+        if isinstance(argument, list):
+            items = [x for x in argument if _get_reference(x) not in left_out_ids]
+            if len(argument) > 0 and len(items) == 0:
+                return None
+            rewritten.append(items)
+        elif _get_reference(argument) in left_out_ids:
+            return None
+        else:
+            rewritten.append(argument)
+    return rewritten
+
+
+def write_selection(ifc_filepath: str, out_filepath: str) -> Tuple[int, int]:
+    """
+    Write the instances of an IFC file used by the converter to a new STEP file.
+    Output: (number of kept instances, number of instances)
+    """
+    schema_name = None
+    with open(ifc_filepath, "rb") as f:
+        match = SCHEMA_PATTERN.search(f.read(64 * 1024))
+        if match is not None:
+            schema_name = match.group(1).decode()
+    if schema_name is None:
+        raise ValueError(f"Cannot read the schema of {ifc_filepath}")
+    schema = ifcopenshell.ifcopenshell_wrapper.schema_by_name(schema_name)
+
+    kept_with_classes = set()
+    for relation_class, _, _ in KEPT_WITH_RELATIONS:
+        kept_with_classes |= _get_subtypes(schema, relation_class)
+    index = StepIndex(ifc_filepath, kept_with_classes)
+    kept, rewritten_arguments = select_instances(index, schema)
+
+    with open(ifc_filepath, "rb") as f, open(out_filepath, "wb") as out:
+        out.write(index.header)
+        # Instances are written in the order of the input file
+        for row in np.nonzero(kept)[0].tolist():
+            instance_id = int(index.ids[row])
+            if instance_id in rewritten_arguments:
+                out.write(b"#%d=%s(%s);\n" % (instance_id, index.types[index.codes[row]].encode(), _join_arguments(rewritten_arguments[instance_id])))
+            else:
+                f.seek(index.offsets[row])
+                out.write(f.read(index.lengths[row]).rstrip() + b"\n")
+        out.write(b"ENDSEC;\nEND-ISO-10303-21;\n")
+    return int(kept.sum()), len(index)
+
+
+def open_selectively(ifc_filepath: str) -> ifcopenshell.file:
+    """
+    Open only the instances of an IFC file used by the converter, see write_selection.
+    """
+    fd, tmp_filepath = tempfile.mkstemp(suffix=".ifc")
+    os.close(fd)
+    try:
+        kept_count, count = write_selection(ifc_filepath, tmp_filepath)
+        logger.debug(f"Selective loading kept {kept_count} of {count} instances of {ifc_filepath}")
+        return ifcopenshell.open(tmp_filepath)
+    finally:
+        os.remove(tmp_filepath)
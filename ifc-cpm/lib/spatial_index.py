@@ -0,0 +1,69 @@
+import math
+from typing import Any, Set, Tuple
+from collections import defaultdict
+
+"""
+Uniform grid spatial index over axis-aligned bounding boxes.
+Items are registered in every grid cell their bounding box covers, so a query only has to look at
+the items sharing a cell with the query box instead of every item.
+"""
+
+BoundingBox = Tuple[float, float, float, float]  # (min_x, min_y, max_x, max_y)
+
+
+def get_line_bounding_box(line) -> BoundingBox:
+    (x1, y1), (x2, y2) = line
+    return min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)
+
+
+def inflate_bounding_box(bbox: BoundingBox, distance: float) -> BoundingBox:
+    min_x, min_y, max_x, max_y = bbox
+    return min_x - distance, min_y - distance, max_x + distance, max_y + distance
+
+
+def bounding_boxes_overlap(bbox1: BoundingBox, bbox2: BoundingBox) -> bool:
+    return bbox1[0] <= bbox2[2] and bbox2[0] <= bbox1[2] and bbox1[1] <= bbox2[3] and bbox2[1] <= bbox1[3]
+
+
+class UniformGrid:
+    def __init__(self, cell_size: float):
+        self.cell_size = cell_size
+        self.cells = defaultdict(set)
+        self.bounding_boxes = {}
+
+    def insert(self, item: Any, bbox: BoundingBox):
+        self.bounding_boxes[item] = bbox
+        for cell in self._get_cells(bbox):
+            self.cells[cell].add(item)
+
+    def remove(self, item: Any):
+        bbox = self.bounding_boxes.pop(item)
+        for cell in self._get_cells(bbox):
+            self.cells[cell].discard(item)
+
+    def update(self, item: Any, bbox: BoundingBox):
+        if self.bounding_boxes.get(item) == bbox:
+            return
+        self.remove(item)
+        self.insert(item, bbox)
+
+    def query(self, bbox: BoundingBox) -> Set[Any]:
+        """
+        Returns all items whose bounding box overlaps the given bounding box.
+        """
+        items = set()
+        for cell in self._get_cells(bbox):
+            items |= self.cells.get(cell, set())
+        return {item for item in items if bounding_boxes_overlap(self.bounding_boxes[item], bbox)}
+
+    def query_radius(self, point: Tuple[float, float], radius: float) -> Set[Any]:
+        x, y = point
+        return self.query((x - radius, y - radius, x + radius, y + radius))
+
+    def _get_cells(self, bbox: BoundingBox):
+        min_x, min_y, max_x, max_y = bbox
+        i1, j1 = math.floor(min_x / self.cell_size), math.floor(min_y / self.cell_size)
+        i2, j2 = math.floor(max_x / self.cell_size), math.floor(max_y / self.cell_size)
+        for i in range(i1, i2 + 1):
+            for j in range(j1, j2 + 1):
+                yield (i, j)
@@ -0,0 +1,62 @@
+import time
+from typing import List
+
+"""
+Budget of the split stage of a storey.
+A SplitBudget holds the limits, and is started once per storey into a SplitBudgetTracker, which counts the split
+iterations and holds the deadline of the storey. The tracker is shared by the retries of the storey, so that leaving
+out elements and splitting again never extends the total time or number of iterations.
+"""
+
+
+class SplitBudget:
+    """
+    Limits of the split stage of a storey, None is unlimited.
+    max_iterations: maximum number of split points applied
+    max_seconds: maximum time spent splitting
+    """
+    def __init__(self, max_iterations: int = None, max_seconds: float = None):
+        self.max_iterations = max_iterations
+        self.max_seconds = max_seconds
+
+    def start(self) -> "SplitBudgetTracker":
+        return SplitBudgetTracker(self)
+
+
+UNLIMITED_SPLIT_BUDGET = SplitBudget()
+
+
+class SplitBudgetTracker:
+    """
+    Split iterations and deadline of one storey, from the moment its budget is started.
+    """
+    def __init__(self, budget: SplitBudget):
+        self.budget = budget
+        self.iterations = 0
+        self.deadline = None if budget.max_seconds is None else time.perf_counter() + budget.max_seconds
+
+    def step(self, count: int = 1) -> bool:
+        """
+        Count split points applied.
+        Output: True if the budget is exceeded
+        """
+        self.iterations += count
+        return self.is_exceeded()
+
+    def is_past_deadline(self) -> bool:
+        return self.deadline is not None and time.perf_counter() > self.deadline
+
+    def is_exceeded(self) -> bool:
+        if self.budget.max_iterations is not None and self.iterations > self.budget.max_iterations:
+            return True
+        return self.is_past_deadline()
+
+
+class SplitBudgetExceeded(Exception):
+    """
+    Raised when splitting the elements of a storey exceeds its budget or does not converge.
+    offenders: elements whose parts were being split again, may be empty when no element is to blame
+    """
+    def __init__(self, message: str, offenders: List):
+        super().__init__(message)
+        self.offenders = offenders
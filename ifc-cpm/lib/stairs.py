@@ -5,13 +5,12 @@ import ifcopenshell.util.placement
 import ifcopenshell.util.element
 import ifcopenshell.util.unit
 import ifcopenshell.util.shape
-from .utils import find, filter, find_unbounded_lines_intersection, eucledian_distance, calculate_line_angle_relative_to_north, get_sorted_building_storeys, rotate_point_around_point, get_oriented_xy_bounding_box, get_composite_verts, smallest_angle_difference
+from .utils import find, filter, find_unbounded_lines_intersection, eucledian_distance, calculate_line_angle_relative_to_north, rotate_point_around_point, get_oriented_xy_bounding_box, get_oriented_xy_bounding_box_batch, get_composite_verts, smallest_angle_difference
 from .ifctypes import StraightSingleRunStair, DoubleRunStairWithLanding
-
-settings = ifcopenshell.geom.settings()
-settings.set(settings.CONVERT_BACK_UNITS, False)
-settings.set(settings.USE_WORLD_COORDS, True)
-settings.set(settings.INCLUDE_CURVES, True)
+from .shape_cache import get_shape_vertices
+from .storey_index import StoreyElevationIndex
+from .geom_settings import curve_settings
+from .obb import COLLINEAR_POINTS_ERROR
 
 
 def _calculate_resultant_run_line(run_edges):
@@ -22,7 +21,7 @@ def _calculate_resultant_run_line(run_edges):
     return v1, v2
 
 
-def _get_flights_run_edges(stair_flights):
+def _get_flights_run_edges(stair_flights, shape_cache=None):
     run_edges = []
 
     # TODO Need to ensure stair flights are sorted by elevation
@@ -30,34 +29,49 @@ def _get_flights_run_edges(stair_flights):
         axis_repr = ifcopenshell.util.representation.get_representation(stair_flight, "Model", "Axis")
         assert axis_repr is not None, "There should be a Axis representation"
 
-        shape = ifcopenshell.geom.create_shape(settings, axis_repr)
-        run_edge = ifcopenshell.util.shape.get_vertices(shape)
+        run_edge = get_shape_vertices(curve_settings, axis_repr, shape_cache)
         run_edge = [(x[0], x[1]) for x in run_edge]
         run_edges.append(run_edge)
 
     return run_edges
 
 
-def _determine_stair_floor_span(ifc_building, ifc_stair) -> int:
+def get_stair_footprints(ifc_stairs, shape_cache=None) -> list:
+    """
+    Oriented XY bounding box of each stair, computed in one batch.
+    Output: Array of the box of each stair, or of the exception raised while computing it
+    """
+    footprints = [None] * len(ifc_stairs)
+    stairs_verts = {}
+    for i, ifc_stair in enumerate(ifc_stairs):
+        try:
+            stairs_verts[i] = get_composite_verts(ifc_stair, shape_cache)
+        except Exception as e:
+            footprints[i] = e
+
+    bboxes = get_oriented_xy_bounding_box_batch(stairs_verts.values())
+    for i, bbox in zip(stairs_verts.keys(), bboxes):
+        footprints[i] = ValueError(COLLINEAR_POINTS_ERROR) if bbox is None else bbox
+    return footprints
+
+
+def _determine_stair_floor_span(ifc_building, ifc_stair, storey_index=None) -> int:
     # return 1 # FIXME remove
     storey = ifcopenshell.util.element.get_container(ifc_stair, "IfcBuildingStorey")
-    building_storeys = get_sorted_building_storeys(ifc_building)
+    if storey_index is None:
+        storey_index = StoreyElevationIndex(ifc_building)
 
     psets = ifcopenshell.util.element.get_psets(ifc_stair)
     pset_stair = psets['Pset_StairCommon']
     run_height = pset_stair.get("NumberOfRiser", 1) * pset_stair.get("RiserHeight", 1)
 
-    starting_elevation = ifcopenshell.util.placement.get_storey_elevation(storey)
+    starting_elevation = storey_index.get_elevation(storey)
     ending_elevation = starting_elevation + run_height
 
     # Sometimes the staircase and floor elevation is slightly different due to rounding error.
     tolerance = 0.1 * run_height
 
-    def is_storey_voided_by_stair(ifc_storey):
-        elevation = ifcopenshell.util.placement.get_storey_elevation(ifc_storey)
-        return elevation >= starting_elevation - tolerance and elevation <= ending_elevation + tolerance
-
-    storeys_in_stair = filter(building_storeys, matcher=is_storey_voided_by_stair)
+    storeys_in_stair = storey_index.get_storey_indices_in_elevation_range(starting_elevation - tolerance, ending_elevation + tolerance)
 
     return len(storeys_in_stair) - 1
 
@@ -73,14 +87,17 @@ class StairType(Enum):
 
 class StairParser:
     @staticmethod
-    def from_ifc_stair(ifc_building, start_level_index, ifc_stair):
-        stair_type = StairParser.infer_stair_type(ifc_stair)
+    def from_ifc_stair(ifc_building, start_level_index, ifc_stair, shape_cache=None, storey_index=None, footprint=None):
+        """
+        Input: footprint: Box of the stair, or exception, from get_stair_footprints, computed here if None
+        """
+        stair_type = StairParser.infer_stair_type(ifc_stair, shape_cache)
         if stair_type == StairType.STRAIGHT_SINGLE_RUN:
-            stair = StraightSingleRunStairBuilder(ifc_building, start_level_index, ifc_stair).build()
+            stair = StraightSingleRunStairBuilder(ifc_building, start_level_index, ifc_stair, shape_cache, storey_index, footprint).build()
             if stair:
                 return stair
         elif stair_type == StairType.U_TURN_WITH_LANDING:
-            stair = DoubleRunStairWithLandingBuilder(ifc_building, start_level_index, ifc_stair).build()
+            stair = DoubleRunStairWithLandingBuilder(ifc_building, start_level_index, ifc_stair, shape_cache, storey_index, footprint).build()
             if stair:
                 return stair
 
@@ -90,7 +107,7 @@ class StairParser:
         raise NotImplementedError(f"Cannot parse stair {ifc_stair.Name}")
 
     @staticmethod
-    def infer_stair_type(ifc_stair) -> StairType:
+    def infer_stair_type(ifc_stair, shape_cache=None) -> StairType:
         stair_type = ifc_stair.PredefinedType
         if stair_type == "STRAIGHT_RUN_STAIR":
             return StairType.STRAIGHT_SINGLE_RUN
@@ -100,16 +117,16 @@ class StairParser:
 
         if len(stair_flights) >= 1:
             # TODO differentiate between U and straight
-            if StairParser._is_stair_straight(ifc_stair):
+            if StairParser._is_stair_straight(ifc_stair, shape_cache):
                 return StairType.STRAIGHT_SINGLE_RUN
-            if StairParser._is_stair_u_turns(ifc_stair):
+            if StairParser._is_stair_u_turns(ifc_stair, shape_cache):
                 return StairType.U_TURN_WITH_LANDING
 
     @staticmethod
-    def _is_stair_straight(ifc_stair) -> bool:
+    def _is_stair_straight(ifc_stair, shape_cache=None) -> bool:
         elements = ifcopenshell.util.element.get_decomposition(ifc_stair)
         stair_flights = filter(elements, lambda x: x.is_a("IfcStairFlight"))
-        run_edges = _get_flights_run_edges(stair_flights)
+        run_edges = _get_flights_run_edges(stair_flights, shape_cache)
         resultant = _calculate_resultant_run_line(run_edges=run_edges)
         angle1 = calculate_line_angle_relative_to_north(*(run_edges[0]))
         angle2 = calculate_line_angle_relative_to_north(*resultant)
@@ -119,10 +136,10 @@ class StairParser:
         return angle_diff < 10  # Maximum to be considered straight is 10 degrees. TODO configure
 
     @staticmethod
-    def _is_stair_u_turns(ifc_stair) -> bool:
+    def _is_stair_u_turns(ifc_stair, shape_cache=None) -> bool:
         elements = ifcopenshell.util.element.get_decomposition(ifc_stair)
         stair_flights = filter(elements, lambda x: x.is_a("IfcStairFlight"))
-        run_edges = _get_flights_run_edges(stair_flights)
+        run_edges = _get_flights_run_edges(stair_flights, shape_cache)
         resultant = _calculate_resultant_run_line(run_edges=run_edges)
         angle1 = calculate_line_angle_relative_to_north(*(run_edges[0]))
         angle2 = calculate_line_angle_relative_to_north(*resultant)
@@ -132,17 +149,24 @@ class StairParser:
 
 
 class StraightSingleRunStairBuilder:
-    def __init__(self, ifc_building, start_level_index, ifc_stair):
+    def __init__(self, ifc_building, start_level_index, ifc_stair, shape_cache=None, storey_index=None, footprint=None):
         self.ifc_building = ifc_building
         self.start_level_index = start_level_index
         self.ifc_stair = ifc_stair
+        self.shape_cache = shape_cache
+        self.storey_index = storey_index
+        self.footprint = footprint
 
     def build(self):
         elements = ifcopenshell.util.element.get_decomposition(self.ifc_stair)
         stair_flights = filter(elements, lambda x: x.is_a("IfcStairFlight"))
 
-        verts = get_composite_verts(self.ifc_stair)
-        bbox = get_oriented_xy_bounding_box(verts)
+        bbox = self.footprint
+        if isinstance(bbox, Exception):
+            raise bbox
+        if bbox is None:
+            verts = get_composite_verts(self.ifc_stair, self.shape_cache)
+            bbox = get_oriented_xy_bounding_box(verts)
         footprint_v1, footprint_v2, footprint_v3, footprint_v4 = bbox
         edges = [
             (footprint_v1, footprint_v2),
@@ -151,7 +175,7 @@ class StraightSingleRunStairBuilder:
             (footprint_v4, footprint_v1),
         ]
 
-        run_edges = _get_flights_run_edges(stair_flights)
+        run_edges = _get_flights_run_edges(stair_flights, self.shape_cache)
         run_edge = _calculate_resultant_run_line(run_edges)
 
         run_start_vertex, run_end_vertex = run_edge
@@ -179,7 +203,7 @@ class StraightSingleRunStairBuilder:
         lower_gate = find(edges_map.values(), lambda x: x['designation'] == 'BOTTOM_GATE')
         side_walls = filter(edges_map.values(), lambda x: x['designation'] == 'WALL')
 
-        floor_span = _determine_stair_floor_span(self.ifc_building, self.ifc_stair)
+        floor_span = _determine_stair_floor_span(self.ifc_building, self.ifc_stair, self.storey_index)
 
         run_length = eucledian_distance(run_start_vertex, run_end_vertex)
         run_rotation = int(round(calculate_line_angle_relative_to_north(run_start_vertex, run_end_vertex)))
@@ -225,17 +249,24 @@ class StraightSingleRunStairBuilder:
 
 
 class DoubleRunStairWithLandingBuilder:
-    def __init__(self, ifc_building, start_level_index, ifc_stair):
+    def __init__(self, ifc_building, start_level_index, ifc_stair, shape_cache=None, storey_index=None, footprint=None):
         self.ifc_building = ifc_building
         self.start_level_index = start_level_index
         self.ifc_stair = ifc_stair
+        self.shape_cache = shape_cache
+        self.storey_index = storey_index
+        self.footprint = footprint
 
     def build(self):
         elements = ifcopenshell.util.element.get_decomposition(self.ifc_stair)
         stair_flights = filter(elements, lambda x: x.is_a("IfcStairFlight"))
 
-        verts = get_composite_verts(self.ifc_stair)
-        bbox = get_oriented_xy_bounding_box(verts)
+        bbox = self.footprint
+        if isinstance(bbox, Exception):
+            raise bbox
+        if bbox is None:
+            verts = get_composite_verts(self.ifc_stair, self.shape_cache)
+            bbox = get_oriented_xy_bounding_box(verts)
         footprint_v1, footprint_v2, footprint_v3, footprint_v4 = bbox
         edges = [
             (footprint_v1, footprint_v2),
@@ -244,7 +275,7 @@ class DoubleRunStairWithLandingBuilder:
             (footprint_v4, footprint_v1),
         ]
 
-        run_edges = _get_flights_run_edges(stair_flights)
+        run_edges = _get_flights_run_edges(stair_flights, self.shape_cache)
         resultant_run_edge = _calculate_resultant_run_line(run_edges)
         first_run_edge = run_edges[0]
 
@@ -266,7 +297,7 @@ class DoubleRunStairWithLandingBuilder:
         psets = ifcopenshell.util.element.get_psets(self.ifc_stair)
         no_of_treads = psets['Pset_StairCommon'].get("NumberOfTreads")
 
-        floor_span = _determine_stair_floor_span(self.ifc_building, self.ifc_stair)
+        floor_span = _determine_stair_floor_span(self.ifc_building, self.ifc_stair, self.storey_index)
 
         return DoubleRunStairWithLanding(
             object_id=self.ifc_stair.GlobalId,
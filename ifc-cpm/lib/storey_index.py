@@ -0,0 +1,42 @@
+from bisect import bisect_left, bisect_right
+import ifcopenshell.util.placement
+from .utils import get_sorted_building_storeys
+
+"""
+Sorted index of the storey elevations of a building.
+Elevations are read once per building, and the storeys within an elevation range are found by bisection
+instead of testing every storey.
+"""
+
+
+class StoreyElevationIndex:
+    def __init__(self, ifc_building, unit_scale=1, model_index=None):
+        self.storeys = get_sorted_building_storeys(ifc_building, model_index)
+        # Elevations in IFC units, and scaled by unit_scale, in the same (ascending) order as the storeys
+        self.elevations = [ifcopenshell.util.placement.get_storey_elevation(storey) for storey in self.storeys]
+        self.scaled_elevations = [elevation * unit_scale for elevation in self.elevations]
+        self.storey_indices = {storey.id(): i for i, storey in enumerate(self.storeys)}
+
+    def get_elevation(self, ifc_storey) -> float:
+        """
+        Elevation of the storey in IFC units.
+        """
+        if ifc_storey.id() in self.storey_indices:
+            return self.elevations[self.storey_indices[ifc_storey.id()]]
+        return ifcopenshell.util.placement.get_storey_elevation(ifc_storey)
+
+    def get_storey_indices_in_elevation_range(self, min_elevation: float, max_elevation: float) -> range:
+        """
+        Indices of the storeys whose elevation (in IFC units) is within [min_elevation, max_elevation].
+        """
+        return range(bisect_left(self.elevations, min_elevation), bisect_right(self.elevations, max_elevation))
+
+    def get_storey_indices_containing_wall(self, z_min: float, z_max: float, min_wall_height: float, wall_offset_tolerance: float) -> range:
+        """
+        Indices of the storeys a wall spanning [z_min, z_max] (scaled units) belongs to, i.e. the wall starts at most
+        wall_offset_tolerance above the storey elevation and is at least min_wall_height tall from there.
+        """
+        # Both conditions are monotonic in the elevation, so the storeys satisfying them form a contiguous range
+        start = bisect_left(self.scaled_elevations, True, key=lambda elevation: z_min <= elevation + wall_offset_tolerance)
+        end = bisect_left(self.scaled_elevations, True, key=lambda elevation: z_max < elevation + min_wall_height - wall_offset_tolerance)
+        return range(start, max(start, end))
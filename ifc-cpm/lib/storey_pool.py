@@ -0,0 +1,63 @@
+from typing import List, Tuple
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from .element_table import ElementTable
+from .preprocessors import preprocess_storey_elements_within_budget
+from .split_budget import SplitBudget, UNLIMITED_SPLIT_BUDGET
+from .logger import logger
+from .profiling import Profiler, NULL_PROFILER
+
+"""
+Runs the 2D preprocessing of several storeys in a process pool.
+Storeys do not depend on each other once their walls are parsed, so each storey is preprocessed in its own process.
+Elements are sent to and from the workers as element tables, i.e. a few flat arrays instead of lists of pickled objects.
+Workers are spawned rather than forked, since the converter may run in a thread of a multithreaded process (see
+IfcToCpmConverterBuilder.build_all), and a forked worker could inherit locks held by the other threads.
+A pool can be shared by several converters running in threads, so that the storeys of all of them are preprocessed in
+the same processes (see IfcToCpmConverterBuilder.build_all and sweep_parameters).
+"""
+
+
+def create_storey_pool(workers: int = None) -> ProcessPoolExecutor:
+    """
+    Input: workers: number of worker processes, None uses all cores
+    """
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def _preprocess_storey_elements(elements: ElementTable, tolerance: float, split_method: str, split_budget: SplitBudget, profile: bool, log_level):
+    # Spawned workers do not inherit the level of the logger of the parent process
+    logger.setLevel(log_level)
+    profiler = Profiler(enabled=profile)
+    elements, left_out = preprocess_storey_elements_within_budget(elements, tolerance, split_method, profiler=profiler, split_budget=split_budget)
+    return elements, left_out, profiler.get_stage_times(), profiler.get_counters()
+
+
+def preprocess_storeys(storeys_elements: List[ElementTable], tolerance: float, split_method: str, workers: int = None, profilers: List[Profiler] = None, split_budget: SplitBudget = UNLIMITED_SPLIT_BUDGET, pool: ProcessPoolExecutor = None) -> List[Tuple[ElementTable, List[Tuple[str, str]]]]:
+    """
+    Preprocess the elements of each storey in a pool of worker processes.
+    Input:
+        storeys_elements: Array of the element table of each storey
+        profilers: Optional array of the profiler of each storey
+        split_budget: budget of the split stage of each storey
+        pool: pool created by create_storey_pool and shared with other callers, by default a pool of workers processes
+            is created for this call
+    Output: Array of (preprocessed element table, elements left out for exceeding the split budget) of each storey,
+        in the same order, as returned by preprocess_storey_elements_within_budget
+    """
+    if profilers is None:
+        profilers = [NULL_PROFILER] * len(storeys_elements)
+    if pool is None:
+        logger.debug(f"Preprocessing {len(storeys_elements)} storeys using {workers or 'all'} workers...")
+        with create_storey_pool(workers) as pool:
+            return preprocess_storeys(storeys_elements, tolerance, split_method, profilers=profilers, split_budget=split_budget, pool=pool)
+
+    futures = [pool.submit(_preprocess_storey_elements, elements, tolerance, split_method, split_budget, profiler.enabled, logger.level) for elements, profiler in zip(storeys_elements, profilers)]
+    out = []
+    for future, profiler in zip(futures, profilers):
+        elements, left_out, stage_times, counters = future.result()
+        # Stage times are summed over workers, i.e. they are CPU rather than wall-clock times
+        profiler.add_stage_times(stage_times)
+        profiler.add_counters(counters)
+        out.append((elements, left_out))
+    return out
@@ -0,0 +1,170 @@
+import os
+import csv
+import contextlib
+import time
+import itertools
+from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from .shape_cache import ShapeCache, DEFAULT_MAX_BYTES, get_geometry_cache_path
+from .storey_pool import create_storey_pool
+from .logger import logger
+
+"""
+Sweeps of the tolerance parameters of the conversion of a building.
+Every combination of a grid of parameter values is converted with the same builder, so the IFC file is loaded once,
+and with one shared geometry cache, so every product is tessellated once. The first combination fills the cache, the
+others only rerun the storey assignment and parsing of the walls, in threads, and the 2D preprocessing. Combinations
+that only differ in close_wall_gap_metre also reuse the parsed walls of the first of them, and only rerun the 2D
+preprocessing. The 2D preprocessing of the storeys of all combinations runs in one shared pool of processes, since it
+is pure Python and would not run in parallel in threads. One CPM file is written per combination, along with a CSV
+summary of the element counts of each.
+"""
+
+# Parameters of IfcToCpmConverterBuilder.build that can be swept, with the short names used in output file names
+SWEEP_PARAMETERS = {
+    "close_wall_gap_metre": "gap",
+    "min_wall_height_metre": "height",
+    "wall_offset_tolerance_metre": "offset",
+}
+
+SUMMARY_COLUMNS = ["output", "status", "duration", "levels", "walls", "gates", "barricades", "stairs", "barricade_ratio", "barricade_length_ratio", "unparsable", "error"]
+
+
+def get_parameter_combinations(grid: Dict[str, List[float]]) -> List[Dict[str, float]]:
+    """
+    Input: dict of parameter name to the values to try, see SWEEP_PARAMETERS
+    Output: Array of dicts of parameter name to value, one per combination, in the order of the grid
+    """
+    for name, values in grid.items():
+        if name not in SWEEP_PARAMETERS:
+            raise ValueError(f"Cannot sweep {name}, expected one of {list(SWEEP_PARAMETERS.keys())}")
+        if len(values) == 0:
+            raise ValueError(f"No values to sweep for {name}")
+    return [dict(zip(grid.keys(), values)) for values in itertools.product(*grid.values())]
+
+
+def get_combination_groups(combinations: List[Dict[str, float]]) -> List[List[int]]:
+    """
+    Output: Array of the indices of the combinations that only differ in close_wall_gap_metre, in order
+    """
+    groups = {}
+    for i, parameters in enumerate(combinations):
+        key = tuple((name, value) for name, value in parameters.items() if name != "close_wall_gap_metre")
+        groups.setdefault(key, []).append(i)
+    return list(groups.values())
+
+
+def get_combination_name(parameters: Dict[str, float]) -> str:
+    """
+    Output: name of the combination in output file names, e.g. gap-0.2_height-0.5; values are written in full when
+        their short form would round them, so that different values never share a name
+    """
+    def format_value(value: float) -> str:
+        short = f"{value:g}"
+        return short if float(short) == value else repr(value)
+    return "_".join(f"{SWEEP_PARAMETERS[name]}-{format_value(value)}" for name, value in parameters.items())
+
+
+def get_element_summary(converter) -> dict:
+    """
+    Output: dict of the number of converted elements, and of the share of barricades among walls and barricades,
+        by count and by length
+    """
+    levels = converter.crowd_environment.levels
+    walls = [x for level in levels for x in level.walls]
+    barricades = [x for level in levels for x in level.barricades]
+    walls_length = sum(x.length for x in walls)
+    barricades_length = sum(x.length for x in barricades)
+    return {
+        "levels": len(levels),
+        "walls": len(walls),
+        "gates": sum(len(level.gates) for level in levels),
+        "barricades": len(barricades),
+        "stairs": len(converter.crowd_environment.stairs),
+        "barricade_ratio": len(barricades) / (len(walls) + len(barricades)) if len(walls) + len(barricades) > 0 else 0.0,
+        "barricade_length_ratio": float(barricades_length / (walls_length + barricades_length)) if walls_length + barricades_length > 0 else 0.0,
+        "unparsable": len(converter.get_unparsable_objects()),
+    }
+
+
+def sweep_parameters(builder, grid: Dict[str, List[float]], output_dir: str, building_name: str = None, threads: int = None, workers: int = None, compress=False, summary_filepath: str = None, **build_parameters) -> List[dict]:
+    """
+    Convert a building once per combination of the grid, writing <output_dir>/<combination name>.cpm[.gz] for each.
+    Input:
+        builder: IfcToCpmConverterBuilder of the IFC file
+        grid: dict of parameter name to the values to try, see SWEEP_PARAMETERS
+        threads: number of combinations converted at the same time, None uses the default of ThreadPoolExecutor
+        workers: number of processes running the 2D preprocessing of the storeys of all combinations, None uses all
+            cores; with a single one, the storeys are preprocessed in the threads instead
+        summary_filepath: CSV summary to write (default: <output_dir>/summary.csv)
+        build_parameters: keyword arguments of build for the parameters that are not swept
+    Output: Array of dicts of the parameters, output path and summary of each combination, see SUMMARY_COLUMNS.
+        A combination that fails is recorded with status "error" and does not stop the sweep.
+    """
+    combinations = get_parameter_combinations(grid)
+    names = [get_combination_name(parameters) for parameters in combinations]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Combinations with the same name, remove the repeated values of the grid: {sorted(name for name in set(names) if names.count(name) > 1)}")
+    for name in ["building_name", "incremental_state_path", "shared_shape_cache", "process_pool", *grid.keys()]:
+        if name in build_parameters:
+            raise ValueError(f"{name} cannot be passed as a build parameter of a sweep")
+
+    cache_dir = build_parameters.pop("cache_dir", None)
+    geometry_cache_path = get_geometry_cache_path(cache_dir, builder.ifc_filepath) if cache_dir is not None else None
+    shape_cache = ShapeCache(max_bytes=build_parameters.get("shape_cache_max_bytes", DEFAULT_MAX_BYTES))
+    if geometry_cache_path is not None and os.path.exists(geometry_cache_path):
+        logger.debug(f"Loading geometry cache {geometry_cache_path}...")
+        shape_cache.load(geometry_cache_path)
+
+    extension = ".cpm.gz" if compress else ".cpm"
+    os.makedirs(output_dir, exist_ok=True)
+
+    def convert(parameters, parsed_converter=None):
+        """
+        parsed_converter: converter of a combination that only differs in close_wall_gap_metre, whose parsed walls are reused
+        Output: (row, converter), the converter is None if the combination failed
+        """
+        cpm_out_filepath = os.path.join(output_dir, get_combination_name(parameters) + extension)
+        start = time.perf_counter()
+        try:
+            if parsed_converter is not None:
+                converter = parsed_converter.with_close_wall_gap(parameters["close_wall_gap_metre"])
+            else:
+                converter = builder.build(building_name, shared_shape_cache=shape_cache, process_pool=process_pool, **parameters, **build_parameters)
+            converter.write(cpm_out_filepath, compress=compress)
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            return {**parameters, "output": cpm_out_filepath, "status": "error", "duration": time.perf_counter() - start, "error": f"{type(e).__name__}: {e}"}, None
+        return {**parameters, "output": cpm_out_filepath, "status": "ok", "duration": time.perf_counter() - start, **get_element_summary(converter)}, converter
+
+    groups = get_combination_groups(combinations)
+    # The threads only parse the walls and write the outputs, the storeys of all combinations are preprocessed in one
+    # pool of processes
+    use_process_pool = (workers or os.cpu_count() or 1) > 1
+    with create_storey_pool(workers) if use_process_pool else contextlib.nullcontext() as process_pool, ThreadPoolExecutor(max_workers=threads) as executor:
+        # The first combination tessellates the products into the shared cache, the others only read from it
+        first_row, first_converter = convert(combinations[0])
+        rows = {0: first_row}
+        # The first combination of every other group parses its walls, the other combinations of a group reuse them
+        parsing_futures = {executor.submit(convert, combinations[indices[0]]): indices for indices in groups[1:]}
+        futures = {executor.submit(convert, combinations[i], first_converter): i for i in groups[0][1:]}
+        for parsing_future in as_completed(parsing_futures):
+            indices = parsing_futures[parsing_future]
+            rows[indices[0]], parsed_converter = parsing_future.result()
+            futures.update({executor.submit(convert, combinations[i], parsed_converter): i for i in indices[1:]})
+        for future, i in futures.items():
+            rows[i], _ = future.result()
+    rows = [rows[i] for i in range(len(combinations))]
+
+    if geometry_cache_path is not None and shape_cache.is_modified:
+        shape_cache.save(geometry_cache_path)
+
+    write_summary(summary_filepath or os.path.join(output_dir, "summary.csv"), rows, list(grid.keys()))
+    return rows
+
+
+def write_summary(summary_filepath: str, rows: List[dict], parameter_names: List[str]):
+    with open(summary_filepath, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=parameter_names + SUMMARY_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
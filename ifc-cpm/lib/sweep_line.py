@@ -0,0 +1,90 @@
+from typing import List, Tuple, Dict
+from collections import defaultdict
+from .utils import find_lines_intersection
+from .fixed_point import from_fixed
+from .profiling import Profiler, NULL_PROFILER
+from .split_budget import SplitBudgetTracker, SplitBudgetExceeded
+
+"""
+Sweep-line search for all T and + intersections between a set of 2D line segments.
+
+A vertical line is swept from left to right over the segment endpoints. Only segments whose x-range
+is currently crossed by the sweep line (the "active" set) are candidates for intersection, and a
+candidate pair is only tested when their y-ranges overlap as well. Every pair of segments is therefore
+tested at most once, instead of being re-tested after each split.
+"""
+
+# Intersections are computed on fixed-point coordinates, which can move a point by up to one grid step.
+# Ranges are inflated by this amount so that touching segments are never pruned.
+SWEEP_EPSILON = from_fixed(1)
+
+Line = Tuple[Tuple[float, float], Tuple[float, float]]
+
+
+def find_all_intersections(lines: List[Line], profiler: Profiler = NULL_PROFILER, budget_tracker: SplitBudgetTracker = None) -> Dict[int, List[Tuple[float, float]]]:
+    """
+    Input:
+        lines: Array of line segments ((x1, y1), (x2, y2))
+        budget_tracker: split budget of the storey, every cut of a segment in its interior counts as one split iteration
+    Output: Map of segment index to the list of points where the segment is cut by another segment.
+    Points that coincide with the endpoints of both segments (L junctions) are not reported.
+    Raises SplitBudgetExceeded with the indices of the segments cut at two points or more when the budget is exceeded.
+    """
+    def budget_exceeded(message: str) -> SplitBudgetExceeded:
+        profiler.count("intersection-tests", intersection_tests)
+        offenders = [i for i, points in intersections.items() if len({p for p in points if p != lines[i][0] and p != lines[i][1]}) >= 2]
+        return SplitBudgetExceeded(message, offenders)
+
+    events = []
+    for i, ((x1, y1), (x2, y2)) in enumerate(lines):
+        events.append((min(x1, x2) - SWEEP_EPSILON, 0, i))
+        events.append((max(x1, x2) + SWEEP_EPSILON, 1, i))
+
+    # Start events are processed before end events at the same x, so touching segments overlap.
+    events.sort()
+
+    intersections = defaultdict(list)
+    active = set()
+    intersection_tests = 0
+    for _, event_type, i in events:
+        if event_type == 1:
+            active.discard(i)
+            continue
+        if budget_tracker is not None and budget_tracker.is_past_deadline():
+            raise budget_exceeded(f"Finding intersections exceeded the split budget after {intersection_tests} intersection tests")
+
+        line1 = lines[i]
+        (_, y1), (_, y2) = line1
+        y_min1, y_max1 = min(y1, y2) - SWEEP_EPSILON, max(y1, y2) + SWEEP_EPSILON
+        for j in active:
+            line2 = lines[j]
+            (_, y3), (_, y4) = line2
+            if max(y3, y4) < y_min1 or min(y3, y4) > y_max1:
+                continue
+
+            intersection_tests += 1
+            intersection = find_lines_intersection(line1, line2)
+            if intersection is None:
+                continue
+
+            # Only add intersections that are T or +
+            wall_vertices = [line1[0], line1[1], line2[0], line2[1]]
+            if wall_vertices.count(intersection) <= 1:
+                intersections[i].append(intersection)
+                intersections[j].append(intersection)
+                cut_lines = (intersection not in line1) + (intersection not in line2)
+                if budget_tracker is not None and budget_tracker.step(cut_lines):
+                    raise budget_exceeded(f"Finding intersections exceeded the split budget after {budget_tracker.iterations} iterations")
+        active.add(i)
+
+    profiler.count("intersection-tests", intersection_tests)
+    return intersections
+
+
+def sort_points_along_line(line: Line, points: List[Tuple[float, float]]) -> List[Tuple[float, float]]:
+    """
+    Deduplicate points and sort them by their position along the line, from the start vertex to the end vertex.
+    """
+    (x1, y1), (x2, y2) = line
+    dx, dy = x2 - x1, y2 - y1
+    return sorted(set(points), key=lambda p: (p[0] - x1) * dx + (p[1] - y1) * dy)
@@ -8,9 +8,12 @@ This function returns a list of elements that the script cannot currently suppor
 """
 
 
-def get_unparsable_elements(ifc_building) -> List[Any]:
+def get_unparsable_elements(ifc_building, model_index=None) -> List[Any]:
     unparsable_elements = []
-    elements = ifcopenshell.util.element.get_decomposition(ifc_building)
+    if model_index is not None:
+        elements = model_index.get_elements("IfcTransportElement", "IfcSlab")
+    else:
+        elements = ifcopenshell.util.element.get_decomposition(ifc_building)
     for element in elements:
         # Escalators, elevators, travelators
         if element.is_a("IfcTransportElement"):
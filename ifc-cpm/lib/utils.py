@@ -5,13 +5,18 @@ import ifcopenshell.util.element
 import ifcopenshell.util.shape
 import ifcopenshell.util.placement
 import ifcopenshell.geom
-from compas.geometry import oriented_bounding_box_xy_numpy
 from .geom_settings import settings
+from .shape_cache import get_shape_vertices
+from .obb import get_oriented_xy_bounding_boxes
+from .fixed_point import GRID_DIGITS, to_fixed, from_fixed, snap, fixed_lines_intersection
 
 
-def get_sorted_building_storeys(ifc_building):
-    building_elements = ifcopenshell.util.element.get_decomposition(ifc_building)
-    storeys = [x for x in building_elements if x.is_a("IfcBuildingStorey")]
+def get_sorted_building_storeys(ifc_building, model_index=None):
+    if model_index is not None:
+        storeys = model_index.get_elements("IfcBuildingStorey")
+    else:
+        building_elements = ifcopenshell.util.element.get_decomposition(ifc_building)
+        storeys = [x for x in building_elements if x.is_a("IfcBuildingStorey")]
     sorted_storeys = sorted(storeys, key=lambda s: ifcopenshell.util.placement.get_storey_elevation(s))
     return sorted_storeys
 
@@ -25,71 +30,35 @@ def transform_vertex(transformation_matrix, vertex: Tuple[float, float]) -> Tupl
     return (transformed_x, transformed_y)
 
 
-# TODO find permanent solution for rounding error
-def truncate(number, digits=4) -> float:
-    # Improve accuracy with floating point operations, to avoid truncate(16.4, 2) = 16.39 or truncate(-1.13, 2) = -1.12
-    components = str(number).split('.')
-    if len(components) == 1 or len(components[1]) <= digits:
-        return number
-    stepper = 10.0 ** digits
-    return math.ceil(stepper * number) / stepper
+def truncate(number, digits=GRID_DIGITS) -> float:
+    # Snap onto the fixed-point grid, e.g. truncate(16.4, 2) = 16.4 and truncate(16.4001, 2) = 16.41
+    return snap(number, digits)
 
 
 def find_unbounded_lines_intersection(line1, line2):
-    # FIXME this function may output slightly different intersection if the input is swapped, which should NOT happen.
-    # This is potentially caused by a rounding error -- more investigation is needed.
-    # The consequence of this rounding error is an infinite loop in the _split_intersecting_elements function.
-    # Sort line1 and line2 to force a consistent output
-    [line1, line2] = sorted([tuple(line1), tuple(line2)])
-
     (x1, y1), (x2, y2) = line1
     (x3, y3), (x4, y4) = line2
 
-    # Excessive decimal places must be truncated to avoid rounding error
-    x1, y1 = truncate(x1), truncate(y1)
-    x2, y2 = truncate(x2), truncate(y2)
-    x3, y3 = truncate(x3), truncate(y3)
-    x4, y4 = truncate(x4), truncate(y4)
+    # Intersection is computed with exact integer arithmetic on the fixed-point grid, so the output
+    # does not depend on the order of the input lines.
+    fixed_line1 = (to_fixed(x1), to_fixed(y1)), (to_fixed(x2), to_fixed(y2))
+    fixed_line2 = (to_fixed(x3), to_fixed(y3)), (to_fixed(x4), to_fixed(y4))
 
-    # Calculate the slopes of the two line segments
-    m1 = (y2 - y1) / (x2 - x1) if (x2 - x1) != 0 else float('inf')
-    m2 = (y4 - y3) / (x4 - x3) if (x4 - x3) != 0 else float('inf')
-
-    # Check if the segments are parallel (the slopes are the same)
-    if m1 == m2:
+    intersection = fixed_lines_intersection(fixed_line1, fixed_line2)
+    if intersection is None:
         return None  # No intersection, the lines are parallel
 
-    # Calculate the intersection point
-    if m1 == float('inf'):  # First line is vertical
-        x = x1
-        y = m2 * (x - x3) + y3
-    elif m2 == float('inf'):  # Second line is vertical
-        x = x3
-        y = m1 * (x - x1) + y1
-    else:
-        x = (m1 * x1 - y1 - m2 * x3 + y3) / (m1 - m2)
-        y = m1 * (x - x1) + y1
-
-    x, y = truncate(x), truncate(y)
-    return (x, y)
+    x, y = intersection
+    return (from_fixed(x), from_fixed(y))
 
 
 def find_lines_intersection(line1, line2):
-    # FIXME this function may output slightly different intersection if the input is swapped, which should NOT happen.
-    # This is potentially caused by a rounding error -- more investigation is needed.
-    # The consequence of this rounding error is an infinite loop in the _split_intersecting_elements function.
-    # Sort line1 and line2 to force a consistent output
-    [line1, line2] = sorted([tuple(line1), tuple(line2)])
     (x1, y1), (x2, y2) = line1
     (x3, y3), (x4, y4) = line2
+    x1, y1, x2, y2 = to_fixed(x1), to_fixed(y1), to_fixed(x2), to_fixed(y2)
+    x3, y3, x4, y4 = to_fixed(x3), to_fixed(y3), to_fixed(x4), to_fixed(y4)
 
-    # Excessive decimal places must be truncated to avoid rounding error
-    x1, y1 = truncate(x1), truncate(y1)
-    x2, y2 = truncate(x2), truncate(y2)
-    x3, y3 = truncate(x3), truncate(y3)
-    x4, y4 = truncate(x4), truncate(y4)
-
-    res = find_unbounded_lines_intersection(line1, line2)
+    res = fixed_lines_intersection(((x1, y1), (x2, y2)), ((x3, y3), (x4, y4)))
     if res is None:
         return None
 
@@ -102,7 +71,7 @@ def find_lines_intersection(line1, line2):
         min(x3, x4) <= x <= max(x3, x4) and
         min(y3, y4) <= y <= max(y3, y4)
     ):
-        return (x, y)  # Intersection point is within both line segments
+        return (from_fixed(x), from_fixed(y))  # Intersection point is within both line segments
     else:
         return None  # Intersection point is outside one or both line segments
 
@@ -198,16 +167,15 @@ def rotate_point_around_point(origin, vertex, angle_degrees):
     return new_bx, new_by
 
 
-def get_composite_verts(ifc_product):
+def get_composite_verts(ifc_product, shape_cache=None):
     if ifc_product.Representation is not None:
-        shape = ifcopenshell.geom.create_shape(settings, ifc_product)
-        vertices = ifcopenshell.util.shape.get_vertices(shape.geometry)
+        vertices = get_shape_vertices(settings, ifc_product, shape_cache)
         return list(vertices)
 
     vertices = []
     products = ifcopenshell.util.element.get_decomposition(ifc_product)
     for product in products:
-        vertices += get_composite_verts(product)
+        vertices += get_composite_verts(product, shape_cache)
 
     return vertices
 
@@ -272,12 +240,14 @@ def shortest_distance_between_two_lines(segment1, segment2):
 
 
 def get_oriented_xy_bounding_box(vertices):
-    # Vertices must be non-negative, because there is a bug in the Compas library which causes bbox to be improperly calculated.
-    flat_vertices = np.array(vertices).flatten()
-    verts_x, verts_y, verts_z = flat_vertices[::3], flat_vertices[1::3], flat_vertices[2::3]
-    min_x, min_y = min(verts_x), min(verts_y)
-    offset_vertices = [(x - min_x, y - min_y, z) for (x, y, z) in vertices]
-
-    bbox = oriented_bounding_box_xy_numpy(offset_vertices)
-    deoffset_bbox = [(x + min_x, y + min_y) for (x, y) in bbox]
-    return deoffset_bbox
+    bbox = get_oriented_xy_bounding_boxes([np.array(vertices)])[0]
+    return [(x, y) for x, y in bbox.tolist()]
+
+
+def get_oriented_xy_bounding_box_batch(vertex_clouds) -> list:
+    """
+    Same as get_oriented_xy_bounding_box for several vertex clouds, computed in one batch.
+    Output: Array of the box of each vertex cloud, None for the clouds whose vertices are all collinear
+    """
+    bboxes = get_oriented_xy_bounding_boxes([np.array(vertices) for vertices in vertex_clouds], skip_collinear=True)
+    return [None if bbox is None else [(x, y) for x, y in bbox.tolist()] for bbox in bboxes]
@@ -1,37 +1,37 @@
 from typing import Tuple, Any
-import ifcopenshell.util.element
-import ifcopenshell.util.placement
 import numpy as np
 from typing import Tuple
-from .utils import filter, get_composite_verts, get_sorted_building_storeys
+from .utils import get_composite_verts
+from .storey_index import StoreyElevationIndex
+from .model_index import ModelIndex
+from .geom_settings import settings
 from .logger import logger
 
 
-def get_walls_by_storey(ifc_building, min_wall_height, wall_offset_tolerance, unit_scale):
-    walls_map = dict()
-    ifc_walls = get_all_walls(ifc_building)
-
-    sorted_storeys = get_sorted_building_storeys(ifc_building)
-    for i, storey in enumerate(sorted_storeys):
-        elevation = ifcopenshell.util.placement.get_storey_elevation(storey) * unit_scale
-        walls_in_storey = []
-        for (ifc_wall, z_min, z_max) in ifc_walls:
-            tolerance = wall_offset_tolerance
-            wall_contained_within_boundary = (z_min <= elevation + tolerance and z_max >= elevation + min_wall_height - tolerance)
-            if wall_contained_within_boundary:
-                walls_in_storey.append(ifc_wall)
-        walls_map[storey] = walls_in_storey
+def get_walls_by_storey(ifc_building, min_wall_height, wall_offset_tolerance, unit_scale, shape_cache=None, storey_index=None, model_index=None):
+    if model_index is None:
+        model_index = ModelIndex(ifc_building)
+    if storey_index is None:
+        storey_index = StoreyElevationIndex(ifc_building, unit_scale, model_index)
+    walls_map = {storey: [] for storey in storey_index.storeys}
+    ifc_walls = get_all_walls(ifc_building, shape_cache, model_index)
+
+    for (ifc_wall, z_min, z_max) in ifc_walls:
+        for i in storey_index.get_storey_indices_containing_wall(z_min, z_max, min_wall_height, wall_offset_tolerance):
+            walls_map[storey_index.storeys[i]].append(ifc_wall)
     return walls_map
 
 
-def get_all_walls(ifc_building) -> Tuple[Any, float, float]:
+def get_all_walls(ifc_building, shape_cache=None, model_index=None) -> Tuple[Any, float, float]:
     logger.debug("Retrieving walls...")
-    building_elements = ifcopenshell.util.element.get_decomposition(ifc_building)
-    walls = filter(building_elements, matcher=lambda x: x.is_a("IfcWall") or x.is_a("IfcCurtainWall"))
+    if model_index is None:
+        model_index = ModelIndex(ifc_building)
+    # Walls are sorted by GlobalId so that conversions (and storey fingerprints) are reproducible
+    walls = sorted(model_index.get_elements("IfcWall", "IfcCurtainWall"), key=lambda x: x.GlobalId)
     out = []
     for ifc_wall in walls:
         try:
-            z_min, z_max = _wall_z_extremes(ifc_wall)
+            z_min, z_max = _wall_z_extremes(ifc_wall, shape_cache)
             out.append((ifc_wall, z_min, z_max))
         except Exception as exc:
             logger.warning(f"Skipped wall parsing: error parsing wall {ifc_wall.Name}: {exc}")
@@ -39,8 +39,11 @@ def get_all_walls(ifc_building) -> Tuple[Any, float, float]:
     return out
 
 
-def _wall_z_extremes(ifc_wall):
-    vertices = get_composite_verts(ifc_wall)
+def _wall_z_extremes(ifc_wall, shape_cache=None):
+    if shape_cache is not None and ifc_wall.Representation is not None:
+        return shape_cache.get_z_extents(settings, ifc_wall)
+
+    vertices = get_composite_verts(ifc_wall, shape_cache)
     flattened = np.array(vertices).flatten()
     z_verts = flattened[2::3]
     return min(z_verts), max(z_verts)
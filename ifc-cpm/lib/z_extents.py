@@ -0,0 +1,152 @@
+from typing import List, Tuple
+from collections import Counter
+import numpy as np
+import ifcopenshell.util.placement
+from .geom_settings import settings
+from .profiling import Profiler, NULL_PROFILER
+
+"""
+Vertical extents of openings and doors without tessellating them.
+Deciding whether an opening or a door reaches a floor only needs its lowest and highest z. For most elements these can
+be computed exactly from the object placement and the corners of an extruded rectangle or polyline profile, or of a
+bounding box. Doors are otherwise assumed to span their OverallHeight from their placement; this ignores the part of
+the door frame above the door leaf, which does not matter when deciding whether the door starts at a floor.
+Elements whose z extents cannot be read from their attributes are tessellated, as before.
+"""
+
+# Sources of z extents, from the most to the least preferred
+Z_EXTENT_SOURCES = ["extrusion", "bounding-box", "overall-height", "tessellation"]
+
+
+def _transform_points(matrix: np.ndarray, points: np.ndarray) -> np.ndarray:
+    return points @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+def _get_profile_points(profile) -> np.ndarray:
+    """
+    Corners of a profile in its own 2D coordinates, as an (n, 3) array with z = 0. Returns None for profiles with curved edges.
+    """
+    if profile.is_a("IfcRectangleProfileDef"):
+        x, y = profile.XDim / 2, profile.YDim / 2
+        points = np.array([(-x, -y, 0), (x, -y, 0), (x, y, 0), (-x, y, 0)], dtype=np.float64)
+        if profile.Position is not None:
+            points = _transform_points(ifcopenshell.util.placement.get_axis2placement(profile.Position), points)
+        return points
+
+    if profile.is_a("IfcArbitraryClosedProfileDef"):
+        curve = profile.OuterCurve
+        if curve.is_a("IfcPolyline"):
+            coordinates = [point.Coordinates for point in curve.Points]
+        elif curve.is_a("IfcIndexedPolyCurve") and curve.Points.is_a("IfcCartesianPointList2D"):
+            # Arc segments can bulge beyond their points
+            if curve.Segments is not None and any(segment.is_a("IfcArcIndex") for segment in curve.Segments):
+                return None
+            coordinates = curve.Points.CoordList
+        else:
+            return None
+        return np.array([(x, y, 0) for x, y in coordinates], dtype=np.float64)
+
+    return None
+
+
+def _get_box_points(corner, x_dim: float, y_dim: float, z_dim: float) -> np.ndarray:
+    x, y, z = corner
+    return np.array([(x + dx, y + dy, z + dz) for dx in (0, x_dim) for dy in (0, y_dim) for dz in (0, z_dim)], dtype=np.float64)
+
+
+def _get_representation_items(ifc_product, identifier: str) -> List:
+    if ifc_product.Representation is None:
+        return None
+    for representation in ifc_product.Representation.Representations:
+        if representation.RepresentationIdentifier == identifier:
+            return list(representation.Items)
+    return None
+
+
+class ZExtentResolver:
+    """
+    Resolves the z extents (in metres) of IfcOpeningElements and IfcDoors, as ShapeCache.get_z_extents would.
+    The number of elements resolved by each source is kept in counts.
+    """
+    def __init__(self, shape_cache, unit_scale: float, profiler: Profiler = NULL_PROFILER):
+        self.shape_cache = shape_cache
+        self.unit_scale = unit_scale
+        self.profiler = profiler
+        self.counts = Counter({source: 0 for source in Z_EXTENT_SOURCES})
+        # Analytic (source, z extents) of each product, z extents is None when the product must be tessellated
+        self.analytic_z_extents = {}
+
+    def get_z_extents(self, ifc_product) -> Tuple[float, float]:
+        source, z_extents = self.get_analytic_z_extents(ifc_product)
+        if z_extents is None:
+            z_extents = self.shape_cache.get_z_extents(settings, ifc_product)
+        self.counts[source] += 1
+        self.profiler.count(f"z-extents-{source}")
+        return z_extents
+
+    def get_analytic_z_extents(self, ifc_product) -> Tuple[str, Tuple[float, float]]:
+        """
+        Output: (source, z extents), z extents is None if the product can only be resolved by tessellation
+        """
+        if ifc_product.id() in self.analytic_z_extents:
+            return self.analytic_z_extents[ifc_product.id()]
+
+        try:
+            z_extents = self._get_extrusion_z_extents(ifc_product)
+            source = "extrusion"
+            if z_extents is None:
+                z_extents = self._get_bounding_box_z_extents(ifc_product)
+                source = "bounding-box"
+            if z_extents is None and ifc_product.is_a("IfcDoor"):
+                z_extents = self._get_overall_height_z_extents(ifc_product)
+                source = "overall-height"
+        except Exception:
+            # Malformed attributes, the tessellation reports the error if there is one
+            z_extents = None
+        if z_extents is None:
+            source = "tessellation"
+
+        self.analytic_z_extents[ifc_product.id()] = (source, z_extents)
+        return source, z_extents
+
+    def _get_z_range(self, matrix: np.ndarray, points: np.ndarray) -> Tuple[float, float]:
+        z = _transform_points(matrix, points)[:, 2] * self.unit_scale
+        return float(z.min()), float(z.max())
+
+    def _get_extrusion_z_extents(self, ifc_product) -> Tuple[float, float]:
+        items = _get_representation_items(ifc_product, "Body")
+        if not items:
+            return None
+
+        placement = ifcopenshell.util.placement.get_local_placement(ifc_product.ObjectPlacement)
+        z_ranges = []
+        for item in items:
+            if not item.is_a("IfcExtrudedAreaSolid"):
+                return None
+            profile_points = _get_profile_points(item.SweptArea)
+            if profile_points is None:
+                return None
+            direction = np.array(item.ExtrudedDirection.DirectionRatios, dtype=np.float64)
+            direction = direction / np.linalg.norm(direction) * item.Depth
+            points = np.concatenate([profile_points, profile_points + direction])
+            matrix = placement
+            if item.Position is not None:
+                matrix = placement @ ifcopenshell.util.placement.get_axis2placement(item.Position)
+            z_ranges.append(self._get_z_range(matrix, points))
+        return min(z_min for z_min, _ in z_ranges), max(z_max for _, z_max in z_ranges)
+
+    def _get_bounding_box_z_extents(self, ifc_product) -> Tuple[float, float]:
+        items = _get_representation_items(ifc_product, "Box")
+        if not items or not items[0].is_a("IfcBoundingBox"):
+            return None
+
+        box = items[0]
+        placement = ifcopenshell.util.placement.get_local_placement(ifc_product.ObjectPlacement)
+        return self._get_z_range(placement, _get_box_points(box.Corner.Coordinates, box.XDim, box.YDim, box.ZDim))
+
+    def _get_overall_height_z_extents(self, ifc_product) -> Tuple[float, float]:
+        if not ifc_product.OverallHeight:
+            return None
+
+        placement = ifcopenshell.util.placement.get_local_placement(ifc_product.ObjectPlacement)
+        return self._get_z_range(placement, np.array([(0, 0, 0), (0, 0, ifc_product.OverallHeight)], dtype=np.float64))
@@ -0,0 +1,68 @@
+"""
+Sweep of the tolerance parameters of the conversion of an IFC file to CPM.
+
+Converts a building once per combination of the given parameter values, loading and tessellating the IFC file only
+once, and writes one CPM file per combination along with a CSV summary of their element counts and barricade ratios.
+
+Usage:
+    python sweep.py ifc/house.ifc --output-dir sweep --origin 5 5 --close-wall-gap 0.1 0.2 0.4 --min-wall-height 0.5 1
+"""
+import sys
+import argparse
+from lib.IfcToCpmConverter import IfcToCpmConverterBuilder
+from lib.preprocessors import SPLIT_METHODS
+from lib.sweep import sweep_parameters
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert an IFC file to CPM once per combination of tolerance parameters.")
+    parser.add_argument("input", help="IFC file")
+    parser.add_argument("--output-dir", default="sweep", help="Directory to write the CPM files and the summary to")
+    parser.add_argument("--summary", help="CSV summary to write (default: <output-dir>/summary.csv)")
+    parser.add_argument("--threads", type=int, default=None, help="Number of combinations converted at the same time")
+    parser.add_argument("--workers", type=int, default=None, help="Number of processes preprocessing the storeys of all combinations (default: all cores)")
+    parser.add_argument("--compress", action="store_true", help="Write gzip compressed .cpm.gz files")
+    parser.add_argument("--building", help="Name of the building to convert (default: the first building)")
+    parser.add_argument("--origin", type=float, nargs=2, metavar=("X", "Y"))
+    parser.add_argument("--dimension", type=float, nargs=2, metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--close-wall-gap", type=float, nargs="+", default=[0.2], help="Metres, one or more values")
+    parser.add_argument("--min-wall-height", type=float, nargs="+", default=[0.5], help="Metres, one or more values")
+    parser.add_argument("--wall-offset-tolerance", type=float, nargs="+", default=[0.1], help="Metres, one or more values")
+    parser.add_argument("--split-method", choices=list(SPLIT_METHODS.keys()), default="sweep-line")
+    parser.add_argument("--low-memory", action="store_true", help="Only load the parts of the IFC file used by the converter")
+    parser.add_argument("--cache-dir", help="Directory of the persisted geometry caches")
+    args = parser.parse_args()
+
+    grid = {
+        "close_wall_gap_metre": args.close_wall_gap,
+        "min_wall_height_metre": args.min_wall_height,
+        "wall_offset_tolerance_metre": args.wall_offset_tolerance,
+    }
+    builder = IfcToCpmConverterBuilder(args.input, low_memory=args.low_memory)
+    rows = sweep_parameters(
+        builder,
+        grid,
+        args.output_dir,
+        building_name=args.building,
+        threads=args.threads,
+        workers=args.workers,
+        compress=args.compress,
+        summary_filepath=args.summary,
+        origin=tuple(args.origin) if args.origin else None,
+        dimension=tuple(args.dimension) if args.dimension else None,
+        split_method=args.split_method,
+        cache_dir=args.cache_dir,
+    )
+
+    for row in rows:
+        if row["status"] == "ok":
+            print(f"{row['output']}: {row['walls']} walls, {row['gates']} gates, {row['barricades']} barricades ({row['barricade_ratio']:.1%})")
+        else:
+            print(f"{row['output']}: {row['status']}: {row['error']}")
+
+    if any(row["status"] != "ok" for row in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()